@@ -6,6 +6,8 @@ Modules and Classes:
 - END: Constant to define the end state.
 - MemorySaver: Class for saving checkpoints.
 - AgentState: Class representing the state of the agent.
+- traced_node: Function wrapping each node with a tracing span.
+- register_cache, register_queues: Functions exposing cache hit rates and queue depths as metrics.
 
 Functions:
 - call_agent_model: Function to call the agent model.
@@ -28,30 +30,47 @@ Functions:
 
 from langgraph.graph import StateGraph, END
 from langgraph.checkpoint.memory import MemorySaver
-from base_agent.utils.nodes import call_agent_model, agent_route, get_help, extract_task, agent_tool_node
+from base_agent.utils.nodes import call_agent_model, agent_route, get_help, extract_task, agent_tool_node, _get_model as _get_agent_model
+from base_agent.utils.expert_nodes import _get_model as _get_expert_model
 from base_agent.utils.expert_nodes import call_database, create_plan, task_handler, database_handler, user_handler, human_feedback, calculation_handler, llm_handler, task_router, output_handler, feedback_handler
 from base_agent.utils.state import AgentState
+from base_agent.utils.tools import section_tree_cache, retrieval_cache, ranking_cache, embedding_cache
+from base_agent.utils.compaction import passage_cache
+from base_agent.utils.tracing import traced_node
+from base_agent.utils.metrics import register_cache, register_queues
+from base_agent.utils.admission import queue_depths
+
+# Expose the hit rates of the model caches (metrics are served if NORMGRAPH_METRICS_PORT is set, see metrics.py)
+register_cache("agent_models", lambda: _get_agent_model.cache_info()[:2])
+register_cache("expert_models", lambda: _get_expert_model.cache_info()[:2])
+register_cache("section_trees", section_tree_cache.stats)
+register_cache("retrievals", retrieval_cache.stats)
+register_cache("rankings", ranking_cache.stats)
+register_cache("passages", passage_cache.stats)
+register_cache("embeddings", embedding_cache.stats)
+register_queues(queue_depths)
 
 # Define parent graph
+# every node is wrapped with a tracing span (see tracing.py), exported if NORMGRAPH_TRACE_FILE or NORMGRAPH_OTLP_ENDPOINT is set
 workflow = StateGraph(AgentState)
 
 # Agent nodes
-workflow.add_node("agent", call_agent_model) 
-workflow.add_node("DocumentSearch", agent_tool_node)
-workflow.add_node("GetHelp", get_help)
-workflow.add_node("InvokeExpertModel", extract_task)
+workflow.add_node("agent", traced_node("agent", call_agent_model)) 
+workflow.add_node("DocumentSearch", traced_node("DocumentSearch", agent_tool_node))
+workflow.add_node("GetHelp", traced_node("GetHelp", get_help))
+workflow.add_node("InvokeExpertModel", traced_node("InvokeExpertModel", extract_task))
 
 # Expert nodes
-workflow.add_node("InitialRetrieval", call_database)
-workflow.add_node("CreatePlan", create_plan)
-workflow.add_node("TaskRouter", task_router)
-workflow.add_node("DataBaseHandler", database_handler)
-workflow.add_node("UserHandler", user_handler)
-workflow.add_node("HumanFeedback", human_feedback)
-workflow.add_node("FeedbackHandler", feedback_handler)
-workflow.add_node("CalculationHandler", calculation_handler)
-workflow.add_node("LLMHandler", llm_handler)
-workflow.add_node("OutputHandler", output_handler)
+workflow.add_node("InitialRetrieval", traced_node("InitialRetrieval", call_database))
+workflow.add_node("CreatePlan", traced_node("CreatePlan", create_plan))
+workflow.add_node("TaskRouter", traced_node("TaskRouter", task_router))
+workflow.add_node("DataBaseHandler", traced_node("DataBaseHandler", database_handler))
+workflow.add_node("UserHandler", traced_node("UserHandler", user_handler))
+workflow.add_node("HumanFeedback", traced_node("HumanFeedback", human_feedback))
+workflow.add_node("FeedbackHandler", traced_node("FeedbackHandler", feedback_handler))
+workflow.add_node("CalculationHandler", traced_node("CalculationHandler", calculation_handler))
+workflow.add_node("LLMHandler", traced_node("LLMHandler", llm_handler))
+workflow.add_node("OutputHandler", traced_node("OutputHandler", output_handler))
 
 # Set the entrypoint as `agent`
 workflow.set_entry_point("agent")
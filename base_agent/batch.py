@@ -0,0 +1,240 @@
+"""
+This module provides the bulk question-answering entry point over the compiled `graph` of agent.py, for running question sets (e.g. compliance checklists in the style of `questions.csv`) in one batch.
+
+Work is shared between the questions of a batch:
+- identical questions (ignoring whitespace) are answered once, the result is returned for every occurrence
+- all questions are embedded up front in bulk requests (`embed_queries`), retrieval queries equal to a question need no embedding request
+- retrievals go through the shared retrieval cache of tools.py, identical sub-queries of concurrently running questions are retrieved once (single-flight)
+- graph invocations run concurrently, limited by a semaphore
+- with `budget_s`, every graph invocation gets a latency budget (see deadline.py): slow dependencies are cut off and the answer degrades instead of exceeding it
+- with a `scheduler`, every graph invocation is admitted by the admission control (see admission.py) with the 'batch' priority, so interactive turns sharing the scheduler go first; shed questions are returned with the load shedding answer and the error
+
+Results are streamed as the questions finish. Questions interrupted at `HumanFeedback` are answered by the optional `feedback` function, otherwise they are returned with the pending question and can be resumed with their thread id.
+
+Usage (run from the repository root):
+```shell
+python -m base_agent.batch helper_notebooks_benchmark/questions.csv --concurrency 8 --output results.jsonl
+```
+
+Modules and Classes:
+- BatchResult: Class holding the result of a question.
+- BatchStats: Class tracking the progress and the throughput of a batch.
+
+Functions:
+- answer_batch: Async generator answering a list of questions and yielding the results as they finish.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import time
+import uuid
+
+from langchain_core.messages import HumanMessage
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+from base_agent.agent import graph
+from base_agent.utils.admission import AdmissionScheduler, Overloaded, load_shed_message, with_priority
+from base_agent.utils.deadline import with_budget
+from base_agent.utils.tools import embed_queries, embedding_cache, retrieval_cache
+from base_agent.utils.tracing import span
+
+
+class BatchResult:
+    """Result of a single question of a batch."""
+
+    def __init__(self, index, question, thread_id):
+        self.index = index
+        self.question = question
+        self.thread_id = thread_id
+        self.response = ""
+        self.pending_question = ""   # set if the question stopped at HumanFeedback without an answer
+        self.interrupts = 0
+        self.latency = 0.0
+        self.error = ""
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "question": self.question,
+            "thread_id": self.thread_id,
+            "response": self.response,
+            "pending_question": self.pending_question,
+            "interrupts": self.interrupts,
+            "latency_s": round(self.latency, 3),
+            "error": self.error,
+        }
+
+
+class BatchStats:
+    """Progress and throughput of a batch."""
+
+    def __init__(self, total):
+        self.total = total
+        self.unique = 0
+        self.completed = 0
+        self.errors = 0
+        self.start = time.perf_counter()
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def questions_per_minute(self):
+        elapsed = self.elapsed()
+        return self.completed / elapsed * 60 if elapsed else 0.0
+
+    def to_dict(self):
+        return {
+            "questions": self.total,
+            "unique_questions": self.unique,
+            "completed": self.completed,
+            "errors": self.errors,
+            "wall_time_s": round(self.elapsed(), 3),
+            "questions_per_minute": round(self.questions_per_minute(), 2),
+            "retrieval_cache": dict(zip(("hits", "misses"), retrieval_cache.stats()), deduplicated=retrieval_cache.deduplicated),
+            "embedding_cache": dict(zip(("hits", "misses"), embedding_cache.stats()), deduplicated=embedding_cache.deduplicated),
+        }
+
+
+def _normalize(question):
+    return " ".join(question.split())
+
+
+async def _invoke(graph_input, run_config, budget_s, scheduler):
+    if scheduler is None:
+        return await graph.ainvoke(graph_input, with_budget(run_config, budget_s) if budget_s else run_config)
+    configurable = run_config["configurable"]
+    async with scheduler.admit(configurable.get("tenant", "default"), configurable.get("priority", "batch")):
+        # the budget starts after the admission, the queue wait is limited by the scheduler
+        return await graph.ainvoke(graph_input, with_budget(run_config, budget_s) if budget_s else run_config)
+
+
+async def _answer(index, question, feedback, max_interrupts, config, budget_s=None, scheduler=None):
+    result = BatchResult(index, question, str(uuid.uuid4()))
+    run_config = dict(config or {}, configurable=dict((config or {}).get("configurable", {}), thread_id=result.thread_id))
+    run_config.setdefault("recursion_limit", 100)
+    if scheduler is not None and "priority" not in run_config["configurable"]:
+        run_config = with_priority(run_config, "batch")
+
+    start = time.perf_counter()
+    try:
+        graph_input = {"messages": [HumanMessage(question)]}
+        while True:
+            # the budget starts with each invocation, the time waiting for feedback is not part of it
+            await _invoke(graph_input, run_config, budget_s, scheduler)
+            state = await graph.aget_state(run_config)
+            if "HumanFeedback" not in state.next:
+                break
+            asked = state.values["messages"][-1].content
+            answer = feedback(question, asked) if feedback is not None else None
+            if answer is None or result.interrupts >= max_interrupts:
+                result.pending_question = asked
+                break
+            result.interrupts += 1
+            await graph.aupdate_state(run_config, {"messages": [HumanMessage(answer)]})
+            graph_input = None
+
+        messages = state.values.get("messages", [])
+        result.response = "\n".join(str(message.content) for message in messages[1:] if message.type == "ai" and message.content)
+    except Overloaded as e:
+        result.response = load_shed_message(e)
+        result.error = f"{type(e).__name__}: {e}"
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.latency = time.perf_counter() - start
+    return result
+
+
+async def answer_batch(questions, concurrency=4, feedback=None, max_interrupts=5, config=None, stats=None, budget_s=None, scheduler=None):
+    """
+    Answers a list of questions through the graph and yields the results as they finish.
+
+    Args:
+    questions (list): The questions to answer.
+    concurrency (int): Maximum number of concurrent graph invocations.
+    feedback (callable): Optional function (question, asked) -> answer for HumanFeedback interrupts, returning None leaves the question pending.
+    max_interrupts (int): Maximum number of answered interrupts per question.
+    config (dict): Optional base config of the graph invocations (callbacks, configurable values).
+    stats (BatchStats): Optional stats object, updated while the batch runs.
+    budget_s (float): Optional latency budget of each graph invocation in seconds.
+    scheduler (AdmissionScheduler): Optional admission control of the graph invocations, shared with other callers of the graph.
+
+    Yields:
+    BatchResult: One result per question (duplicates get a copy with their own index).
+    """
+    stats = stats or BatchStats(len(questions))
+    occurrences = {}
+    for index, question in enumerate(questions):
+        occurrences.setdefault(_normalize(question), []).append(index)
+    stats.unique = len(occurrences)
+
+    with span("batch.embed", questions=len(occurrences)):
+        await asyncio.to_thread(embed_queries, list(occurrences))
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(indices):
+        async with semaphore:
+            return indices, await _answer(indices[0], questions[indices[0]], feedback, max_interrupts, config, budget_s, scheduler)
+
+    tasks = [asyncio.create_task(limited(indices)) for indices in occurrences.values()]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            indices, result = await finished
+            for index in indices:
+                shared = result
+                if index != result.index:
+                    shared = BatchResult(index, questions[index], result.thread_id)
+                    shared.__dict__.update({key: value for key, value in result.__dict__.items() if key not in ("index", "question")})
+                stats.completed += 1
+                stats.errors += bool(shared.error)
+                yield shared
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _load_questions(filename):
+    with open(filename, newline='', encoding='utf-8-sig') as input_file:
+        if filename.endswith(".csv"):
+            reader = csv.DictReader(input_file, delimiter=';')
+            return [row['Questions'].strip() for row in reader if row['Questions'].strip()]
+        return [line.strip() for line in input_file if line.strip()]
+
+
+async def _main(args):
+    questions = _load_questions(args.questions)
+    stats = BatchStats(len(questions))
+    output_file = open(args.output, 'w', encoding='utf-8') if args.output else None
+    try:
+        async for result in answer_batch(questions, args.concurrency, max_interrupts=0, stats=stats, budget_s=args.budget,
+                                         scheduler=AdmissionScheduler() if args.admission else None):
+            line = json.dumps(result.to_dict(), ensure_ascii=False)
+            if output_file:
+                output_file.write(line + "\n")
+                output_file.flush()
+            print(f"[{stats.completed}/{stats.total}] {stats.questions_per_minute():.1f} questions/min - {result.question[:60]}")
+    finally:
+        if output_file:
+            output_file.close()
+    print(json.dumps(stats.to_dict(), indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a set of questions in one batch.")
+    parser.add_argument("questions", help="csv-file (column 'Questions', delimiter ';') or text file with one question per line")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--output", default=None, help="optional json-lines output file")
+    parser.add_argument("--budget", type=float, default=None, help="optional latency budget per graph invocation in seconds")
+    parser.add_argument("--admission", action="store_true", help="admit the graph invocations through the admission control (NORMGRAPH_MAX_RUNS, NORMGRAPH_TENANT_LIMIT, ...)")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
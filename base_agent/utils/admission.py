@@ -0,0 +1,582 @@
+"""
+This module provides the admission control of the application: a scheduler in front of the graph invocations and concurrency limits for the external dependencies.
+
+Graph runs are admitted by the `AdmissionScheduler`: at most NORMGRAPH_MAX_RUNS runs are executed at once, at most NORMGRAPH_TENANT_LIMIT of them per tenant. Waiting runs are queued by priority class ('interactive' before 'expert' before 'batch'). A run is shed with `Overloaded` if the queue holds NORMGRAPH_MAX_QUEUE runs already or if it waited longer than NORMGRAPH_MAX_QUEUE_WAIT_S.
+
+The calls of the dependencies pass a priority semaphore per dependency (NORMGRAPH_DEPENDENCY_LIMITS). Waiting calls are served by the priority of their run: the nodes of the expert model run with the 'expert' priority (see `EXPERT_NODES`), so the calls of simple `DocumentSearch` turns go before the calls of long expert plans. OpenAI requests additionally reserve their estimated tokens in a tokens-per-minute bucket (NORMGRAPH_OPENAI_TPM). The OpenAI clients are limited on the HTTP level (`openai_http_clients`), a request that cannot be admitted in time gets a 429 response with a `retry-after` header, which the OpenAI SDK handles like a rate limit of the API.
+
+The queue wait of the runs and of the dependency calls is recorded in spans ('admission.queue', 'admission.dependency') and exported as metrics (see metrics.py).
+
+Configuration through environment variables:
+- NORMGRAPH_MAX_RUNS: concurrently executed graph runs (default: 16)
+- NORMGRAPH_MAX_QUEUE: queued graph runs before new runs are shed (default: 100)
+- NORMGRAPH_TENANT_LIMIT: concurrently executed graph runs per tenant (default: 4)
+- NORMGRAPH_MAX_QUEUE_WAIT_S: maximum queue wait of a run or dependency call (default: 60)
+- NORMGRAPH_DEPENDENCY_LIMITS: concurrent calls per dependency (default: 'llm=32,assistant=8,embedding=16,neo4j=50', 0 disables a limit)
+- NORMGRAPH_OPENAI_TPM: tokens per minute of the OpenAI requests (default: 0, no limit)
+
+Modules and Classes:
+- Overloaded: Raised when a run or call is shed.
+- PrioritySemaphore: Thread-safe semaphore serving its waiters by priority, awaitable from the event loop.
+- TokenBucket: Tokens-per-minute budget of a dependency.
+- AdmissionScheduler: Scheduler admitting the graph runs.
+- AdmissionProxy: Wrapper limiting the calls of a client (neo4j driver, embedding client).
+
+Functions:
+- with_priority: Function returning a graph config with priority class and tenant.
+- priority_scope: Context manager activating the priority of a graph node.
+- acquire_slot, acquire_slot_async: Functions acquiring a concurrency slot of a dependency from a thread or the event loop.
+- dependency_slot: Context manager holding a concurrency slot of a dependency.
+- openai_http_clients: Function returning the HTTP clients of the OpenAI models with admission control.
+- load_shed_message: Function returning the answer of a shed run.
+- queue_depths: Function returning the queued runs and the waiting calls per dependency (queue depth metrics).
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+
+import httpx
+
+from base_agent.utils.deadline import remaining_budget
+from base_agent.utils.tracing import span
+
+PRIORITIES = {"interactive": 0, "expert": 1, "batch": 2}
+DEFAULT_LIMITS = {"llm": 32, "assistant": 8, "embedding": 16, "neo4j": 50}
+OUTPUT_TOKEN_ESTIMATE = 500     # completion tokens reserved for OpenAI requests without max_tokens
+
+# nodes of the expert model, their dependency calls are served after those of interactive turns
+EXPERT_NODES = {"InvokeExpertModel", "InitialRetrieval", "CreatePlan", "TaskRouter", "DataBaseHandler", "UserHandler",
+                "HumanFeedback", "FeedbackHandler", "CalculationHandler", "LLMHandler", "OutputHandler"}
+
+_priority = contextvars.ContextVar("normgraph_priority", default="interactive")
+
+
+class Overloaded(RuntimeError):
+    """Raised when a graph run or a dependency call is shed. `retry_after_s` estimates when a retry may be admitted."""
+
+    def __init__(self, reason, retry_after_s=1.0):
+        super().__init__(f"overloaded ({reason}), retry after {retry_after_s:.0f}s")
+        self.reason = reason
+        self.retry_after_s = retry_after_s
+
+
+def load_shed_message(error):
+    """Returns the answer of a shed run for the user."""
+    return f"Das System ist derzeit ausgelastet. Bitte versuchen Sie es in {max(1, round(error.retry_after_s))} Sekunden erneut."
+
+
+#----------------- Configuration -----------------#
+def _env_int(name, default):
+    return int(os.environ.get(name, str(default)))
+
+
+def max_queue_wait_s():
+    return float(os.environ.get("NORMGRAPH_MAX_QUEUE_WAIT_S", "60"))
+
+
+def dependency_limits():
+    # 'llm=16,neo4j=20' -> {'llm': 16, 'neo4j': 20, ...}
+    limits = dict(DEFAULT_LIMITS)
+    for part in filter(None, (p.strip() for p in os.environ.get("NORMGRAPH_DEPENDENCY_LIMITS", "").split(","))):
+        kind, limit = part.split("=", 1)
+        limits[kind.strip()] = int(limit)
+    return limits
+
+
+def with_priority(config, priority="interactive", tenant=None):
+    """Returns a copy of the graph config with the priority class (and tenant) of the run."""
+    config = dict(config or {})
+    configurable = dict(config.get("configurable") or {}, priority=priority)
+    if tenant is not None:
+        configurable["tenant"] = tenant
+    config["configurable"] = configurable
+    return config
+
+
+@contextmanager
+def priority_scope(name, config):
+    """Activates the priority of a graph node: the priority class of the run, lowered to 'expert' for the nodes of the expert model."""
+    priority = ((config or {}).get("configurable") or {}).get("priority", "interactive")
+    if name in EXPERT_NODES and PRIORITIES.get(priority, 0) < PRIORITIES["expert"]:
+        priority = "expert"
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+#----------------- Dependency limits -----------------#
+class PrioritySemaphore:
+    """Semaphore whose waiters are served by priority (lower first), then in arrival order. Usable from threads (`acquire`) and coroutines (`acquire_async`)."""
+
+    def __init__(self, value):
+        self._value = value
+        self._waiters = []
+        # wake-up callbacks of the waiting coroutines by their waiter entry, the waiting threads wait on the condition
+        self._wakers = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def _wake(self):
+        # called with the condition held: the waiting threads check whether they are first, a coroutine is only woken when it is first
+        self._condition.notify_all()
+        if self._waiters:
+            waker = self._wakers.get(self._waiters[0])
+            if waker is not None:
+                waker()
+
+    def _remove(self, entry):
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+        self._wakers.pop(entry, None)
+        self._wake()
+
+    def try_acquire(self):
+        with self._condition:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return True
+            return False
+
+    def acquire(self, priority=0, timeout=None):
+        """Waits for a slot, returns False if none was free within `timeout` seconds."""
+        with self._condition:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return True
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiters, entry)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not (self._value > 0 and self._waiters[0] == entry):
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    self._remove(entry)
+                    return False
+                self._condition.wait(left)
+            heapq.heappop(self._waiters)
+            self._value -= 1
+            if self._value > 0 and self._waiters:
+                self._wake()
+            return True
+
+    async def acquire_async(self, priority=0, timeout=None):
+        """
+        Like `acquire`, but waits on the event loop instead of blocking a thread.
+        The slot is taken without a suspension point in between, so a cancelled wait never holds a slot.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._condition:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return True
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiters, entry)
+            self._wakers[entry] = lambda: loop.call_soon_threadsafe(event.set)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                with self._condition:
+                    if self._value > 0 and self._waiters[0] == entry:
+                        heapq.heappop(self._waiters)
+                        del self._wakers[entry]
+                        self._value -= 1
+                        if self._value > 0 and self._waiters:
+                            self._wake()
+                        return True
+                    event.clear()
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    with self._condition:
+                        self._remove(entry)
+                    return False
+                try:
+                    await asyncio.wait_for(event.wait(), left)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # cancelled while waiting: the entry is removed and the next waiter is woken
+            with self._condition:
+                if entry in self._wakers:
+                    self._remove(entry)
+            raise
+
+    def release(self):
+        with self._condition:
+            self._value += 1
+            self._wake()
+
+    def waiting(self):
+        with self._condition:
+            return len(self._waiters)
+
+
+class TokenBucket:
+    """Tokens-per-minute budget. Reservations are deducted at once, the caller waits until the bucket is refilled."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens, max_wait_s=None):
+        """Reserves `tokens` and returns the seconds to wait before using them, None if the wait would exceed `max_wait_s` (nothing is reserved then)."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            tokens = min(tokens, self.capacity)
+            wait = max(0.0, (tokens - self.tokens) / self.rate)
+            if max_wait_s is not None and wait > max_wait_s:
+                return None
+            self.tokens -= tokens
+            return wait
+
+
+_gates = {}
+_gates_lock = threading.Lock()
+# schedulers of the process, reported by `queue_depths`
+_schedulers = weakref.WeakSet()
+
+
+def _semaphore(kind):
+    with _gates_lock:
+        if kind not in _gates:
+            limit = dependency_limits().get(kind, 0)
+            _gates[kind] = PrioritySemaphore(limit) if limit > 0 else None
+        return _gates[kind]
+
+
+@lru_cache(maxsize=1)
+def _token_bucket():
+    tpm = _env_int("NORMGRAPH_OPENAI_TPM", 0)
+    return TokenBucket(tpm) if tpm > 0 else None
+
+
+def _slot_timeout():
+    # waiting for a slot counts against the request deadline (see deadline.py)
+    remaining = remaining_budget()
+    return max_queue_wait_s() if remaining is None else max(0.0, min(remaining, max_queue_wait_s()))
+
+
+def acquire_slot(kind, tokens=0):
+    """
+    Acquires a concurrency slot of a dependency (and reserves `tokens` in the OpenAI bucket for 'llm' and 'assistant' calls).
+
+    Returns:
+    callable: Function releasing the slot (idempotent).
+
+    Raises:
+    Overloaded: If no slot or tokens were available within the queue wait limit or the remaining request budget.
+    """
+    semaphore = _semaphore(kind)
+    priority = _priority.get()
+    if semaphore is not None and not semaphore.try_acquire():
+        with span("admission.dependency", dependency=kind, priority=priority) as wait_span:
+            if not semaphore.acquire(PRIORITIES.get(priority, 0), _slot_timeout()):
+                wait_span.set("shed", "dependency")
+                raise Overloaded(f"{kind} limit", retry_after_s=1.0)
+
+    release = _releaser(semaphore)
+    wait = _reserve_tokens(kind, tokens, release)
+    if wait > 0:
+        with span("admission.tpm", dependency=kind, tokens=tokens):
+            time.sleep(wait)
+    return release
+
+
+async def acquire_slot_async(kind, tokens=0):
+    """
+    Like `acquire_slot`, but waits for the slot and the tokens on the event loop instead of blocking a worker thread. A cancelled call holds no slot.
+
+    Returns:
+    callable: Function releasing the slot (idempotent).
+
+    Raises:
+    Overloaded: If no slot or tokens were available within the queue wait limit or the remaining request budget.
+    """
+    semaphore = _semaphore(kind)
+    priority = _priority.get()
+    if semaphore is not None and not semaphore.try_acquire():
+        with span("admission.dependency", dependency=kind, priority=priority) as wait_span:
+            if not await semaphore.acquire_async(PRIORITIES.get(priority, 0), _slot_timeout()):
+                wait_span.set("shed", "dependency")
+                raise Overloaded(f"{kind} limit", retry_after_s=1.0)
+
+    release = _releaser(semaphore)
+    wait = _reserve_tokens(kind, tokens, release)
+    if wait > 0:
+        try:
+            with span("admission.tpm", dependency=kind, tokens=tokens):
+                await asyncio.sleep(wait)
+        except BaseException:
+            release()
+            raise
+    return release
+
+
+def _releaser(semaphore):
+    released = threading.Event()
+
+    def release():
+        if semaphore is not None and not released.is_set():
+            released.set()
+            semaphore.release()
+    return release
+
+
+def _reserve_tokens(kind, tokens, release):
+    # returns the seconds to wait for the reserved tokens, releases the slot and raises Overloaded if they are not available in time
+    bucket = _token_bucket() if kind in ("llm", "assistant") else None
+    if not tokens or bucket is None:
+        return 0.0
+    wait = bucket.reserve(tokens, _slot_timeout())
+    if wait is None:
+        release()
+        with span("admission.tpm", dependency=kind, tokens=tokens, shed="tokens_per_minute"):
+            pass
+        raise Overloaded("tokens per minute", retry_after_s=tokens / bucket.rate)
+    return wait
+
+
+@contextmanager
+def dependency_slot(kind, tokens=0):
+    """Holds a concurrency slot of a dependency while the block runs (see `acquire_slot`)."""
+    release = acquire_slot(kind, tokens)
+    try:
+        yield
+    finally:
+        release()
+
+
+class AdmissionProxy:
+    """Wrapper running the given methods of a client (e.g. `execute_query` of the neo4j driver) with a concurrency slot of its dependency. Other attributes are passed through."""
+
+    def __init__(self, client, kind, methods):
+        self._client = client
+        self._kind = kind
+        self._methods = set(methods)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name not in self._methods:
+            return attribute
+
+        def admitted(*args, **kwargs):
+            with dependency_slot(self._kind):
+                return attribute(*args, **kwargs)
+        return admitted
+
+
+#----------------- OpenAI HTTP clients -----------------#
+def estimate_request_tokens(content):
+    """Rough token estimate of an OpenAI request body: 4 bytes per prompt token plus the requested (or estimated) completion tokens."""
+    try:
+        body = json.loads(content or b"{}")
+    except ValueError:
+        body = {}
+    output = body.get("max_completion_tokens") or body.get("max_tokens") or OUTPUT_TOKEN_ESTIMATE
+    return len(content or b"") // 4 + output
+
+
+def _shed_response(request, error):
+    return httpx.Response(429, headers={"retry-after": str(max(1, round(error.retry_after_s)))},
+                          json={"error": {"message": str(error), "type": "load_shed", "code": error.reason}}, request=request)
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    # the slot is held until the (streamed) response body is closed
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+
+class AdmittedTransport(httpx.HTTPTransport):
+    """HTTP transport acquiring a slot of its dependency per request, requests that cannot be admitted get a 429 response."""
+
+    def __init__(self, kind, **kwargs):
+        super().__init__(**kwargs)
+        self.kind = kind
+
+    def handle_request(self, request):
+        try:
+            release = acquire_slot(self.kind, estimate_request_tokens(request.content))
+        except Overloaded as error:
+            return _shed_response(request, error)
+        try:
+            response = super().handle_request(request)
+        except BaseException:
+            release()
+            raise
+        response.stream = _ReleasingStream(response.stream, release)
+        return response
+
+
+class AsyncAdmittedTransport(httpx.AsyncHTTPTransport):
+    """Async variant of `AdmittedTransport`, the slot is awaited on the event loop (`acquire_slot_async`)."""
+
+    def __init__(self, kind, **kwargs):
+        super().__init__(**kwargs)
+        self.kind = kind
+
+    async def handle_async_request(self, request):
+        try:
+            release = await acquire_slot_async(self.kind, estimate_request_tokens(request.content))
+        except Overloaded as error:
+            return _shed_response(request, error)
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            release()
+            raise
+        response.stream = _AsyncReleasingStream(response.stream, release)
+        return response
+
+
+@lru_cache(maxsize=4)
+def openai_http_clients(kind="llm"):
+    """Returns the keyword arguments `http_client` and `http_async_client` of the OpenAI clients, limited by the slots of `kind`."""
+    return {"http_client": httpx.Client(transport=AdmittedTransport(kind), timeout=None),
+            "http_async_client": httpx.AsyncClient(transport=AsyncAdmittedTransport(kind), timeout=None)}
+
+
+#----------------- Graph run scheduler -----------------#
+class AdmissionScheduler:
+    """
+    Admits graph runs: bounded number of running runs (overall and per tenant), waiting runs queued by priority class, runs shed when the queue is full or their wait exceeds the limit.
+    Runs on the event loop of the graph invocations.
+    """
+
+    def __init__(self, max_running=None, max_queue=None, tenant_limit=None, max_wait_s=None):
+        self.max_running = max_running or _env_int("NORMGRAPH_MAX_RUNS", 16)
+        self.max_queue = max_queue if max_queue is not None else _env_int("NORMGRAPH_MAX_QUEUE", 100)
+        self.tenant_limit = tenant_limit or _env_int("NORMGRAPH_TENANT_LIMIT", 4)
+        self.max_wait_s = max_wait_s if max_wait_s is not None else max_queue_wait_s()
+        self.running = 0
+        self.shed = 0
+        self._tenants = {}
+        self._waiting = []
+        self._sequence = itertools.count()
+        _schedulers.add(self)
+
+    def _can_run(self, tenant):
+        return self.running < self.max_running and self._tenants.get(tenant, 0) < self.tenant_limit
+
+    def _start(self, tenant):
+        self.running += 1
+        self._tenants[tenant] = self._tenants.get(tenant, 0) + 1
+
+    def _dispatch(self):
+        # starts the waiting runs in priority order, runs of tenants at their limit are skipped
+        for entry in sorted(self._waiting):
+            if self.running >= self.max_running:
+                break
+            _, _, tenant, future = entry
+            if future.done() or not self._can_run(tenant):
+                continue
+            self._waiting.remove(entry)
+            self._start(tenant)
+            future.set_result(None)
+        heapq.heapify(self._waiting)
+
+    def _release(self, tenant):
+        self.running -= 1
+        self._tenants[tenant] -= 1
+        if not self._tenants[tenant]:
+            del self._tenants[tenant]
+        self._dispatch()
+
+    def _retry_after(self):
+        return max(1.0, len(self._waiting) / max(self.max_running, 1))
+
+    @asynccontextmanager
+    async def admit(self, tenant="default", priority="interactive"):
+        """
+        Admits a graph run for the duration of the block.
+
+        Raises:
+        Overloaded: If the queue is full or the run waited longer than `max_wait_s`.
+        """
+        with span("admission.queue", tenant=tenant, priority=priority) as queue_span:
+            if not self._waiting and self._can_run(tenant):
+                self._start(tenant)
+            else:
+                if len(self._waiting) >= self.max_queue:
+                    self.shed += 1
+                    queue_span.set("shed", "queue_full")
+                    raise Overloaded("queue full", self._retry_after())
+                future = asyncio.get_running_loop().create_future()
+                entry = (PRIORITIES.get(priority, 0), next(self._sequence), tenant, future)
+                heapq.heappush(self._waiting, entry)
+                # the waiting runs ahead of this one may all belong to tenants at their limit, a free slot is used right away
+                self._dispatch()
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), self.max_wait_s)
+                except asyncio.TimeoutError:
+                    if not future.done():
+                        self._waiting.remove(entry)
+                        heapq.heapify(self._waiting)
+                        future.cancel()
+                        self.shed += 1
+                        queue_span.set("shed", "queue_timeout")
+                        raise Overloaded("queue wait", self._retry_after())
+                except asyncio.CancelledError:
+                    if future.done() and not future.cancelled():
+                        self._release(tenant)
+                    elif entry in self._waiting:
+                        self._waiting.remove(entry)
+                        heapq.heapify(self._waiting)
+                    raise
+        try:
+            yield
+        finally:
+            self._release(tenant)
+
+    def stats(self):
+        return {"running": self.running, "queued": len(self._waiting), "shed": self.shed}
+
+
+def queue_depths():
+    """Returns the queue depths {'runs': queued graph runs of all schedulers, <dependency>: calls waiting for a slot of the dependency}."""
+    depths = {"runs": sum(scheduler.stats()["queued"] for scheduler in list(_schedulers))}
+    with _gates_lock:
+        gates = dict(_gates)
+    depths.update({kind: gate.waiting() for kind, gate in gates.items() if gate is not None})
+    return depths
@@ -0,0 +1,119 @@
+"""
+This module provides a small thread-safe cache shared by the retrieval functions.
+
+`get_or_compute` is single-flight: if several threads request the same missing key at once, only the first computes the value and the others wait for its result. This de-duplicates identical retrievals of concurrently processed questions. A waiting request waits at most for the remaining budget of its own request deadline (see deadline.py), even if the computing request has a longer budget. The deadline of the computing request doesn't pass to the waiting requests: if its computation exceeded its deadline or returned a degraded value (not cacheable), a waiting request with budget left computes the value itself, a waiting request without budget left takes the degraded value and records its degradations.
+
+Modules and Classes:
+- TTLCache: LRU cache with a maximum size and a time-to-live per entry, counting hits and misses.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from base_agent.utils.deadline import DeadlineExceeded, degrade, remaining_budget, track_degradation
+
+_MISSING = object()
+
+
+class _Flight:
+    """A computation in progress, awaited by concurrent requests of the same key."""
+
+    __slots__ = ("done", "value", "error", "cached", "degradations")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.cached = False
+        self.degradations = []
+
+
+class TTLCache:
+    """LRU cache whose entries expire after `ttl` seconds. Cached values are shared and must not be mutated by callers."""
+
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl if ttl is not None else float(os.environ.get("NORMGRAPH_CACHE_TTL_S", "300"))
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and time.monotonic() - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not _MISSING:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute, cacheable=None):
+        """
+        Returns the cached value of `key` or computes it once for all concurrent requests. If `cacheable(value)` is false, the value is not stored and the waiting requests with budget left compute it again.
+
+        Raises:
+        DeadlineExceeded: If the value computed by another request is not ready within the remaining budget of the waiting request.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            remaining = remaining_budget()
+            if not flight.done.wait(None if remaining is None else max(remaining, 0.0)):
+                raise DeadlineExceeded("waiting for a concurrent computation exceeded the request deadline")
+            remaining = remaining_budget()
+            if (flight.error is None and not flight.cached) or isinstance(flight.error, DeadlineExceeded):
+                if remaining is None or remaining > 0:
+                    # the computation ran into the deadline of the computing request, not of this one
+                    return self.get_or_compute(key, compute, cacheable)
+            if flight.error is not None:
+                raise flight.error
+            for reason in flight.degradations:
+                degrade(reason)
+            with self._lock:
+                self.deduplicated += 1
+            return flight.value
+
+        try:
+            with track_degradation() as recorded:
+                flight.value = compute()
+            flight.degradations = recorded
+            if cacheable is None or cacheable(flight.value):
+                self.put(key, flight.value)
+                flight.cached = True
+            return flight.value
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return self.hits, self.misses
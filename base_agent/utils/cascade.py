@@ -0,0 +1,83 @@
+"""
+This module provides the model cascade of the expert nodes: a step is first answered by the small model (`gpt-4o-mini`) and only escalated to `gpt-4o` if needed.
+
+A step is escalated, if
+- the small model reports a confidence below `min_confidence` (self-reported confidence field of the structured output, LLMHandler)
+- the structured output of the small model fails to parse or validate (all nodes)
+- a rule sends the step directly to the large model: the step has at least `max_dependencies` dependencies, or its input matches one of the regular expressions in `direct_patterns`
+
+The cascade of each node is configured by `DEFAULT_CASCADES`, overridable per deployment with the environment variable NORMGRAPH_CASCADE (json, e.g. '{"LLMHandler": {"min_confidence": 0.8}}') and per invocation with `config["configurable"]["cascade"]` (same format). A node configured with a single model (e.g. {"models": ["base"]}) disables its cascade.
+
+Every attempt is recorded as a span 'cascade.attempt' (node, model, accepted, reason), so the escalation rate and the latency of each model are available in the traces, the metrics and the benchmark runner.
+
+Functions:
+- cascade_settings: Function returning the cascade configuration of a node.
+- direct_to_large_model: Function applying the step-type rules.
+- run_cascade: Function running the attempts of a node until one is accepted.
+"""
+
+import json
+import os
+import re
+
+from langchain_core.exceptions import OutputParserException
+from pydantic import ValidationError
+
+from base_agent.utils.tracing import span
+
+DEFAULT_CASCADES = {
+    "LLMHandler": {"models": ["mini", "base"], "min_confidence": 0.7, "max_dependencies": 3, "direct_patterns": []},
+    "CalculationHandler": {"models": ["mini", "base"]},
+    "OutputHandler": {"models": ["mini", "base"]},
+}
+
+
+class Escalate(Exception):
+    """Raised by an attempt to reject the answer of a model, the reason is recorded on the attempt span."""
+
+
+# errors of an attempt that escalate to the next model. Timeouts, connection and rate limit errors are raised:
+# the larger model would run past the request deadline or around the load shedding of admission.py
+ESCALATING_ERRORS = (Escalate, ValidationError, OutputParserException)
+
+
+def cascade_settings(node, config=None):
+    settings = dict(DEFAULT_CASCADES.get(node, {"models": ["base"]}))
+    if os.environ.get("NORMGRAPH_CASCADE"):
+        settings.update(json.loads(os.environ["NORMGRAPH_CASCADE"]).get(node, {}))
+    settings.update((((config or {}).get("configurable") or {}).get("cascade") or {}).get(node, {}))
+    return settings
+
+
+def direct_to_large_model(settings, step):
+    """Step-type rules: returns True if the step should skip the small model."""
+    max_dependencies = settings.get("max_dependencies")
+    if max_dependencies is not None and len(step.dependencies) >= max_dependencies:
+        return True
+    return any(re.search(pattern, step.step_input, re.IGNORECASE) for pattern in settings.get("direct_patterns", []))
+
+
+def run_cascade(node, settings, attempt, skip_small=False):
+    """
+    Runs `attempt(model_name, is_last)` for the models of the cascade until an attempt is accepted. An attempt rejects its answer by raising `Escalate` or fails with a validation or parsing error, the last model's answer is always returned (its errors are raised). Other errors (timeouts, rate limits) are raised by every attempt.
+
+    Returns:
+    The result of the accepted attempt.
+    """
+    models = settings.get("models", ["base"])
+    if skip_small:
+        models = models[-1:]
+    for position, model_name in enumerate(models):
+        is_last = position == len(models) - 1
+        with span("cascade.attempt", node=node, model=model_name, position=position) as attempt_span:
+            try:
+                result = attempt(model_name, is_last)
+            except ESCALATING_ERRORS as error:
+                if is_last:
+                    raise
+                attempt_span.set("accepted", False)
+                attempt_span.set("reason", str(error) if isinstance(error, Escalate) else f"invalid output: {type(error).__name__}")
+                continue
+            attempt_span.set("accepted", True)
+            attempt_span.set("reason", "direct" if skip_small and len(settings.get("models", [])) > 1 else "")
+            return result
@@ -0,0 +1,226 @@
+"""
+This module provides the compaction of the step results of the expert plan.
+
+A `DataBase[...]` step stores the full rendered context of its retrieval as step result. The result is spliced into the inputs of dependent steps (`add_dependencies`) and concatenated next to the shared context of the initial retrieval in the prompt of the `OutputHandler`, so the same standards text can appear two or three times in the final prompt. With the compaction, a step result only keeps the passages relevant to the question of the step:
+- the chunks of the retrieved sections and of the sections they reference are scored against the step input: BM25 over the chunks (German stemming, see lexical.py), optionally fused with the similarity of the stored chunk embeddings to the query embedding ('hybrid')
+- the best chunks are kept up to a token budget and rendered in document order below their section heading, each with its chunk id for citations
+- chunks already contained in the shared context or in an earlier step result are not repeated, only cited by their chunk id
+Results below the token budget are kept unchanged. The token reduction is recorded per step ('compaction.step') and per plan ('compaction.plan', see `report_plan`).
+
+Configuration per deployment through environment variables, overridable per invocation through `config["configurable"]`:
+- NORMGRAPH_STEP_COMPACTION / 'step_compaction': '1' enables the compaction (default: disabled)
+- NORMGRAPH_STEP_RESULT_TOKENS / 'step_result_tokens': token budget of a compacted step result (default: 800)
+- NORMGRAPH_COMPACTION_SCORER / 'compaction_scorer': 'lexical' (default) or 'hybrid'
+
+Modules and Classes:
+- Passage: Class holding a chunk of a retrieved section.
+
+Functions:
+- compaction_settings: Function returning whether the compaction is enabled, the token budget and the scorer.
+- section_passages: Function returning the passages of sections in document order.
+- rank_passages: Function ranking passages by their relevance to a query.
+- compact_step_result: Function compacting the result of a database step.
+- report_plan: Function recording the token reduction of the step results of a plan.
+"""
+
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from base_agent.utils import tools
+from base_agent.utils.cache import TTLCache
+from base_agent.utils.deadline import DeadlineExceeded, budget_low, degrade, low_budget_s
+from base_agent.utils.embedders import embedding_label
+from base_agent.utils.lexical import BM25Index
+from base_agent.utils.sections import Chunk, load_sections
+from base_agent.utils.tracing import span
+
+# formatted with the label of the embedding nodes of the model (see embedders.py)
+CHUNK_EMBEDDINGS_CYPHER = """
+MATCH (chunk)-[:HAS_EMBEDDING]->(embedding:{label})
+WHERE chunk.id IN $ids AND embedding.model = $model
+RETURN chunk.id AS id, embedding.value AS value
+"""
+
+Passage = namedtuple("Passage", ["chunk_id", "section_id", "heading", "text"])
+
+# sections only change at ingestion time, their passages are reused like the section trees
+passage_cache = TTLCache(maxsize=256)
+
+
+def compaction_settings(config=None):
+    """Returns (enabled, token budget, scorer) from the invocation config or the environment."""
+    configurable = (config or {}).get("configurable") or {}
+    enabled = configurable.get("step_compaction", os.environ.get("NORMGRAPH_STEP_COMPACTION", ""))
+    if isinstance(enabled, str):
+        enabled = enabled.lower() in ("1", "true", "yes")
+    budget = int(configurable.get("step_result_tokens", os.environ.get("NORMGRAPH_STEP_RESULT_TOKENS", "800")))
+    scorer = configurable.get("compaction_scorer", os.environ.get("NORMGRAPH_COMPACTION_SCORER", "lexical"))
+    return bool(enabled), budget, scorer
+
+
+#----------------- Passages -----------------#
+def _collect(section, heading, passages, seen):
+    for element in section.elements:
+        if isinstance(element, Chunk):
+            if element.content and element.id not in seen:
+                seen.add(element.id)
+                passages.append(Passage(element.id, section.id, heading, element.content))
+            for ref in element.references:
+                _collect(ref, f"Referenziert: {ref.num} {ref.title}".strip(), passages, seen)
+        else:
+            _collect(element, f"{element.num} {element.title}".strip(), passages, seen)
+
+
+def section_passages(section_ids, driver):
+    """
+    Returns the passages (chunks) of the sections in the given order, each section followed by the chunks of the sections it references.
+    """
+    def compute():
+        sections = load_sections(driver, section_ids)
+        passages, seen = [], set()
+        for section_id in section_ids:
+            section = sections.get(section_id)
+            if section is not None:
+                _collect(section, f"{section.num} {section.title}".strip(), passages, seen)
+        return passages
+
+    return passage_cache.get_or_compute(tuple(section_ids), compute)
+
+
+def _vector_ranking(query, passages, driver, client):
+    records, _, _ = driver.execute_query(CHUNK_EMBEDDINGS_CYPHER.format(label=embedding_label(tools.EMBEDDING_MODEL)), ids=[passage.chunk_id for passage in passages], model=tools.EMBEDDING_MODEL)
+    if not records:
+        return []
+    ids = [record["id"] for record in records]
+    matrix = np.asarray([record["value"] for record in records], dtype=np.float32)
+    # the query embedding was computed by the retrieval of the step, it is served from the embedding cache
+    query_vector = np.asarray(tools.get_embedding(client, query, tools.EMBEDDING_MODEL), dtype=np.float32)
+    scores = matrix @ query_vector / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vector) + 1e-12)
+    return [ids[index] for index in np.argsort(-scores)]
+
+
+def rank_passages(query, passages, scorer="lexical", driver=None, client=None):
+    """
+    Ranks passages by their relevance to a query.
+
+    Args:
+    query (str): The question of the step.
+    passages (list): The candidate passages.
+    scorer (str): 'lexical' (BM25 over the chunks) or 'hybrid' (BM25 and embedding similarity, fused with the reciprocal rank fusion).
+
+    Returns:
+    list: The chunk ids of the relevant passages, best first. Passages without any query term are missing in the lexical ranking.
+    """
+    if not passages:
+        return []
+    # the heading is indexed once with the chunk, so chunks of a matching section rank above unrelated chunks
+    index = BM25Index([(passage.chunk_id, passage.heading, [passage.text]) for passage in passages], title_weight=1)
+    lexical = index.search(query, limit=len(passages))
+    if scorer != "hybrid" or budget_low(low_budget_s()):
+        return lexical
+    rankings = {"lexical": lexical, "vector": _vector_ranking(query, passages, driver, client)}
+    return list(tools.apply_reciprocal_rank_fusion(tools.gather_unique_values(rankings), list(rankings.keys()), rankings).keys())
+
+
+#----------------- Compaction -----------------#
+def _normalize(text):
+    return " ".join(text.split())
+
+
+def _render(passages, cited):
+    parts = []
+    heading = None
+    for passage in passages:
+        if passage.heading != heading:
+            heading = passage.heading
+            parts.append(f"{heading}\n")
+        parts.append(f"[{passage.chunk_id}] {passage.text.strip()}\n\n")
+    if cited:
+        parts.append("Bereits im Kontext: " + ", ".join(f"[{chunk_id}]" for chunk_id in cited) + "\n")
+    return "".join(parts)
+
+
+def compact_step_result(query, result, context, previous_results, k, config=None):
+    """
+    Compacts the result of a database step to the passages relevant to its question.
+
+    Args:
+    query (str): The input of the step (with the results of its dependencies).
+    result (str): The rendered context retrieved for the step.
+    context (str): The shared context of the initial retrieval, part of the prompts of the LLM and output steps.
+    previous_results (list): The results of the earlier steps (StepResult).
+    k (int): The number of vector results of the retrieval of the step.
+
+    Returns:
+    tuple: (compacted result, tokens of the full result), the full result if the compaction doesn't reduce it or exceeds the request deadline and (result, None) if the compaction is disabled.
+    """
+    enabled, budget, scorer = compaction_settings(config)
+    if not enabled:
+        return result, None
+    full_tokens = tools.count_tokens(result)
+    if full_tokens <= budget or budget_low(low_budget_s()):
+        return result, full_tokens
+
+    with span("compaction.step", scorer=scorer, full_tokens=full_tokens) as step_span:
+        # the ranking of the retrieval is cached, the sections are the ones rendered into `result`
+        try:
+            passages = section_passages(tools.ranked_section_ids(query, k), tools.driver)
+            ranked = rank_passages(query, passages, scorer, tools.driver, tools.vo)
+        except DeadlineExceeded:
+            # the full result is kept
+            degrade("compaction")
+            return result, full_tokens
+        if not ranked:
+            # no passage shares a term with the question, the beginning of the sections is kept
+            ranked = [passage.chunk_id for passage in passages]
+
+        seen_in = [_normalize(context or "")] + [_normalize(previous.result if isinstance(previous, tools.StepResult) else previous["result"]) for previous in previous_results]
+        by_id = {passage.chunk_id: passage for passage in passages}
+        kept, cited, tokens = set(), [], 0
+        for chunk_id in ranked:
+            passage = by_id[chunk_id]
+            text = _normalize(passage.text)
+            if any(text in source or f"[{chunk_id}]" in source for source in seen_in):
+                cited.append(chunk_id)
+                continue
+            passage_tokens = tools.count_tokens(passage.text)
+            if kept and tokens + passage_tokens > budget:
+                continue
+            kept.add(chunk_id)
+            tokens += passage_tokens
+
+        compacted = _render([passage for passage in passages if passage.chunk_id in kept], cited)
+        if tools.count_tokens(compacted) >= full_tokens:
+            compacted = result
+        step_span.set("passages", len(passages))
+        step_span.set("kept", len(kept))
+        step_span.set("cited", len(cited))
+        step_span.set("compacted_tokens", tools.count_tokens(compacted))
+    return compacted, full_tokens
+
+
+def report_plan(plan, step_results):
+    """
+    Records the token reduction of the step results of a plan that passed the compaction (span 'compaction.plan').
+
+    Returns:
+    tuple: (tokens of the full results, tokens of the compacted results) of these steps.
+    """
+    step_numbers = {step.step_number for step in plan.steps}
+    # the step results of earlier plans of the thread are kept in the state, the latest result of each step counts
+    latest = {}
+    for result in step_results:
+        if isinstance(result, dict):
+            result = tools.StepResult(**result)
+        if result.step_number in step_numbers:
+            latest[result.step_number] = result
+    compacted = [result for result in latest.values() if result.full_tokens is not None]
+    full_tokens = sum(result.full_tokens for result in compacted)
+    compacted_tokens = sum(tools.count_tokens(result.result) for result in compacted)
+    if compacted:
+        with span("compaction.plan", steps=len(compacted), full_tokens=full_tokens, compacted_tokens=compacted_tokens,
+                  reduction=round(1 - compacted_tokens / full_tokens, 4) if full_tokens else 0.0):
+            pass
+    return full_tokens, compacted_tokens
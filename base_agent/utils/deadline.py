@@ -0,0 +1,291 @@
+"""
+This module provides request deadlines, per-dependency timeouts and hedged calls for the external dependencies of the application.
+
+A request gets a latency budget through its graph config: `config["configurable"]["deadline"]` holds the absolute deadline (unix time, set with `with_budget`). Every graph node activates the deadline of its config (see `traced_node` in tracing.py), so it flows through a context variable into the tools, the retrieval functions and the background threads started by them.
+
+Calls of the dependencies are bounded by the smaller of their dependency timeout and the remaining budget and raise `DeadlineExceeded` (a `TimeoutError`) when it is exceeded. The blocking call itself cannot be interrupted, it finishes in the background and its result is discarded. Idempotent calls (query embeddings, the read-only retrieval queries) are hedged: if a call has not finished after the p95 latency of its dependency (measured over the recent calls), a duplicate request is sent and the first response is used.
+
+When the remaining budget runs low, the application degrades instead of failing:
+- the retrieval legs that run into the deadline are dropped from the rank fusion
+- the sections that cannot be fetched in time are left out of the context, a database step without any result states the missing result
+- the references of retrieved sections are not expanded (below NORMGRAPH_LOW_BUDGET_S)
+- the remaining plan steps are skipped and the answer is generated from the results so far (below NORMGRAPH_OUTPUT_RESERVE_S)
+
+Configuration through environment variables:
+- NORMGRAPH_TIMEOUTS: timeouts per dependency in seconds (default: 'neo4j=10,embedding=10,llm=60,assistant=120')
+- NORMGRAPH_HEDGE: dependencies with hedged calls (default: 'embedding,neo4j', '' disables hedging)
+- NORMGRAPH_HEDGE_QUANTILE: latency quantile after which a hedged request is sent (default: 95)
+- NORMGRAPH_LOW_BUDGET_S: remaining budget below which references are not expanded (default: 5)
+- NORMGRAPH_OUTPUT_RESERVE_S: remaining budget reserved for the final answer (default: 15)
+
+`helper_notebooks_benchmark/deadline_eval.py` measures the timeouts and hedging against local fake services with configurable slow tails.
+
+Modules and Classes:
+- DeadlineExceeded: Raised when a call exceeds its timeout or the request deadline.
+- LatencyTracker: Class tracking the recent latencies of a dependency.
+- DeadlineProxy: Wrapper bounding the calls of a client (neo4j driver, embedding client).
+
+Functions:
+- with_budget: Function returning a graph config with a request deadline.
+- deadline_scope: Context manager activating the deadline of a graph config.
+- unbounded: Context manager disabling the timeouts (e.g. for loading local indexes).
+- remaining_budget: Function returning the remaining budget of the current request.
+- budget_low: Function returning whether the remaining budget is below a reserve.
+- call_with_deadline: Function running a call with timeout and optional hedging.
+- track_degradation: Context manager collecting the degradations of a computation (degraded results are not cached).
+- degrade: Function recording a degradation.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import lru_cache
+
+from base_agent.utils.tracing import current_span, span
+
+DEFAULT_TIMEOUTS = {"neo4j": 10.0, "embedding": 10.0, "llm": 60.0, "assistant": 120.0}
+MIN_HEDGE_SAMPLES = 20      # calls of a dependency before its quantile is trusted for hedging
+
+# absolute deadline of the current request (time.monotonic), None without a budget
+_deadline = contextvars.ContextVar("normgraph_deadline", default=None)
+_unbounded = contextvars.ContextVar("normgraph_unbounded", default=False)
+# degradations of the current computation, see track_degradation
+_degradations = contextvars.ContextVar("normgraph_degradations", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a call exceeds its dependency timeout or the request deadline."""
+
+
+#----------------- Configuration -----------------#
+def _parse_timeouts(value):
+    # 'neo4j=10,embedding=5' -> {'neo4j': 10.0, 'embedding': 5.0}
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        kind, seconds = part.split("=", 1)
+        timeouts[kind.strip()] = float(seconds)
+    return timeouts
+
+
+def dependency_timeout(kind):
+    return _parse_timeouts(os.environ.get("NORMGRAPH_TIMEOUTS", "")).get(kind)
+
+
+def hedged_kinds():
+    return {kind.strip() for kind in os.environ.get("NORMGRAPH_HEDGE", "embedding,neo4j").split(",") if kind.strip()}
+
+
+#----------------- Request deadline -----------------#
+def with_budget(config, budget_s):
+    """Returns a copy of the graph config with a request deadline `budget_s` seconds from now."""
+    config = dict(config or {})
+    config["configurable"] = dict(config.get("configurable") or {}, deadline=time.time() + budget_s)
+    return config
+
+
+@contextmanager
+def deadline_scope(config):
+    """Activates the deadline of a graph config (if any) for the current context."""
+    deadline = ((config or {}).get("configurable") or {}).get("deadline")
+    if deadline is None:
+        yield
+        return
+    token = _deadline.set(time.monotonic() + (deadline - time.time()))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def unbounded():
+    """Disables the request deadline and the dependency timeouts for the current context, e.g. for loading the local indexes."""
+    token = _unbounded.set(True)
+    deadline_token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(deadline_token)
+        _unbounded.reset(token)
+
+
+def remaining_budget(config=None):
+    """Returns the remaining budget in seconds of the given config or the current context, None without a deadline."""
+    if config is not None:
+        deadline = ((config or {}).get("configurable") or {}).get("deadline")
+        return None if deadline is None else deadline - time.time()
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def budget_low(reserve_s, config=None):
+    remaining = remaining_budget(config)
+    return remaining is not None and remaining < reserve_s
+
+
+def low_budget_s():
+    return float(os.environ.get("NORMGRAPH_LOW_BUDGET_S", "5"))
+
+
+def output_reserve_s():
+    return float(os.environ.get("NORMGRAPH_OUTPUT_RESERVE_S", "15"))
+
+
+def call_timeout(kind):
+    """Returns the timeout of a call: the smaller of the dependency timeout and the remaining budget (None if unbounded)."""
+    if _unbounded.get():
+        return None
+    timeout = dependency_timeout(kind)
+    remaining = remaining_budget()
+    if remaining is not None:
+        if remaining <= 0:
+            raise DeadlineExceeded(f"request deadline exceeded before the {kind} call")
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    return timeout
+
+
+@contextmanager
+def track_degradation():
+    """
+    Collects the degradations recorded with `degrade` inside the block (also in the threads started with a copied context) in the yielded list.
+    Degradations of a nested block are also collected by the enclosing block.
+    """
+    degradations = []
+    token = _degradations.set(degradations)
+    try:
+        yield degradations
+    finally:
+        _degradations.reset(token)
+        enclosing = _degradations.get()
+        if enclosing is not None:
+            enclosing.extend(degradations)
+
+
+def degrade(reason):
+    """Records that a result was degraded to meet the deadline (e.g. 'lexical', 'vector', 'references', 'plan')."""
+    degradations = _degradations.get()
+    if degradations is not None:
+        degradations.append(reason)
+    with span("deadline.degraded", reason=reason):
+        pass
+
+
+#----------------- Latency tracking -----------------#
+class LatencyTracker:
+    """Recent latencies of a dependency, used to delay hedged requests until the configured quantile."""
+
+    def __init__(self, size=200):
+        self._latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def quantile(self, q):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))]
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def latency_tracker(kind):
+    with _trackers_lock:
+        tracker = _trackers.get(kind)
+        if tracker is None:
+            tracker = _trackers[kind] = LatencyTracker()
+        return tracker
+
+
+@lru_cache(maxsize=1)
+def _executor():
+    return ThreadPoolExecutor(max_workers=int(os.environ.get("NORMGRAPH_DEADLINE_WORKERS", "32")), thread_name_prefix="deadline")
+
+
+#----------------- Bounded calls -----------------#
+def call_with_deadline(kind, func, *args, hedge=False, **kwargs):
+    """
+    Runs `func(*args, **kwargs)` bounded by the timeout of its dependency and the request deadline.
+
+    Args:
+    kind (str): The dependency ('neo4j', 'embedding', 'llm', 'assistant').
+    func (callable): The blocking call.
+    hedge (bool): Whether the call is idempotent and may be hedged with a duplicate request after the p95 latency.
+
+    Returns:
+    The result of the first finished request.
+
+    Raises:
+    DeadlineExceeded: If no request finished within the timeout.
+    """
+    timeout = call_timeout(kind)
+    tracker = latency_tracker(kind)
+    hedge_delay = tracker.quantile(float(os.environ.get("NORMGRAPH_HEDGE_QUANTILE", "95"))) if hedge and kind in hedged_kinds() else None
+    if timeout is None and hedge_delay is None:
+        return func(*args, **kwargs)
+
+    start = time.monotonic()
+    # the context is copied, so the spans of the call are children of the current span
+    futures = [_executor().submit(contextvars.copy_context().run, func, *args, **kwargs)]
+    active_span = current_span()
+    try:
+        if hedge_delay is not None and (timeout is None or hedge_delay < timeout):
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                futures.append(_executor().submit(contextvars.copy_context().run, func, *args, **kwargs))
+                if active_span is not None:
+                    active_span.set("hedged", True)
+
+        pending = list(futures)
+        while pending:
+            left = None if timeout is None else timeout - (time.monotonic() - start)
+            if left is not None and left <= 0:
+                break
+            done, pending = wait(pending, timeout=left, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    # a failed request only counts if no other request is still running
+                    if active_span is not None and len(futures) > 1:
+                        active_span.set("hedge_won", future is futures[1])
+                    result = future.result()
+                    tracker.observe(time.monotonic() - start)
+                    return result
+        # timed out calls count with their timeout, so the hedging quantile follows a slow tail
+        tracker.observe(time.monotonic() - start)
+        if active_span is not None:
+            active_span.set("deadline_exceeded", True)
+        raise DeadlineExceeded(f"{kind} call exceeded its timeout of {timeout:.2f}s")
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+class DeadlineProxy:
+    """
+    Wrapper bounding the given methods of a client with `call_with_deadline` (e.g. `execute_query` of the neo4j driver, `embed` of the embedding client). Other attributes are passed through.
+    Only wrap clients whose wrapped methods are idempotent when `hedge` is set.
+    """
+
+    def __init__(self, client, kind, methods, hedge=False):
+        self._client = client
+        self._kind = kind
+        self._methods = set(methods)
+        self._hedge = hedge
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name not in self._methods:
+            return attribute
+
+        def bounded(*args, **kwargs):
+            return call_with_deadline(self._kind, attribute, *args, hedge=self._hedge, **kwargs)
+        return bounded
@@ -0,0 +1,245 @@
+"""
+This module provides the embedding backends of the query and chunk embeddings.
+
+By default the embeddings are computed by VoyageAI (`voyage-multilingual-2`, 1024 dimensions), a network call in every retrieval without a cache hit. The local backend computes them on the CPU with a multilingual sentence-transformers model (optionally run with ONNX Runtime), batched and spread over a thread pool, and needs no credentials or network access once the model is downloaded. Both backends share the interface of the VoyageAI client (`embed(texts, model, input_type)` returning `.embeddings`), so `get_embedding`, `embed_queries`, the deadline, admission and replay wrappers and the ingestion (see `voyage_embed.ipynb`) work with either backend.
+
+The embeddings of every model are stored on their own nodes (property `model`) with a label of the model ('Embedding' for VoyageAI, e.g. 'Embedding_intfloat_multilingual_e5_small' otherwise) and have their own vector index over this label ('content-embeddings-vo' for VoyageAI), so the indexes of different models never share vectors. Switching a deployment to another backend:
+1. `reembed(driver, client, model)` embeds all chunks without an embedding of the model (resumable) and creates the vector index of the model
+2. NORMGRAPH_EMBEDDER=local switches the queries and the local vector mirror over to the new index. The VoyageAI embeddings are kept for a rollback, `drop_embeddings` removes them.
+`helper_notebooks_benchmark/embedding_eval.py` compares the query latency and the retrieval quality of the backends.
+
+Configuration through environment variables:
+- NORMGRAPH_EMBEDDER: 'voyage' (default) or 'local'
+- NORMGRAPH_LOCAL_EMBEDDING_MODEL: sentence-transformers model of the local backend (default: 'intfloat/multilingual-e5-small')
+- NORMGRAPH_LOCAL_EMBEDDING_RUNTIME: 'torch' (default) or 'onnx' (requires `sentence-transformers[onnx]`)
+- NORMGRAPH_LOCAL_EMBEDDING_THREADS: threads encoding batches in parallel (default: 4)
+- NORMGRAPH_LOCAL_EMBEDDING_BATCH: texts per batch (default: 32)
+
+Modules and Classes:
+- LocalEmbeddingClient: Class computing embeddings with a local sentence-transformers model.
+
+Functions:
+- embedding_backend: Function returning the configured backend.
+- embedding_model: Function returning the embedding model of a backend.
+- vector_index_name: Function returning the name of the vector index of a model.
+- embedding_label: Function returning the label of the embedding nodes of a model.
+- create_embedding_client: Function creating the client of a backend.
+- embed_documents: Function embedding chunk contents in batches (ingestion).
+- store_embeddings: Function creating the embedding nodes of chunks (ingestion).
+- create_vector_index: Function creating the vector index of a model.
+- reembed: Function embedding all chunks with a model and creating its vector index (migration).
+- drop_embeddings: Function removing the embeddings and the vector index of a model.
+"""
+
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from base_agent.utils.tracing import span
+
+VOYAGE_MODEL = 'voyage-multilingual-2'
+VOYAGE_INDEX = 'content-embeddings-vo'
+VOYAGE_DIMENSIONS = 1024
+DEFAULT_LOCAL_MODEL = 'intfloat/multilingual-e5-small'
+DOCUMENT_BATCH_SIZE = 128
+
+# instruction prefixes of model families trained with them, matched against the model name
+_PREFIXES = {
+    "e5": {"query": "query: ", "document": "passage: "},
+}
+
+# the queries of the embedding nodes are formatted with the label of the model, see `embedding_label`
+MISSING_EMBEDDINGS_CYPHER = """
+MATCH (chunk:Chunk)
+WHERE chunk.content IS NOT NULL AND NOT EXISTS {{ (chunk)-[:HAS_EMBEDDING]->(:{label} {{model: $model}}) }}
+RETURN chunk.id AS id, chunk.content AS text
+LIMIT $limit
+"""
+
+DROP_EMBEDDINGS_CYPHER = """
+MATCH (e:{label} {{model: $model}})
+WITH e LIMIT $limit
+DETACH DELETE e
+RETURN count(*) AS deleted
+"""
+
+
+def embedding_backend():
+    backend = os.environ.get("NORMGRAPH_EMBEDDER", "voyage").strip().lower() or "voyage"
+    if backend not in ("voyage", "local"):
+        raise ValueError(f"Unknown embedding backend '{backend}', expected 'voyage' or 'local'")
+    return backend
+
+
+def embedding_model(backend=None):
+    """Returns the embedding model of the backend (default: the configured backend)."""
+    if (backend or embedding_backend()) == "voyage":
+        return VOYAGE_MODEL
+    return os.environ.get("NORMGRAPH_LOCAL_EMBEDDING_MODEL", DEFAULT_LOCAL_MODEL)
+
+
+def _slug(model):
+    # 'intfloat/multilingual-e5-small' -> 'intfloat-multilingual-e5-small'
+    return re.sub(r"[^a-z0-9]+", "-", model.lower()).strip("-")
+
+
+def vector_index_name(model):
+    """Name of the vector index over the embeddings of `model`, 'content-embeddings-vo' for VoyageAI."""
+    return VOYAGE_INDEX if model == VOYAGE_MODEL else f"content-embeddings-{_slug(model)}"
+
+
+def embedding_label(model):
+    """
+    Label of the embedding nodes of `model`. A vector index covers every node of its label, so the nodes of other models must not carry the label 'Embedding' of the VoyageAI index (and of the partition indexes, see partitions.py).
+    """
+    return "Embedding" if model == VOYAGE_MODEL else "Embedding_" + _slug(model).replace("-", "_")
+
+
+#----------------- Local backend -----------------#
+class LocalEmbeddingClient:
+    """
+    Embedding client with the interface of the VoyageAI client, computing normalized embeddings with a local sentence-transformers model on the CPU.
+    The model is loaded with the first call. Texts are encoded in batches of NORMGRAPH_LOCAL_EMBEDDING_BATCH, the batches of a large call are spread over a thread pool (the model releases the GIL while encoding), a single query is encoded in the calling thread.
+    """
+
+    def __init__(self, model=None, runtime=None, threads=None, batch_size=None):
+        self.model = model or os.environ.get("NORMGRAPH_LOCAL_EMBEDDING_MODEL", DEFAULT_LOCAL_MODEL)
+        self.runtime = runtime or os.environ.get("NORMGRAPH_LOCAL_EMBEDDING_RUNTIME", "torch")
+        self.threads = threads or int(os.environ.get("NORMGRAPH_LOCAL_EMBEDDING_THREADS", "4"))
+        self.batch_size = batch_size or int(os.environ.get("NORMGRAPH_LOCAL_EMBEDDING_BATCH", "32"))
+        self.prefixes = next((prefixes for family, prefixes in _PREFIXES.items() if family in self.model.lower()), {})
+        self._encoder = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def encoder(self):
+        if self._encoder is None:
+            with self._lock:
+                if self._encoder is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError as error:
+                        raise ImportError("The local embedding backend requires the optional package `sentence-transformers`") from error
+                    # the executor is created first, a thread seeing the model also sees the executor
+                    self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="embed")
+                    with span("local.embed.load", model=self.model, runtime=self.runtime):
+                        self._encoder = SentenceTransformer(self.model, device="cpu", backend="onnx" if self.runtime == "onnx" else "torch")
+        return self._encoder
+
+    @property
+    def dimensions(self):
+        return self.encoder.get_sentence_embedding_dimension()
+
+    def _encode(self, batch):
+        return self.encoder.encode(batch, batch_size=len(batch), normalize_embeddings=True, convert_to_numpy=True).tolist()
+
+    def embed(self, texts, model=None, input_type=None, **kwargs):
+        if model is not None and model != self.model:
+            raise ValueError(f"The local embedding client serves '{self.model}', not '{model}'")
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        prefix = self.prefixes.get(input_type or "document", "")
+        texts = [prefix + text for text in texts]
+        if len(texts) <= self.batch_size:
+            return SimpleNamespace(embeddings=self._encode(texts))
+        self.encoder    # loads the model and its executor
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        embeddings = []
+        for batch_embeddings in self._executor.map(self._encode, batches):
+            embeddings.extend(batch_embeddings)
+        return SimpleNamespace(embeddings=embeddings)
+
+
+def create_embedding_client(backend=None):
+    """Creates the client of the backend (default: the configured backend), the VoyageAI client reads VOYAGE_API_KEY."""
+    if (backend or embedding_backend()) == "voyage":
+        import voyageai
+        return voyageai.Client()
+    return LocalEmbeddingClient()
+
+
+#----------------- Ingestion and migration -----------------#
+def embed_documents(client, texts, model, batch_size=DOCUMENT_BATCH_SIZE):
+    """
+    Embeds chunk contents with one request per batch of `batch_size` texts.
+
+    Returns:
+    list: The embeddings in the order of the texts.
+    """
+    embeddings = []
+    for i in range(0, len(texts), batch_size):
+        batch = texts[i:i + batch_size]
+        with span(f"{'voyage' if model == VOYAGE_MODEL else 'local'}.embed", model=model, texts=len(batch), input_type="document"):
+            embeddings.extend(client.embed(batch, model=model, input_type="document").embeddings)
+    return embeddings
+
+
+def store_embeddings(driver, ids, embeddings, model, key="content"):
+    """Creates the `Embedding` nodes of the chunks `ids` (with the quantised codes of quantization.py)."""
+    # imported here, quantization.py depends on the configured model through vector_index.py
+    from base_agent.utils.quantization import to_storage
+    batch = [{"id": chunk_id, "key": key, "embedding": embedding, "model": model, "uuid": str(uuid.uuid4()), **to_storage(embedding)}
+             for chunk_id, embedding in zip(ids, embeddings)]
+    # labels cannot be parameters, the label is derived from the model name (only [A-Za-z0-9_])
+    driver.execute_query(f"""
+    UNWIND $batch AS item
+    MATCH (n) WHERE n.id = item.id
+    CREATE (e:{embedding_label(model)} {{key: item.key, value: item.embedding, model: item.model, id: item.uuid,
+                         value_int8: item.value_int8, int8_scale: item.int8_scale, value_bin: item.value_bin}})
+    CREATE (n)-[:HAS_EMBEDDING]->(e)
+    """, batch=batch)
+    return len(batch)
+
+
+def create_vector_index(driver, model, dimensions, wait_s=300):
+    """Creates the vector index over the embeddings of `model` (if missing) and waits until it is online."""
+    name = vector_index_name(model)
+    driver.execute_query(f"CREATE VECTOR INDEX `{name}` IF NOT EXISTS FOR (n:{embedding_label(model)}) ON (n.value) "
+                         f"OPTIONS {{indexConfig: {{`vector.dimensions`: {int(dimensions)}, `vector.similarity_function`: 'cosine'}}}}")
+    driver.execute_query("CALL db.awaitIndex($name, $timeout)", name=name, timeout=wait_s)
+    return name
+
+
+def reembed(driver, client, model, batch_size=DOCUMENT_BATCH_SIZE, dimensions=None):
+    """
+    Embeds the contents of all chunks without an embedding of `model` and creates the vector index of the model. Interrupted runs continue where they stopped.
+
+    Args:
+    driver: The neo4j driver.
+    client: The embedding client of the model (e.g. `create_embedding_client('local')`).
+    model (str): The embedding model.
+    dimensions (int): Dimensions of the embeddings, taken from the first embedding if not given.
+
+    Returns:
+    int: The number of embedded chunks.
+    """
+    count = 0
+    with span("embeddings.reembed", model=model) as reembed_span:
+        while True:
+            records, _, _ = driver.execute_query(MISSING_EMBEDDINGS_CYPHER.format(label=embedding_label(model)), model=model, limit=batch_size * 8)
+            if not records:
+                break
+            ids = [record["id"] for record in records]
+            embeddings = embed_documents(client, [record["text"] for record in records], model, batch_size)
+            dimensions = dimensions or len(embeddings[0])
+            count += store_embeddings(driver, ids, embeddings, model)
+        if dimensions is None:
+            dimensions = VOYAGE_DIMENSIONS if model == VOYAGE_MODEL else client.dimensions
+        reembed_span.set("chunks", count)
+        reembed_span.set("index", create_vector_index(driver, model, dimensions))
+    return count
+
+
+def drop_embeddings(driver, model, batch_size=10000):
+    """Removes the embeddings and the vector index of `model`, e.g. the VoyageAI embeddings after a switch to the local backend."""
+    deleted = 0
+    while True:
+        records, _, _ = driver.execute_query(DROP_EMBEDDINGS_CYPHER.format(label=embedding_label(model)), model=model, limit=batch_size)
+        if not records or not records[0]["deleted"]:
+            break
+        deleted += records[0]["deleted"]
+    driver.execute_query(f"DROP INDEX `{vector_index_name(model)}` IF EXISTS")
+    return deleted
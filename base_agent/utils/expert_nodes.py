@@ -1,54 +1,84 @@
 """
-This module defines various expert nodes and utility functions used in the agent's workflow. It includes functions to get language models, handle dependencies, call databases, create plans, route tasks, handle user queries, and perform calculations. The module also sets up a callback handler for logging and monitoring.
+This module defines various expert nodes and utility functions used in the agent's workflow. It includes functions to get language models, handle dependencies, call databases, create plans, route tasks, handle user queries, and perform calculations. The models are created with the callback handlers for tracing and monitoring (see tracing.py).
+
+With NORMGRAPH_BATCH_HUMAN_STEPS=1 (or `configurable.batch_human_steps`), the UserHandler asks all dependency-free Human steps of the plan together with the current one in a single interrupt, and the FeedbackHandler extracts the answers of all of them from the reply with one structured call.
 
 Modules and Classes:
 - ChatOpenAI: Class to interact with OpenAI's chat models.
 - SearchDataBase: Tool for searching a database.
 - ToolNode: Class to define a tool node.
 - AIMessage: Class for handling AI messages.
-- CallbackHandler: Class for handling callbacks.
-- Plan, StepResult, Calculation, Conclusion: Classes for handling different types of steps and results.
+- get_callbacks, span: Functions for tracing model calls and the calculator assistant.
+- Plan, StepResult, Calculation, Conclusion, ReasonedAnswer, ExtractedAnswers: Classes for handling different types of steps and results.
+- run_cascade: Function answering a step with the small model first and escalating to the large model if needed (see cascade.py).
+- budget_low, call_timeout: Functions of the request deadline (see deadline.py).
+- compact_step_result, report_plan: Functions compacting the results of database steps to their relevant passages (see compaction.py).
+- CalculationFailed: Exception raised when a run of the calculator assistant ends without a result.
 
 Functions:
 - _get_model: Function to get a language model based on the model name.
 - add_dependencies: Function to add dependencies to a step.
 - add_dependencies_to_string: Function to add dependencies to a string.
 - call_database: Function to call the database.
+- stream_plan: Function streaming the planner output and dispatching dependency-free database steps early.
 - create_plan: Function to create a plan.
 - task_router: Function to route tasks.
 - task_handler: Function to handle tasks.
 - database_handler: Function to handle database queries.
+- batch_human_steps: Function returning whether Human steps are asked together.
 - user_handler: Function to handle user queries.
 - human_feedback: Function to handle human feedback.
 - feedback_handler: Function to handle feedback.
+- extract_batch_feedback: Function extracting the answers of several Human steps from one reply.
+- run_calculator: Function to solve a problem with the calculator assistant.
 - calculation_handler: Function to handle calculations.
 - llm_handler: Function to handle LLM tasks.
 - output_handler: Function to handle output.
 """
 
+import os
+import time
 from functools import lru_cache
 from langchain_openai import ChatOpenAI
-from base_agent.utils.tools import Plan, StepResult, Calculation, Conclusion, SearchDataBase, parse_steps_fixed, sort_steps
+from base_agent.utils.replay import get_llm_cache, replayable
+from base_agent.utils.tracing import get_callbacks, span
+from base_agent.utils.tools import Plan, StepResult, Calculation, Conclusion, ReasonedAnswer, ExtractedAnswers, SearchDataBase, SEARCH_DATABASE_K, IncrementalPlanParser, retrieve_context, parse_steps_fixed, sort_steps
+from base_agent.utils.prefetch import run_in_background
+from base_agent.utils.filters import filter_for
+from base_agent.utils.cascade import Escalate, cascade_settings, direct_to_large_model, run_cascade
+from base_agent.utils.compaction import compact_step_result, report_plan
+from base_agent.utils.admission import openai_http_clients
+from base_agent.utils.deadline import DeadlineExceeded, budget_low, call_timeout, degrade, dependency_timeout, output_reserve_s
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import AIMessage
 from openai import OpenAI
-from base_agent.utils.prompts import planner_prompt, extractor_prompt, reasoning_prompt, calculator_prompt, output_prompt
+from base_agent.utils.prompts import (prompt_messages, planner_system_prompt, planner_user_prompt, extractor_system_prompt, extractor_user_prompt,
+                                      batch_extractor_system_prompt, batch_extractor_user_prompt, human_batch_intro,
+                                      reasoning_system_prompt, reasoning_user_prompt, calculator_system_prompt, calculator_user_prompt,
+                                      output_system_prompt, output_user_prompt)
+
+ASSISTANT_POLL_S = 0.5     # poll interval of the calculator assistant runs
+ASSISTANT_PENDING = ("queued", "in_progress", "cancelling")
+
+
+class CalculationFailed(Exception):
+    """Raised when a run of the calculator assistant ends with another status than 'completed' (failed, expired, cancelled, incomplete, requires_action)."""
 
 # Cache the model instances to avoid redundant initializations
 @lru_cache(maxsize=4)
 def _get_model(model_name: str):
     if model_name == "base":
-        llm = ChatOpenAI(temperature=0, model_name="gpt-4o", streaming=True)
+        llm = ChatOpenAI(temperature=0, model_name="gpt-4o", streaming=True, stream_usage=True, cache=get_llm_cache(), callbacks=get_callbacks(), timeout=dependency_timeout("llm"), **openai_http_clients())
         return llm
     elif model_name == "mini-t":
-        llm = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", streaming=True)
+        llm = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", streaming=True, stream_usage=True, cache=get_llm_cache(), callbacks=get_callbacks(), timeout=dependency_timeout("llm"), **openai_http_clients())
         model = llm.bind_tools([SearchDataBase], tool_choice="required")
         return model
     elif model_name == "mini":
-        llm = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", streaming=False)
+        llm = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", streaming=False, cache=get_llm_cache(), callbacks=get_callbacks(), timeout=dependency_timeout("llm"), **openai_http_clients())
         return llm
     elif model_name == "calculator":
-        client = OpenAI()
+        client = OpenAI(http_client=openai_http_clients("assistant")["http_client"])   # requests limited by the admission control (see admission.py)
         assistant = client.beta.assistants.retrieve(
             assistant_id='asst_7VQGXcbxkAgXMYNLns3e5tTU'    # OpenAI Assistant with code interpreter access for calculations
             )
@@ -87,7 +117,7 @@ def add_dependencies_to_string(step, dependencies, dependency_results):
     return dependency_string
 
 # Function for the initial database query
-def call_database(state):
+def call_database(state, config=None):
     task = state["task"]
     context = ""
     retriever_prompt = ChatPromptTemplate.from_messages(
@@ -101,23 +131,51 @@ def call_database(state):
     retriever = retriever_prompt | retriever_model
     retriever_output = retriever.invoke({"task": task})
 
+    # the SearchDataBase tool is only bound for its schema, the retrieval itself runs directly (cached and de-duplicated)
+    # the speculative ranking of the user message (see prefetch.py) is not used: it ranks with DOCUMENT_RETRIEVER_K vector results
+    # the data type and category chosen by the model are applied as pre-filters of the search (see filters.py)
     for calls in retriever_output.tool_calls:
-        print(calls['args']['query'])
-        res = SearchDataBase(query=calls['args']['query'], data_type=calls['args']['data_type'], category=calls['args']['category'])
-        context += res['retrieved information']
+        search_filter = filter_for(calls['args'].get('data_type'), calls['args'].get('category'))
+        try:
+            context += retrieve_context(calls['args']['query'], SEARCH_DATABASE_K, search_filter)
+        except DeadlineExceeded:
+            # the plan is created from the contexts retrieved in time
+            degrade("retrieval")
 
     return {"context": context}
 
+# Function to stream the plan and start dependency-free database steps while the plan is still generated
+def stream_plan(model, messages):
+    parser = IncrementalPlanParser()
+
+    def dispatch(steps):
+        for step in steps:
+            if step.step_type == "database_query" and not step.dependencies:
+                # the result lands in the shared retrieval cache, the DataBaseHandler joins the running retrieval (see TTLCache.get_or_compute)
+                with span("plan.dispatch", step=step.step_number):
+                    run_in_background(retrieve_context, step.step_input, SEARCH_DATABASE_K)
+
+    # stream() bypasses the response cache, so models with a cache (record/replay mode) are invoked
+    if model.cache is not None:
+        text = model.invoke(messages).content
+        dispatch(parser.feed(text) + parser.close())
+        return text
+
+    for chunk in model.stream(messages):
+        dispatch(parser.feed(chunk.content))
+    dispatch(parser.close())
+    return parser.text
+
 # Function to create a plan
 def create_plan(state):
     task = state["task"]
     context = state["context"]
     model = _get_model("base")
 
-    result = model.invoke(planner_prompt.format(task=task, context=context))
+    plan_text = stream_plan(model, prompt_messages(planner_system_prompt, planner_user_prompt, context=context, task=task))
     
-    steps = parse_steps_fixed(result.content)
-    print(steps)
+    # the complete plan is parsed again and validated (sort_steps raises on cycles)
+    steps = parse_steps_fixed(plan_text)
     sorted_step_order = sort_steps(steps)
     sorted_steps = sorted(steps, key=lambda step: sorted_step_order.index(step.step_number))
     plan = Plan(steps=sorted_steps)
@@ -130,12 +188,16 @@ def task_router(state):
     return {"log": 'routing to next task...'}
 
 # Function to route tasks
-def task_handler(state):
+def task_handler(state, config=None):
     index = state["plan_index"]
     plan = state["plan"]
     step_count = len(plan.steps)
 
-    print("Index: " + str(index) + ", Step count: " + str(step_count))
+    if index < step_count and budget_low(output_reserve_s(), config):
+        # the remaining budget is reserved for the answer, it is generated from the results so far
+        degrade("plan")
+        return "end"
+
     if index < (step_count):
         current_step = plan.steps[index]
 
@@ -152,7 +214,7 @@ def task_handler(state):
         return "end"
     
 # Function to handle database queries
-def database_handler(state):
+def database_handler(state, config=None):
     index = state["plan_index"]
     plan = state["plan"]
     current_step = plan.steps[index]
@@ -163,15 +225,29 @@ def database_handler(state):
 
         current_step = add_dependencies(current_step, dependencies, dependency_results)
 
-    res = SearchDataBase(query=current_step.step_input, data_type="", category="")
-    res_str = res['retrieved information']
+    try:
+        res_str = retrieve_context(current_step.step_input, SEARCH_DATABASE_K)
+    except DeadlineExceeded:
+        # the step is answered without the retrieval, the output states the missing result
+        degrade("retrieval")
+        sr = StepResult(step_number=current_step.step_number, result=f"Die Datenbanksuche wurde im Zeitbudget nicht abgeschlossen: {current_step.step_input}")
+        return {"step_results": [sr], "plan_index": index + 1}
+    # only the passages relevant to the step are kept, passages of the shared context are cited (see compaction.py)
+    res_str, full_tokens = compact_step_result(current_step.step_input, res_str, state["context"], state["step_results"], SEARCH_DATABASE_K, config)
 
-    sr = StepResult(step_number=current_step.step_number, result=res_str)
+    sr = StepResult(step_number=current_step.step_number, result=res_str, full_tokens=full_tokens)
 
     return {"step_results": [sr], "plan_index": index + 1}
 
+# Function to check whether the Human steps of a plan are asked in a single interrupt
+def batch_human_steps(config=None):
+    configured = ((config or {}).get("configurable") or {}).get("batch_human_steps")
+    if configured is not None:
+        return bool(configured)
+    return os.environ.get("NORMGRAPH_BATCH_HUMAN_STEPS", "").lower() in ("1", "true", "yes")
+
 # Function to initiate user feedback process
-def user_handler(state):
+def user_handler(state, config=None):
     index = state["plan_index"]
     plan = state["plan"]
     current_step = plan.steps[index]
@@ -184,8 +260,18 @@ def user_handler(state):
 
     user_query = current_step.step_input
 
+    batch = [current_step]
+    if batch_human_steps(config):
+        batch += [step for step in plan.steps[index + 1:] if step.step_type == "user_query" and not step.dependencies]
+    if len(batch) == 1:
+        return {"messages": [AIMessage(user_query)], "human_batch": []}
+
+    # the batched steps are moved directly behind the current step, steps without dependencies can run earlier without breaking the order
+    batched = {step.step_number for step in batch}
+    steps = plan.steps[:index] + batch + [step for step in plan.steps[index + 1:] if step.step_number not in batched]
+    questions = "\n".join(f"{number}. {step.step_input}" for number, step in enumerate(batch, 1))
 
-    return {"messages": [AIMessage(user_query)]}
+    return {"messages": [AIMessage(f"{human_batch_intro}\n{questions}")], "plan": Plan(steps=steps), "human_batch": [step.step_number for step in batch]}
 
 # Dummy-Function to wait for human feedback
 def human_feedback(state):
@@ -199,17 +285,77 @@ def feedback_handler(state):
     plan = state["plan"]
     current_step = plan.steps[index]
 
+    batch = state.get("human_batch") or []
+    if len(batch) > 1:
+        return extract_batch_feedback(state, plan.steps[index:index + len(batch)], last_message)
+
     question = current_step.step_input
     model = _get_model("mini")
 
-    result = model.invoke(extractor_prompt.format(question=question, answer=last_message))
+    result = model.invoke(prompt_messages(extractor_system_prompt, extractor_user_prompt, question=question, answer=last_message))
     
 
     sr = StepResult(step_number=current_step.step_number, result=result.content)
     return {"step_results": [sr], "plan_index": index + 1}
 
+# Function to extract the answers of several Human steps from one reply
+def extract_batch_feedback(state, steps, answer):
+    questions = "\n".join(f"{step.step_number}: {step.step_input}" for step in steps)
+    model = _get_model("mini").with_structured_output(ExtractedAnswers, method="json_schema")
+
+    extraction = model.invoke(prompt_messages(batch_extractor_system_prompt, batch_extractor_user_prompt, questions=questions, answer=answer))
+    answers = {extracted.step_number.strip(): extracted.answer for extracted in extraction.answers}
+
+    # a question missing in the extraction keeps the whole reply as its result
+    results = [StepResult(step_number=step.step_number, result=answers.get(step.step_number) or answer) for step in steps]
+    return {"step_results": results, "plan_index": state["plan_index"] + len(steps), "human_batch": []}
+
+# Function to solve a problem with the calculator assistant (code interpreter)
+def run_calculator(problem):
+    with span("openai.assistant") as assistant_span:
+        calc_client, calc_model = _get_model("calculator")
+        thread = calc_client.beta.threads.create()
+        
+        calc_client.beta.threads.messages.create(
+            thread_id=thread.id,
+            role="user",
+            content=problem
+            )
+        
+        with span("openai.assistant.poll") as poll_span:
+            run = calc_client.beta.threads.runs.create(
+                thread_id=thread.id,
+                assistant_id=calc_model.id
+                )
+            # polled until the run finished or its timeout (dependency timeout or request deadline) is exceeded
+            timeout = call_timeout("assistant")
+            start = time.monotonic()
+            while run.status in ASSISTANT_PENDING:
+                if timeout is not None and time.monotonic() - start > timeout:
+                    calc_client.beta.threads.runs.cancel(thread_id=thread.id, run_id=run.id)
+                    poll_span.set("status", "cancelled")
+                    poll_span.set("deadline_exceeded", True)
+                    raise DeadlineExceeded(f"assistant run exceeded its timeout of {timeout:.2f}s")
+                time.sleep(ASSISTANT_POLL_S)
+                run = calc_client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
+            poll_span.set("status", run.status)
+
+        if run.usage is not None:
+            assistant_span.set("input_tokens", run.usage.prompt_tokens)
+            assistant_span.set("output_tokens", run.usage.completion_tokens)
+        
+        if run.status != 'completed':
+            last_error = getattr(run, "last_error", None)
+            raise CalculationFailed(f"assistant run ended with status '{run.status}'" + (f": {last_error.message}" if last_error else ""))
+
+        messages = calc_client.beta.threads.messages.list(
+            thread_id=thread.id
+        )
+
+        return messages.data[0].content[0].text.value
+
 # Function to handle calculations
-def calculation_handler(state):
+def calculation_handler(state, config=None):
     index = state["plan_index"]
     plan = state["plan"]
     current_step = plan.steps[index]
@@ -222,40 +368,32 @@ def calculation_handler(state):
         dependency_string = add_dependencies_to_string(current_step, dependencies, dependency_results)
 
     #print(dependency_string)
-    model = _get_model("mini")
-    structured_model = model.with_structured_output(Calculation, method="json_schema") 
-    result = structured_model.invoke(calculator_prompt.format(task=current_step.step_input, variables=dependency_string))
+    messages = prompt_messages(calculator_system_prompt, calculator_user_prompt, task=current_step.step_input, variables=dependency_string)
 
-    #print("Calculator Input: " + str(result.problem_plain_text))
+    def attempt(model_name, is_last):
+        structured_model = _get_model(model_name).with_structured_output(Calculation, method="json_schema")
+        return structured_model.invoke(messages)
 
-    print("Augmented Step Input: " + str(current_step.step_input))
+    # escalates to the large model if the structured output of the small model is invalid
+    result = run_cascade("CalculationHandler", cascade_settings("CalculationHandler", config), attempt)
 
-    calc_client, calc_model = _get_model("calculator")
-    thread = calc_client.beta.threads.create()
-    
-    message = calc_client.beta.threads.messages.create(
-        thread_id=thread.id,
-        role="user",
-        content=result.problem_plain_text
-        )
-    
-    run = calc_client.beta.threads.runs.create_and_poll(
-        thread_id=thread.id,
-        assistant_id=calc_model.id
-        )
-    
-    if run.status == 'completed': 
-        messages = calc_client.beta.threads.messages.list(
-            thread_id=thread.id
-        )
+    #print("Calculator Input: " + str(result.problem_plain_text))
 
-    response = messages.data[0].content[0].text.value
+    try:
+        response = replayable("assistant", [result.problem_plain_text], lambda: run_calculator(result.problem_plain_text))
+    except DeadlineExceeded:
+        # the step is answered without the calculation, the output states the missing result
+        degrade("calculation")
+        response = f"Die Berechnung wurde im Zeitbudget nicht abgeschlossen: {result.problem_plain_text}"
+    except CalculationFailed:
+        degrade("calculation")
+        response = f"Die Berechnung konnte nicht durchgeführt werden: {result.problem_plain_text}"
     sr = StepResult(step_number=current_step.step_number, result=response)
     return {"step_results": [sr], "plan_index": index + 1}
 
 
 # Function to call LLM as a tool of the expert model
-def llm_handler(state):
+def llm_handler(state, config=None):
     index = state["plan_index"]
     plan = state["plan"]
     current_step = plan.steps[index]
@@ -269,17 +407,26 @@ def llm_handler(state):
 
 
 
-    model = _get_model("base")
-    result = model.invoke(reasoning_prompt.format(context=context, task=current_step.step_input))
+    messages = prompt_messages(reasoning_system_prompt, reasoning_user_prompt, context=context, task=current_step.step_input)
+    settings = cascade_settings("LLMHandler", config)
 
-    print("Augmented Step Input: " + str(current_step.step_input))  
+    def attempt(model_name, is_last):
+        if is_last:
+            return _get_model(model_name).invoke(messages).content
+        # the small model reports its confidence, low confidence escalates the step to the next model
+        result = _get_model(model_name).with_structured_output(ReasonedAnswer, method="json_schema").invoke(messages)
+        if not result.answer.strip() or result.confidence < settings.get("min_confidence", 0.7):
+            raise Escalate(f"confidence {result.confidence:.2f}")
+        return result.answer
 
-    sr = StepResult(step_number=current_step.step_number, result=result.content)
+    answer = run_cascade("LLMHandler", settings, attempt, skip_small=direct_to_large_model(settings, current_step))
+
+    sr = StepResult(step_number=current_step.step_number, result=answer)
 
     return {"step_results": [sr], "plan_index": index + 1}
 
 # Function to generate the final output
-def output_handler(state):
+def output_handler(state, config=None):
     step_results = state["step_results"]
     context = state["context"]
 
@@ -297,11 +444,15 @@ def output_handler(state):
         else:
             result_string += f"Step {result['step_number']} result: {result['result']}\n"
 
-    model = _get_model("mini")
-    structured_model = model.with_structured_output(Conclusion, method="json_schema")
-    
+    messages = prompt_messages(output_system_prompt, output_user_prompt, context=context, task=task, plan=plan_string, step_results=result_string)
+    report_plan(plan, step_results)
+
+    def attempt(model_name, is_last):
+        structured_model = _get_model(model_name).with_structured_output(Conclusion, method="json_schema")
+        return structured_model.invoke(messages)
 
-    result = structured_model.invoke(output_prompt.format(context=context, task=task, plan=plan_string, step_results=result_string))
+    # escalates to the large model if the structured output of the small model is invalid
+    result = run_cascade("OutputHandler", cascade_settings("OutputHandler", config), attempt)
 
     messages = []
     messages.append(AIMessage(result.conclusion))
@@ -0,0 +1,182 @@
+"""
+This module provides the data type and category filters of the hybrid retrieval.
+
+The retrieval tools receive a `data_type` (e.g. 'Parameter', 'Table') and, for `SearchDataBase`, a `category` (the standard, e.g. 'DIN 1993-1-3') from the model. At ingestion time (see `markdown_ingestion.ipynb`), every chunk is tagged with the data types it contains and the category of its document, sections carry the union of the tags of their chunks. A search with a filter only considers matching nodes:
+- local vector index / quantised index / BM25: only the rows of matching chunks or sections are scored (pre-filter)
+- neo4j vector and full-text search: the matching condition is part of the query (the neo4j vector index has no pre-filter, so more candidates are requested and filtered inside the query)
+
+Untagged nodes always match, so a partially tagged graph returns the same results as before. A requested data type accepts related chunk tags (e.g. parameters are often given in tables), 'Other' does not filter.
+
+Configuration through environment variables:
+- NORMGRAPH_RETRIEVAL_FILTERS: '0' disables the filters (default: enabled)
+- NORMGRAPH_FILTER_OVERSAMPLE: candidates requested from the neo4j vector index per result when a filter is set (default: 4)
+
+Modules and Classes:
+- SearchFilter: Class holding the accepted data types and the category of a search.
+
+Functions:
+- filter_for: Function creating the filter of a tool call.
+- with_category: Function restricting a filter to a category.
+- filter_condition: Function returning the cypher condition of a filter.
+- allowed_rows: Function returning the rows of an index that match a filter.
+- filter_ranking: Function restricting a ranking of sections to the sections matching a filter.
+- tag_data_types: Function tagging the content of a chunk.
+- tag_graph: Function tagging the chunks and sections of the graph at ingestion.
+"""
+
+import os
+import re
+from collections import namedtuple
+
+from base_agent.utils.tracing import span
+
+DATA_TYPES = ["Definition", "Parameter", "Equation", "Table", "Process", "Proof", "Other"]
+TAG_BATCH = 1000
+
+# chunk tags accepted for a requested data type
+ACCEPTED_TAGS = {
+    "Definition": ("Definition",),
+    "Parameter": ("Parameter", "Table", "Equation"),
+    "Equation": ("Equation",),
+    "Table": ("Table",),
+    "Process": ("Process", "Proof"),
+    "Proof": ("Proof", "Process", "Equation"),
+}
+
+# heuristics of the data type tags, a chunk can carry several tags
+_TAG_PATTERNS = {
+    "Table": re.compile(r"(^\s*\|.*\|\s*$\n?){2,}|^\s*Tabelle\s+[A-Z]*\.?\d", re.MULTILINE),
+    "Equation": re.compile(r"\$[^$]+\$|\\frac|\\cdot|^.{0,80}\b[A-Za-zµ]{1,3}(?:_\{?\w+\}?)?\s*=\s*[^=]{1,80}$|\(\s*[A-Z]*\.?\d+(?:\.\d+)*\s*\)\s*$", re.MULTILINE),
+    "Parameter": re.compile(r"\d+(?:,\d+)?\s*(?:kN|N|mm|cm|m)(?:/m²|/m2|²)?\b|\b(?:Beiwert|Formbeiwert|Koeffizient|Faktor|charakteristische[nr]? Wert)", re.IGNORECASE),
+    "Definition": re.compile(r"\b(?:bezeichnet|ist definiert|versteht man|im Sinne dieser|Begriffe?\b|Definitionen?)", re.IGNORECASE),
+    "Process": re.compile(r"\b(?:Verfahren|Vorgehen|ist zu ermitteln|sind zu ermitteln|sind anzusetzen|ist anzusetzen|Ermittlung)", re.IGNORECASE),
+    "Proof": re.compile(r"\b(?:Nachweis\w*|nachzuweisen|Bemessung\w*)", re.IGNORECASE),
+}
+
+CHUNKS_CYPHER = """
+MATCH (chunk)-[:PART_OF*1..]->(root)
+WHERE chunk.content IS NOT NULL AND ($rootId IS NULL OR root.id = $rootId)
+RETURN DISTINCT chunk.id AS id, chunk.content AS content
+"""
+
+SECTION_TAGS_CYPHER = """
+MATCH (section)
+WHERE section.id IN $ids
+RETURN section.id AS id, section.data_types AS data_types, section.category AS category
+"""
+
+TAG_CHUNKS_CYPHER = """
+UNWIND $batch AS item
+MATCH (chunk {id: item.id})
+SET chunk.data_types = item.data_types
+"""
+
+TAG_CATEGORY_CYPHER = """
+MATCH (node)-[:PART_OF*1..]->(root {id: $rootId})
+SET node.category = $category
+"""
+
+TAG_SECTIONS_CYPHER = """
+MATCH (chunk)-[:PART_OF]->(section)
+WHERE chunk.data_types IS NOT NULL AND ($rootId IS NULL OR EXISTS { MATCH (section)-[:PART_OF*0..]->(root {id: $rootId}) })
+WITH section, apoc.coll.toSet(apoc.coll.flatten(collect(chunk.data_types))) AS data_types
+SET section.data_types = data_types
+"""
+
+
+class SearchFilter(namedtuple("SearchFilter", ["data_types", "category"])):
+    """Accepted chunk tags (None: any) and category (None: any) of a search. Hashable, so it is part of the retrieval cache key."""
+
+    def matches(self, data_types, category):
+        if self.category is not None and category is not None and category != self.category:
+            return False
+        if self.data_types is not None and data_types is not None and not set(data_types) & set(self.data_types):
+            return False
+        return True
+
+    def parameters(self):
+        """Parameters of the cypher condition returned by `filter_condition`."""
+        return {"dataTypes": list(self.data_types) if self.data_types is not None else None, "category": self.category}
+
+
+def filters_enabled():
+    return os.environ.get("NORMGRAPH_RETRIEVAL_FILTERS", "1").lower() not in ("0", "false", "no")
+
+
+def filter_oversample():
+    return int(os.environ.get("NORMGRAPH_FILTER_OVERSAMPLE", "4"))
+
+
+def filter_for(data_type=None, category=None):
+    """
+    Creates the filter of a tool call from the data type and category chosen by the model.
+
+    Returns:
+    SearchFilter: The filter, or None if nothing is filtered (filters disabled, 'Other' or empty values).
+    """
+    if not filters_enabled():
+        return None
+    data_types = ACCEPTED_TAGS.get(data_type or "")
+    category = category if category and category != "Other" else None
+    if data_types is None and category is None:
+        return None
+    return SearchFilter(data_types, category)
+
+
+def with_category(search_filter, category):
+    """Returns the filter restricted to `category`, e.g. the category of a partition searched by an in-process index (see partitions.py)."""
+    return SearchFilter(search_filter.data_types if search_filter is not None else None, category)
+
+
+def filter_condition(node):
+    """Cypher condition matching `node` against the parameters $dataTypes and $category (untagged nodes match)."""
+    return (f"($dataTypes IS NULL OR {node}.data_types IS NULL OR any(tag IN {node}.data_types WHERE tag IN $dataTypes)) "
+            f"AND ($category IS NULL OR {node}.category IS NULL OR {node}.category = $category)")
+
+
+def allowed_rows(search_filter, data_types, categories):
+    """Returns the rows whose tags match the filter. `data_types` and `categories` hold the tags of each row (None for untagged rows)."""
+    return [row for row, (row_types, row_category) in enumerate(zip(data_types, categories)) if search_filter.matches(row_types, row_category)]
+
+
+def filter_ranking(section_ids, search_filter, driver):
+    """
+    Restricts a ranking of sections retrieved without filter (e.g. the speculative retrieval, see prefetch.py) to the sections matching the filter, in ranking order.
+    Unlike a filtered search, sections that only rank below the unfiltered candidates are not found.
+    """
+    with span("filters.ranking", sections=len(section_ids)) as ranking_span:
+        records, _, _ = driver.execute_query(SECTION_TAGS_CYPHER, ids=list(section_ids))
+        tags = {record["id"]: (record["data_types"], record["category"]) for record in records}
+        matching = [section_id for section_id in section_ids if search_filter.matches(*tags.get(section_id, (None, None)))]
+        ranking_span.set("matching", len(matching))
+    return matching
+
+
+#----------------- Tagging (ingestion) -----------------#
+def tag_data_types(content):
+    """Returns the data type tags of a chunk ('Other' if no heuristic matches)."""
+    tags = [data_type for data_type, pattern in _TAG_PATTERNS.items() if pattern.search(content or "")]
+    return tags or ["Other"]
+
+
+def tag_graph(driver, category=None, root_id=None):
+    """
+    Tags the chunks with their data types and the sections with the union of the tags of their chunks. With `category` and `root_id`, all nodes below the document root additionally get the category.
+
+    Args:
+    driver: The neo4j driver.
+    category (str): Category of the document, e.g. 'DIN 1993-1-3'.
+    root_id (str): Id of the document root node, all chunks of the graph are tagged if None.
+
+    Returns:
+    int: The number of tagged chunks.
+    """
+    with span("filters.tag", root=root_id or ""):
+        records, _, _ = driver.execute_query(CHUNKS_CYPHER, rootId=root_id)
+        batch = [{"id": record["id"], "data_types": tag_data_types(record["content"])} for record in records]
+        for i in range(0, len(batch), TAG_BATCH):
+            driver.execute_query(TAG_CHUNKS_CYPHER, batch=batch[i:i + TAG_BATCH])
+        driver.execute_query(TAG_SECTIONS_CYPHER, rootId=root_id)
+        if category is not None and root_id is not None:
+            driver.execute_query(TAG_CATEGORY_CYPHER, rootId=root_id, category=category)
+    return len(batch)
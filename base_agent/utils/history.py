@@ -0,0 +1,103 @@
+"""
+This module provides the conversation-history compaction of the agent node.
+
+The `add_messages` reducer keeps every message of a thread, including the `ToolMessage`s carrying the full `DocumentRetriever` context, so the prompt of `call_agent_model` grows with every turn. Once the history exceeds a token threshold, the tool outputs of all but the last N turns are replaced by compact citations: the tool name, its query and the headings of the retrieved sections. The replaced messages keep their id, so the `add_messages` reducer overwrites them in the checkpoint and the compacted history stays a stable prompt prefix for the following turns.
+
+A turn starts with a `HumanMessage`. The tool call / tool message pairs are preserved, only the content of the tool messages is shortened.
+
+Configuration per deployment through environment variables, overridable per invocation through `config["configurable"]`:
+- NORMGRAPH_HISTORY_MAX_TOKENS / 'history_max_tokens': token threshold of the history that triggers the compaction (default: 8000, 0 disables it)
+- NORMGRAPH_HISTORY_KEEP_TURNS / 'history_keep_turns': number of most recent turns kept verbatim (default: 2)
+
+Functions:
+- history_settings: Function returning the compaction threshold and the number of kept turns.
+- history_tokens: Function counting the tokens of a message history.
+- cite_tool_output: Function creating the compact citation of a tool output.
+- compact_history: Function returning the compacted tool messages of a history.
+"""
+
+import os
+import re
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from base_agent.utils.tools import count_tokens
+
+MAX_HEADINGS = 8
+
+# section headings rendered by `Section.render`, e.g. "5.2.3 Schneelast auf Dächern" or "A.1 Anwendungsbereich"
+_HEADING = re.compile(r"^(?:[A-Z]\.)?\d+(?:\.\d+)*\.?\s+[A-ZÄÖÜ].{0,120}$")
+
+
+def history_settings(config=None):
+    """Returns (max_tokens, keep_turns) from the invocation config or the environment."""
+    configurable = (config or {}).get("configurable", {})
+    max_tokens = configurable.get("history_max_tokens", os.environ.get("NORMGRAPH_HISTORY_MAX_TOKENS", "8000"))
+    keep_turns = configurable.get("history_keep_turns", os.environ.get("NORMGRAPH_HISTORY_KEEP_TURNS", "2"))
+    return int(max_tokens), int(keep_turns)
+
+
+def _message_tokens(message):
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    tokens = count_tokens(content)
+    for tool_call in getattr(message, "tool_calls", None) or []:
+        tokens += count_tokens(str(tool_call.get("args", "")))
+    return tokens
+
+
+def history_tokens(messages):
+    return sum(_message_tokens(message) for message in messages)
+
+
+def cite_tool_output(tool_name, args, content):
+    """Creates the compact citation of a tool output: tool, query and the headings of the retrieved sections."""
+    query = (args or {}).get("query") or (args or {}).get("task") or ""
+    text = content if isinstance(content, str) else str(content)
+    # the tool output is the serialized result dict, line breaks may be escaped
+    lines = [line.strip() for line in text.replace("\\n", "\n").split("\n")]
+    headings = []
+    for line in lines:
+        if _HEADING.match(line) and line not in headings:
+            headings.append(line)
+        if len(headings) >= MAX_HEADINGS:
+            break
+    citation = f"[Gekürzt] {tool_name}"
+    if query:
+        citation += f"('{query}')"
+    if headings:
+        citation += ": " + "; ".join(headings)
+    return citation
+
+
+def compact_history(messages, max_tokens, keep_turns):
+    """
+    Compacts the tool outputs older than the last `keep_turns` turns if the history exceeds `max_tokens`.
+
+    Returns:
+    list: Replacement `ToolMessage`s with the ids of the compacted messages (empty if nothing was compacted).
+    """
+    if max_tokens <= 0 or history_tokens(messages) <= max_tokens:
+        return []
+
+    turn_starts = [index for index, message in enumerate(messages) if isinstance(message, HumanMessage)]
+    if len(turn_starts) <= keep_turns:
+        return []
+    boundary = turn_starts[-keep_turns] if keep_turns > 0 else len(messages)
+
+    tool_calls = {}
+    for message in messages[:boundary]:
+        if isinstance(message, AIMessage):
+            for tool_call in message.tool_calls or []:
+                tool_calls[tool_call["id"]] = tool_call
+
+    replacements = []
+    for message in messages[:boundary]:
+        if not isinstance(message, ToolMessage) or message.additional_kwargs.get("compacted") or message.id is None:
+            continue
+        tool_call = tool_calls.get(message.tool_call_id, {})
+        citation = cite_tool_output(tool_call.get("name", message.name or "tool"), tool_call.get("args"), message.content)
+        if count_tokens(citation) >= _message_tokens(message):
+            continue
+        replacements.append(ToolMessage(content=citation, tool_call_id=message.tool_call_id, name=message.name, id=message.id,
+                                        additional_kwargs={"compacted": True}))
+    return replacements
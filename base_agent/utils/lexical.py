@@ -0,0 +1,255 @@
+"""
+This module provides the lexical (keyword) leg of the hybrid retrieval in `RRFGraphQuery`.
+
+Backends, selected with the environment variable NORMGRAPH_LEXICAL_BACKEND:
+- 'neo4j' (default): full-text search over the section and chapter titles (index 'titles')
+- 'neo4j+content': additionally searches the chunk contents (index 'chunk-content', created with `ensure_fulltext_indexes`)
+- 'bm25': in-process BM25 index over section titles and chunk contents with German stemming, no neo4j round-trip
+
+The neo4j queries are parameterised, so the query plan is cached independently of the user text, and the user text is escaped for the Lucene query syntax (quotes, '+', '-', brackets, boolean operators, ...). Each leg returns a ranked list of section ids, that are fused with the vector search results by the reciprocal rank fusion. The latency of the lexical leg is recorded as its own span 'lexical.search'.
+
+With a data type / category filter (see filters.py), the neo4j legs only return matching sections and chunks, the BM25 index only scores matching sections.
+With a partition (see partitions.py), the neo4j legs query the full-text indexes of the partition, the BM25 index only scores the sections of its category.
+
+Modules and Classes:
+- BM25Index: Class implementing the in-process BM25 index.
+
+Functions:
+- escape_lucene: Function escaping a user query for the Lucene query syntax.
+- german_stem: Function stemming a German word (CISTEM).
+- tokenize: Function splitting a text into stemmed tokens.
+- ensure_fulltext_indexes: Function creating the full-text indexes.
+- lexical_search: Function returning the ranked section ids of each lexical leg.
+"""
+
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from base_agent.utils.deadline import unbounded
+from base_agent.utils.filters import allowed_rows, filter_condition, with_category
+from base_agent.utils.tracing import span
+
+TITLE_INDEX = "titles"
+CONTENT_INDEX = "chunk-content"
+CONTENT_LIMIT = 10      # sections returned by the content leg
+
+TITLE_CYPHER = """
+CALL db.index.fulltext.queryNodes($indexName, $query) YIELD node, score
+RETURN DISTINCT node.title AS title, node.id AS id, score
+"""
+
+CONTENT_CYPHER = """
+CALL db.index.fulltext.queryNodes($indexName, $query) YIELD node, score
+MATCH (node)-[:PART_OF]->(section)
+RETURN section.title AS title, section.id AS id, max(score) AS score
+ORDER BY score DESC
+LIMIT $limit
+"""
+
+TITLE_FILTERED_CYPHER = f"""
+CALL db.index.fulltext.queryNodes($indexName, $query) YIELD node, score
+WHERE {filter_condition("node")}
+RETURN DISTINCT node.title AS title, node.id AS id, score
+"""
+
+CONTENT_FILTERED_CYPHER = f"""
+CALL db.index.fulltext.queryNodes($indexName, $query) YIELD node, score
+WHERE {filter_condition("node")}
+MATCH (node)-[:PART_OF]->(section)
+RETURN section.title AS title, section.id AS id, max(score) AS score
+ORDER BY score DESC
+LIMIT $limit
+"""
+
+INDEX_CYPHERS = [
+    "CREATE FULLTEXT INDEX `titles` IF NOT EXISTS FOR (n:Chapter|Section) ON EACH [n.title] OPTIONS {indexConfig: {`fulltext.analyzer`: 'german'}}",
+    "CREATE FULLTEXT INDEX `chunk-content` IF NOT EXISTS FOR (n:Chunk) ON EACH [n.content] OPTIONS {indexConfig: {`fulltext.analyzer`: 'german'}}",
+]
+
+_LUCENE_SPECIAL = re.compile(r'([+\-!(){}\[\]^"~*?:\\/&|])')
+_LUCENE_OPERATORS = re.compile(r"\b(AND|OR|NOT|TO)\b")
+
+
+def escape_lucene(query):
+    """Escapes the special characters of the Lucene query syntax, so the user text is searched literally."""
+    query = query.replace("„", " ").replace("“", " ").replace("”", " ")
+    query = _LUCENE_SPECIAL.sub(r"\\\1", query)
+    # boolean operators are only recognized in upper case
+    return _LUCENE_OPERATORS.sub(lambda match: match.group(1).lower(), query).strip()
+
+
+def ensure_fulltext_indexes(driver):
+    """Creates the full-text indexes over titles and chunk contents, if they don't exist yet."""
+    for cypher in INDEX_CYPHERS:
+        driver.execute_query(cypher)
+
+
+#----------------- German stemming -----------------#
+def german_stem(word):
+    """
+    Stems a lower case German word with the CISTEM algorithm (Weissweiler & Fraser, 2017).
+    """
+    word = word.replace("ü", "u").replace("ö", "o").replace("ä", "a").replace("ß", "ss")
+    word = re.sub(r"^ge(.{4,})", r"\1", word)
+    word = word.replace("sch", "$").replace("ei", "%").replace("ie", "&")
+    word = re.sub(r"(.)\1", r"\1*", word)
+
+    while len(word) > 3:
+        if len(word) > 5:
+            word, count = re.subn(r"e[mr]$", "", word)
+            if count:
+                continue
+            word, count = re.subn(r"nd$", "", word)
+            if count:
+                continue
+        word, count = re.subn(r"t$", "", word)
+        if count:
+            continue
+        word, count = re.subn(r"[esn]$", "", word)
+        if not count:
+            break
+
+    word = re.sub(r"(.)\*", r"\1\1", word)
+    return word.replace("&", "ie").replace("%", "ei").replace("$", "sch")
+
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    return [german_stem(token) for token in _TOKEN.findall((text or "").lower())]
+
+
+#----------------- BM25 -----------------#
+BM25_VERSION_CYPHER = """
+MATCH (chunk:Chunk)
+RETURN count(chunk) AS count, max(chunk.id) AS last, count(chunk.data_types) AS tagged
+"""
+
+BM25_DOCUMENT_CYPHER = """
+MATCH (section) WHERE section:Section OR section:Chapter
+OPTIONAL MATCH (chunk:Chunk)-[:PART_OF]->(section)
+RETURN section.id AS id, section.title AS title, collect(chunk.content) AS contents, section.data_types AS data_types, section.category AS category
+"""
+
+
+class BM25Index:
+    """In-process BM25 index over section documents (title and chunk contents). The title is weighted double."""
+
+    def __init__(self, documents, k1=1.2, b=0.75, title_weight=2, tags=None):
+        self.k1 = k1
+        self.b = b
+        self.ids = []
+        self.lengths = []
+        self.postings = defaultdict(list)
+        # (data types, category) of each section, None for untagged sections
+        self.data_types = [data_types for data_types, _ in tags] if tags else [None] * len(documents)
+        self.categories = [category for _, category in tags] if tags else [None] * len(documents)
+        self._allowed = {}
+        for doc_index, (section_id, title, contents) in enumerate(documents):
+            tokens = tokenize(title) * title_weight + tokenize(" ".join(contents))
+            self.ids.append(section_id)
+            self.lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self.postings[term].append((doc_index, frequency))
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        n = len(self.ids)
+        self.idf = {term: math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5)) for term, posting in self.postings.items()}
+        self.version = None
+
+    @classmethod
+    def from_graph(cls, driver):
+        records, _, _ = driver.execute_query(BM25_DOCUMENT_CYPHER)
+        return cls([(record["id"], record["title"], record["contents"]) for record in records],
+                   tags=[(record["data_types"], record["category"]) for record in records])
+
+    def search(self, query, limit=CONTENT_LIMIT, search_filter=None):
+        """Returns the ids of the `limit` best matching sections (only sections matching `search_filter` are scored)."""
+        allowed = None
+        if search_filter is not None:
+            allowed = self._allowed.get(search_filter)
+            if allowed is None:
+                allowed = self._allowed[search_filter] = frozenset(allowed_rows(search_filter, self.data_types, self.categories))
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_index, frequency in self.postings[term]:
+                if allowed is not None and doc_index not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_index] / self.average_length)
+                scores[doc_index] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [self.ids[doc_index] for doc_index, _ in ranked]
+
+
+_bm25 = None
+_bm25_checked = 0.0
+_bm25_lock = threading.Lock()
+
+
+def _bm25_version(driver):
+    records, _, _ = driver.execute_query(BM25_VERSION_CYPHER)
+    return f"{records[0]['count']}:{records[0]['last']}:{records[0]['tagged']}" if records else ""
+
+
+def get_bm25_index(driver):
+    """Returns the shared BM25 index, rebuilt when the chunks in the graph changed (checked every NORMGRAPH_VECTOR_REFRESH_S seconds)."""
+    global _bm25, _bm25_checked
+    interval = float(os.environ.get("NORMGRAPH_VECTOR_REFRESH_S", "300"))
+    with _bm25_lock:
+        if _bm25 is None or time.monotonic() - _bm25_checked > interval:
+            version = _bm25_version(driver)
+            if _bm25 is None or _bm25.version != version:
+                # the build is shared by all requests, it is not bounded by the deadline of the current one
+                with unbounded(), span("bm25.build") as build_span:
+                    _bm25 = BM25Index.from_graph(driver)
+                    _bm25.version = version
+                    build_span.set("documents", len(_bm25.ids))
+            _bm25_checked = time.monotonic()
+        return _bm25
+
+
+#----------------- Lexical leg -----------------#
+def lexical_backend():
+    return os.environ.get("NORMGRAPH_LEXICAL_BACKEND", "neo4j").lower()
+
+
+def _fulltext(driver, index_name, cypher, query, **parameters):
+    with span("neo4j.fulltext", index=index_name) as text_span:
+        records, _, _ = driver.execute_query(cypher, indexName=index_name, query=query, **parameters)
+        text_span.set("rows", len(records))
+    return [record["id"] for record in records]
+
+
+def lexical_search(query, driver, search_filter=None, partition=None):
+    """
+    Runs the lexical leg of the hybrid retrieval with the configured backend, restricted to the sections and chunks matching `search_filter` and to the `partition` (Standard) if given.
+
+    Returns:
+    dict: Ranked section ids per lexical leg, e.g. {'textSearch': [...], 'contentSearch': [...]}.
+    """
+    backend = lexical_backend()
+    with span("lexical.search", backend=backend):
+        if backend == "bm25":
+            if partition is not None:
+                search_filter = with_category(search_filter, partition.category)
+            return {'textSearch': get_bm25_index(driver).search(query, search_filter=search_filter)}
+
+        escaped = escape_lucene(query)
+        if not escaped:
+            return {'textSearch': []}
+        if search_filter is None:
+            title_cypher, content_cypher, parameters = TITLE_CYPHER, CONTENT_CYPHER, {}
+        else:
+            title_cypher, content_cypher, parameters = TITLE_FILTERED_CYPHER, CONTENT_FILTERED_CYPHER, search_filter.parameters()
+        title_index, content_index = (partition.title_index, partition.content_index) if partition is not None else (TITLE_INDEX, CONTENT_INDEX)
+        results = {'textSearch': _fulltext(driver, title_index, title_cypher, escaped, **parameters)}
+        if backend == "neo4j+content":
+            results['contentSearch'] = _fulltext(driver, content_index, content_cypher, escaped, limit=CONTENT_LIMIT, **parameters)
+        return results
@@ -0,0 +1,339 @@
+"""
+This module provides Prometheus-compatible metrics for the running application.
+
+The metrics are derived from the tracing spans (see tracing.py): every finished span is put into a queue by a span processor and aggregated into counters and histograms by a background thread, so the request path only pays for a queue insertion.
+
+Collected metrics:
+- normgraph_span_duration_seconds{span}: latency histogram of every graph node ('node.<name>'), tool ('tool.DocumentRetriever', 'tool.SearchDataBase'), retrieval function ('RRFGraphQuery', 'RetrieveSections') and external call ('neo4j.*', 'voyage.embed' / 'local.embed', 'llm.<model>', 'openai.assistant')
+- normgraph_span_errors_total{span}: failed operations
+- normgraph_llm_calls_total{model,node}: chat model invocations (models created by `_get_model`)
+- normgraph_llm_tokens_total{model,node,type}: input, output and cached tokens (prompt prefix served from the provider's prompt cache)
+- normgraph_llm_time_to_first_token_seconds{model,node}: time to first token of streaming chat models
+- normgraph_threads_waiting_for_feedback: threads interrupted at `HumanFeedback`, a thread without an answer for NORMGRAPH_FEEDBACK_TTL_S seconds (default: 86400) counts as abandoned
+- normgraph_queue_depth{queue}: graph runs waiting for their admission ('runs') and calls waiting for a slot per dependency (see admission.py)
+- normgraph_neo4j_queries_in_flight: running neo4j queries (connection pool usage)
+- normgraph_cache_hits_total / normgraph_cache_misses_total{cache}: hit rates of registered caches
+- normgraph_prefetch_total{result}: speculative retrievals taken by a matching query ('hit') or discarded ('miss')
+- normgraph_cascade_attempts_total{node,model,result}: attempts of the model cascade (see cascade.py) that were 'accepted' or 'escalated'
+- normgraph_step_result_tokens_total{stage}: tokens of the compacted step results before ('full') and after ('compacted') their compaction (see compaction.py)
+
+The metrics are exposed through the pull function `render_metrics` or a local http endpoint, started when NORMGRAPH_METRICS_PORT is set (e.g. 'http://localhost:9464/metrics').
+
+Modules and Classes:
+- Counter, Gauge, Histogram: Metric types with labels.
+- MetricsRegistry: Class holding all metrics and rendering the Prometheus text format.
+
+Functions:
+- render_metrics: Function returning all metrics in the Prometheus text format.
+- register_cache: Function registering a cache for the hit-rate metrics.
+- register_queues: Function registering the queue depths for the queue metrics.
+- start_metrics_server: Function starting the http endpoint.
+"""
+
+import os
+import queue
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from base_agent.utils.tracing import add_span_processor, add_span_start_processor
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Gauge, either set explicitly or computed at scrape time by `callback` (returning {label values: value})."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=(), callback=None, type=None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+        if type:
+            self.type = type
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(labels.get(label, "") for label in self.labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        if self.callback is not None:
+            values.update(self.callback())
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+span_duration = registry.register(Histogram("normgraph_span_duration_seconds", "Duration of graph nodes, tools and external calls.", ["span"]))
+span_errors = registry.register(Counter("normgraph_span_errors_total", "Failed graph nodes, tools and external calls.", ["span"]))
+llm_calls = registry.register(Counter("normgraph_llm_calls_total", "Chat model invocations.", ["model", "node"]))
+llm_tokens = registry.register(Counter("normgraph_llm_tokens_total", "Tokens of chat model invocations.", ["model", "node", "type"]))
+llm_ttft = registry.register(Histogram("normgraph_llm_time_to_first_token_seconds", "Time to first token of streaming chat model invocations.", ["model", "node"]))
+
+def _waiting_count():
+    return {(): len(_expire_waiting())}
+
+
+waiting_threads = registry.register(Gauge("normgraph_threads_waiting_for_feedback", "Threads interrupted at the HumanFeedback node.", callback=_waiting_count))
+neo4j_in_flight = registry.register(Gauge("normgraph_neo4j_queries_in_flight", "Running neo4j queries."))
+prefetches = registry.register(Counter("normgraph_prefetch_total", "Speculative retrievals by result.", ["result"]))
+cascade_attempts = registry.register(Counter("normgraph_cascade_attempts_total", "Attempts of the model cascade of the expert nodes.", ["node", "model", "result"]))
+hedged_calls = registry.register(Counter("normgraph_hedged_calls_total", "External calls with a hedged duplicate request, by the request that answered first.", ["span", "winner"]))
+deadline_exceeded = registry.register(Counter("normgraph_deadline_exceeded_total", "External calls that exceeded their timeout or the request deadline.", ["span"]))
+degradations = registry.register(Counter("normgraph_degraded_total", "Results degraded to meet the request deadline.", ["reason"]))
+admission_wait = registry.register(Histogram("normgraph_admission_queue_wait_seconds", "Queue wait of graph runs before their admission.", ["priority"]))
+dependency_wait = registry.register(Histogram("normgraph_dependency_queue_wait_seconds", "Wait of dependency calls for a concurrency slot.", ["dependency", "priority"]))
+admission_shed = registry.register(Counter("normgraph_admission_shed_total", "Graph runs and dependency calls shed by the admission control.", ["reason"]))
+step_result_tokens = registry.register(Counter("normgraph_step_result_tokens_total", "Tokens of compacted step results before and after the compaction.", ["stage"]))
+
+_caches = {}
+
+
+def _cache_values(index):
+    def callback():
+        return {(name,): info()[index] for name, info in _caches.items()}
+    return callback
+
+
+cache_hits = registry.register(Gauge("normgraph_cache_hits_total", "Cache hits.", ["cache"], callback=_cache_values(0), type="counter"))
+cache_misses = registry.register(Gauge("normgraph_cache_misses_total", "Cache misses.", ["cache"], callback=_cache_values(1), type="counter"))
+
+_queues = []
+
+
+def _queue_values():
+    return {(name,): depth for info in _queues for name, depth in info().items()}
+
+
+queue_depth = registry.register(Gauge("normgraph_queue_depth", "Graph runs waiting for their admission and calls waiting for a dependency slot.", ["queue"], callback=_queue_values))
+
+
+def register_cache(name, info):
+    """
+    Registers a cache for the hit-rate metrics.
+
+    Args:
+    name (str): Label of the cache.
+    info (callable): Function returning (hits, misses), e.g. `lambda: _get_model.cache_info()[:2]`.
+    """
+    _caches[name] = info
+
+
+def register_queues(info):
+    """
+    Registers the queue depths for the queue metrics.
+
+    Args:
+    info (callable): Function returning {queue: depth}, e.g. `admission.queue_depths`.
+    """
+    _queues.append(info)
+
+
+def render_metrics():
+    """Returns all metrics in the Prometheus text format."""
+    return registry.render()
+
+
+#----------------- Span aggregation -----------------#
+# thread id -> time the thread was interrupted at HumanFeedback, threads never answered expire after NORMGRAPH_FEEDBACK_TTL_S
+_waiting = {}
+_waiting_lock = threading.Lock()
+_span_queue = queue.SimpleQueue()
+
+
+def _expire_waiting():
+    ttl = float(os.environ.get("NORMGRAPH_FEEDBACK_TTL_S", "86400"))
+    now = time.monotonic()
+    with _waiting_lock:
+        for thread_id in [thread_id for thread_id, since in _waiting.items() if now - since > ttl]:
+            del _waiting[thread_id]
+        return dict(_waiting)
+
+
+def _aggregate(finished_span):
+    name = finished_span.name
+    attributes = finished_span.attributes
+    span_duration.observe(finished_span.duration, span=name)
+    if finished_span.status == "error":
+        span_errors.inc(span=name)
+    # attributes of the bounded calls (see deadline.py), set on the span of the calling function
+    if attributes.get("hedged"):
+        hedged_calls.inc(span=name, winner="hedge" if attributes.get("hedge_won") else "primary")
+    if attributes.get("deadline_exceeded"):
+        deadline_exceeded.inc(span=name)
+
+    if name.startswith("llm."):
+        labels = {"model": attributes.get("model", ""), "node": attributes.get("node") or ""}
+        llm_calls.inc(**labels)
+        for token_type in ("input", "output", "cached"):
+            llm_tokens.inc(attributes.get(f"{token_type}_tokens", 0), type=token_type, **labels)
+        if "ttft_ms" in attributes:
+            llm_ttft.observe(attributes["ttft_ms"] / 1000, **labels)
+    elif name.startswith("neo4j."):
+        neo4j_in_flight.dec()
+    elif name == "admission.queue":
+        admission_wait.observe(finished_span.duration, priority=attributes.get("priority", ""))
+        if attributes.get("shed"):
+            admission_shed.inc(reason=attributes["shed"])
+    elif name == "admission.dependency":
+        dependency_wait.observe(finished_span.duration, dependency=attributes.get("dependency", ""), priority=attributes.get("priority", ""))
+        if attributes.get("shed"):
+            admission_shed.inc(reason=attributes["shed"])
+    elif name == "admission.tpm" and attributes.get("shed"):
+        admission_shed.inc(reason=attributes["shed"])
+    elif name == "deadline.degraded":
+        degradations.inc(reason=attributes.get("reason", ""))
+    elif name == "compaction.step":
+        step_result_tokens.inc(attributes.get("full_tokens", 0), stage="full")
+        step_result_tokens.inc(attributes.get("compacted_tokens", attributes.get("full_tokens", 0)), stage="compacted")
+    elif name == "prefetch.take":
+        prefetches.inc(result="hit" if attributes.get("hit") else "miss")
+    elif name == "cascade.attempt":
+        cascade_attempts.inc(node=attributes.get("node", ""), model=attributes.get("model", ""),
+                             result="accepted" if attributes.get("accepted") else "escalated")
+    elif name == "node.UserHandler":
+        # the graph is interrupted before HumanFeedback after the UserHandler asked the question
+        with _waiting_lock:
+            _waiting[attributes.get("thread_id")] = time.monotonic()
+        _expire_waiting()
+    elif name == "node.HumanFeedback":
+        with _waiting_lock:
+            _waiting.pop(attributes.get("thread_id"), None)
+
+
+def _run_aggregator():
+    while True:
+        finished_span = _span_queue.get()
+        try:
+            _aggregate(finished_span)
+        except Exception:
+            pass
+
+
+def _on_span_start(started_span):
+    if started_span.name.startswith("neo4j."):
+        neo4j_in_flight.inc()
+
+
+add_span_start_processor(_on_span_start)
+add_span_processor(_span_queue.put)
+threading.Thread(target=_run_aggregator, daemon=True, name="MetricsAggregator").start()
+
+
+#----------------- Http endpoint -----------------#
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Starts the http endpoint serving the metrics on http://<host>:<port>/metrics in a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="MetricsServer").start()
+    return server
+
+
+if os.environ.get("NORMGRAPH_METRICS_PORT"):
+    start_metrics_server(int(os.environ["NORMGRAPH_METRICS_PORT"]))
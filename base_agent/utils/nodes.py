@@ -1,12 +1,14 @@
 """
-This module defines various nodes and utility functions used in the agent's workflow. It includes functions to get language models, route tasks, call models, extract tasks, and provide help. The module also sets up a callback handler for logging and monitoring.
+This module defines various nodes and utility functions used in the agent's workflow. It includes functions to get language models, route tasks, call models, extract tasks, and provide help. The models are created with the callback handlers for tracing and monitoring (see tracing.py).
 
 Modules and Classes:
 - ChatOpenAI: Class to interact with OpenAI's chat models.
 - SearchDataBase: Tool for searching a database.
 - ToolNode: Class to define a tool node.
 - AIMessage, ToolMessage: Classes for handling messages.
-- CallbackHandler: Class for handling callbacks.
+- get_callbacks: Function returning the tracing (and optional Langfuse) callback handlers.
+- compact_history: Function compacting old tool outputs of the conversation history (see history.py).
+- start_prefetch: Function starting the speculative retrieval of a user message (see prefetch.py).
 
 Functions:
 - _get_model: Function to get a language model based on the model name.
@@ -19,35 +21,33 @@ Functions:
 
 from functools import lru_cache
 from langchain_openai import ChatOpenAI
-from base_agent.utils.tools import SearchDataBase, agent_tools
+from base_agent.utils.replay import get_llm_cache
+from base_agent.utils.admission import openai_http_clients
+from base_agent.utils.deadline import dependency_timeout
+from base_agent.utils.tools import SearchDataBase, agent_tools, prefetch_retrieval, PREFETCH_KEY
 from base_agent.utils.prompts import agent_system_prompt_de
 from langgraph.prebuilt import ToolNode
 from langchain_core.messages import AIMessage, ToolMessage
-from langfuse.callback import CallbackHandler
-
-# Initialize the callback handler for logging and monitoring
-# can be disabled by removing the callback handler from the node "call_agent_model"
-langfuse_handler = CallbackHandler(
-    secret_key="",
-    public_key="",
-    host="https://cloud.langfuse.com", # 🇪🇺 EU region
-)
+from base_agent.utils.tracing import get_callbacks, span
+from base_agent.utils.history import compact_history, history_settings
+from base_agent.utils.prefetch import speculative_retrieval_enabled, start_prefetch
+from langchain_core.messages import HumanMessage
 
 # Cache the model instances to avoid redundant initializations
 @lru_cache(maxsize=4)
 def _get_model(model_name: str):
     if model_name == "base":
-        llm = ChatOpenAI(temperature=0, model_name="gpt-4o", streaming=True)
+        llm = ChatOpenAI(temperature=0, model_name="gpt-4o", streaming=True, stream_usage=True, cache=get_llm_cache(), callbacks=get_callbacks(), timeout=dependency_timeout("llm"), **openai_http_clients())
         return llm
     elif model_name == "mini-t":
-        llm = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", streaming=True)
+        llm = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", streaming=True, stream_usage=True, cache=get_llm_cache(), callbacks=get_callbacks(), timeout=dependency_timeout("llm"), **openai_http_clients())
         model = llm.bind_tools([SearchDataBase], tool_choice="required")
         return model
     elif model_name == "mini":
-        llm = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", streaming=False)
+        llm = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", streaming=False, cache=get_llm_cache(), callbacks=get_callbacks(), timeout=dependency_timeout("llm"), **openai_http_clients())
         return llm
     elif model_name == "agent":
-        llm = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", streaming=True)
+        llm = ChatOpenAI(temperature=0, model_name="gpt-4o-mini", streaming=True, stream_usage=True, cache=get_llm_cache(), callbacks=get_callbacks(), timeout=dependency_timeout("llm"), **openai_http_clients())
         model = llm.bind_tools(agent_tools)
         return model
 
@@ -57,8 +57,6 @@ def agent_route(state):
     last_message = messages[-1]
     # If there are no tool calls, then we finish
 
-    print(last_message)
-
     # Case 1: No tool call
     if not last_message.tool_calls:
         return "end"
@@ -74,15 +72,30 @@ def agent_route(state):
     
 
 # Define the function that calls the model
-def call_agent_model(state):
+def call_agent_model(state, config=None):
     messages = state["messages"]
+
+    # Speculative retrieval of the user message, overlapping with the routing call below
+    if speculative_retrieval_enabled() and isinstance(messages[-1], HumanMessage):
+        thread_id = ((config or {}).get("configurable") or {}).get("thread_id")
+        start_prefetch(thread_id, str(messages[-1].content), prefetch_retrieval, key=PREFETCH_KEY)
+
+    # Replace old tool outputs by compact citations once the history exceeds the token threshold
+    max_tokens, keep_turns = history_settings(config)
+    with span("history.compact", max_tokens=max_tokens, keep_turns=keep_turns) as compact_span:
+        compacted = compact_history(messages, max_tokens, keep_turns)
+        compact_span.set("compacted", len(compacted))
+    if compacted:
+        replacements = {message.id: message for message in compacted}
+        messages = [replacements.get(message.id, message) for message in messages]
+
     messages = [{"role": "system", "content": agent_system_prompt_de}] + messages
     #model_name = config.get('configurable', {}).get("model_name", "anthropic")
     model_name = 'agent'
     model = _get_model(model_name)
-    response = model.invoke(messages, config={"callbacks": [langfuse_handler]})
-    # We return a list, because this will get added to the existing list
-    return {"messages": [response]}
+    response = model.invoke(messages)
+    # We return a list, because this will get added to the existing list. Compacted messages replace the originals (same id).
+    return {"messages": compacted + [response]}
 
 
 # Define node that extracts the task from the tool call
@@ -90,7 +103,6 @@ def extract_task(state):
     messages = state["messages"]
     last_message = messages[-1]
     task = last_message.tool_calls[-1]['args']['task']
-    print(task)
     tool_id = last_message.tool_calls[0]['id']
 
     return {"task": task, "messages": [ToolMessage(content="Invoking the Expert Model with task: " + str(task), tool_call_id=tool_id, role="ai")]}
@@ -0,0 +1,251 @@
+"""
+This module provides the partitioning of the corpus by standard and the routing of retrieval queries to the partitions.
+
+Every loaded standard (e.g. 'DIN 1993-1-3', a Eurocode part or a national annex) is a partition: at ingestion time (see `markdown_ingestion.ipynb`), the nodes below its document root get a partition label, and the partition gets its own full-text indexes (titles, chunk contents) and vector index over the embeddings of its chunks. A `Standard` node in the graph holds the catalogue entry of each partition (category, title, aliases, index names).
+
+A query is routed to the relevant partitions:
+- by the `category` chosen by the model (SearchDataBase tool), if it is a loaded standard
+- otherwise by the standard numbers mentioned in the query (e.g. 'DIN EN 1991-1-3', 'Eurocode 1' -> 1991)
+- otherwise to all partitions
+
+The partitions of a query are searched in parallel (each with its own lexical and vector leg, see `RRFGraphQuery`) and the rankings are merged with the reciprocal rank fusion, so the latency depends on the slowest partition instead of the size of the whole corpus. A partition whose search fails or exceeds the request deadline is dropped from the merge (see deadline.py), the query fails only if no partition returns a ranking. The in-process backends (local vector index, BM25) restrict their search to the partition by its category.
+
+Configuration through environment variables:
+- NORMGRAPH_PARTITIONS: '1' enables the partitioned search (default: disabled, one index over the whole corpus)
+- NORMGRAPH_PARTITION_WORKERS: threads searching partitions in parallel (default: 8)
+- NORMGRAPH_STANDARDS: categories offered to the model by the SearchDataBase tool (default: 'DIN 1993-1-3')
+
+Modules and Classes:
+- Standard: Class holding the catalogue entry of a partition.
+
+Functions:
+- partitions_enabled: Function returning whether the partitioned search is enabled.
+- known_categories: Function returning the categories of the SearchDataBase tool.
+- create_partition: Function labelling a document as partition and creating its indexes (ingestion).
+- load_catalogue: Function returning the catalogue of the loaded standards.
+- route_partitions: Function returning the partitions of a query.
+- search_partitions: Function searching partitions in parallel and merging their rankings.
+"""
+
+import contextvars
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+
+from base_agent.utils.deadline import DeadlineExceeded, degrade, remaining_budget
+from base_agent.utils.embedders import VOYAGE_MODEL
+from base_agent.utils.tracing import span
+
+EMBEDDING_DIMENSIONS = 1024
+CATALOGUE_REFRESH_S = 300
+
+_NUMBER = re.compile(r"\b(\d{3,5}(?:-\d+)*)\b")
+_EUROCODE = re.compile(r"\b(?:eurocode|ec)\s*(\d)\b", re.IGNORECASE)
+
+LABEL_CYPHER = """
+MATCH (node)-[:PART_OF*0..]->(root {id: $rootId})
+WITH collect(DISTINCT node) AS nodes
+CALL apoc.create.addLabels(nodes, [$label]) YIELD node
+RETURN count(node) AS nodes
+"""
+
+# the partition vector indexes hold the VoyageAI embeddings only, the embeddings of other models have their own label and index (see embedders.py)
+LABEL_EMBEDDINGS_CYPHER = """
+MATCH (chunk)-[:PART_OF*1..]->(root {id: $rootId})
+MATCH (chunk)-[:HAS_EMBEDDING]->(embedding:Embedding)
+WHERE embedding.model = $model
+WITH collect(DISTINCT embedding) AS embeddings
+CALL apoc.create.addLabels(embeddings, [$label]) YIELD node
+RETURN count(node) AS embeddings
+"""
+
+CATALOGUE_CYPHER = """
+MERGE (standard:Standard {category: $category})
+SET standard.slug = $slug, standard.title = $title, standard.aliases = $aliases, standard.label = $label,
+    standard.root_ids = apoc.coll.toSet(coalesce(standard.root_ids, []) + [$rootId])
+"""
+
+LOAD_CATALOGUE_CYPHER = """
+MATCH (standard:Standard)
+RETURN standard.category AS category, standard.slug AS slug, standard.title AS title, standard.aliases AS aliases
+ORDER BY standard.category
+"""
+
+
+class Standard(namedtuple("Standard", ["category", "slug", "title", "aliases"])):
+    """Catalogue entry of a partition. The index names are derived from the slug of its category."""
+
+    @property
+    def label(self):
+        return partition_label(self.slug)
+
+    @property
+    def title_index(self):
+        return f"titles-{self.slug}"
+
+    @property
+    def content_index(self):
+        return f"chunk-content-{self.slug}"
+
+    @property
+    def vector_index(self):
+        return f"content-embeddings-vo-{self.slug}"
+
+    def numbers(self):
+        """Standard numbers of the category and the aliases, e.g. {'1993-1-3'}."""
+        return {number for text in (self.category, *(self.aliases or ())) for number in _NUMBER.findall(text)}
+
+
+def partitions_enabled():
+    return os.environ.get("NORMGRAPH_PARTITIONS", "").lower() in ("1", "true", "yes")
+
+
+def known_categories():
+    """Categories offered to the model by the SearchDataBase tool, 'Other' searches without a category."""
+    categories = [category.strip() for category in os.environ.get("NORMGRAPH_STANDARDS", "DIN 1993-1-3").split(",") if category.strip()]
+    return categories + ["Other"]
+
+
+def partition_slug(category):
+    # 'DIN EN 1991-1-3/NA' -> 'din-en-1991-1-3-na'
+    return re.sub(r"[^a-z0-9]+", "-", category.lower()).strip("-")
+
+
+def partition_label(slug):
+    return "Partition_" + slug.replace("-", "_")
+
+
+#----------------- Partitioning (ingestion) -----------------#
+def create_partition(driver, category, root_id, title=None, aliases=()):
+    """
+    Labels the nodes of a document (and the embeddings of its chunks) as partition of its standard, creates the indexes of the partition and registers it in the catalogue.
+
+    Args:
+    driver: The neo4j driver.
+    category (str): The standard of the document, e.g. 'DIN 1993-1-3'. Documents of the same standard (e.g. a national annex) can share a partition.
+    root_id (str): Id of the document root node.
+    title (str): Title of the standard in the catalogue.
+    aliases (list): Further names of the standard used by the query router, e.g. ['EN 1993-1-3', 'Eurocode 3 Teil 1-3'].
+
+    Returns:
+    Standard: The catalogue entry of the partition.
+    """
+    standard = Standard(category, partition_slug(category), title or category, list(aliases))
+    with span("partitions.create", category=category):
+        driver.execute_query(LABEL_CYPHER, rootId=root_id, label=standard.label)
+        driver.execute_query(LABEL_EMBEDDINGS_CYPHER, rootId=root_id, label=standard.label, model=VOYAGE_MODEL)
+        # index and label names cannot be parameters, they are derived from the slug (only [a-z0-9-_])
+        driver.execute_query(f"CREATE FULLTEXT INDEX `{standard.title_index}` IF NOT EXISTS FOR (n:{standard.label}) ON EACH [n.title] "
+                             "OPTIONS {indexConfig: {`fulltext.analyzer`: 'german'}}")
+        driver.execute_query(f"CREATE FULLTEXT INDEX `{standard.content_index}` IF NOT EXISTS FOR (n:{standard.label}) ON EACH [n.content] "
+                             "OPTIONS {indexConfig: {`fulltext.analyzer`: 'german'}}")
+        driver.execute_query(f"CREATE VECTOR INDEX `{standard.vector_index}` IF NOT EXISTS FOR (n:{standard.label}) ON (n.value) "
+                             f"OPTIONS {{indexConfig: {{`vector.dimensions`: {EMBEDDING_DIMENSIONS}, `vector.similarity_function`: 'cosine'}}}}")
+        driver.execute_query(CATALOGUE_CYPHER, category=category, slug=standard.slug, title=standard.title, aliases=standard.aliases,
+                             label=standard.label, rootId=root_id)
+    _catalogue.clear()
+    return standard
+
+
+#----------------- Catalogue and routing -----------------#
+class _Catalogue:
+    # catalogue of the loaded standards, reloaded every CATALOGUE_REFRESH_S seconds
+    def __init__(self):
+        self.standards = None
+        self.loaded = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, driver):
+        with self._lock:
+            if self.standards is None or time.monotonic() - self.loaded > CATALOGUE_REFRESH_S:
+                records, _, _ = driver.execute_query(LOAD_CATALOGUE_CYPHER)
+                self.standards = [Standard(record["category"], record["slug"], record["title"], record["aliases"] or []) for record in records]
+                self.loaded = time.monotonic()
+            return self.standards
+
+    def clear(self):
+        with self._lock:
+            self.standards = None
+
+
+_catalogue = _Catalogue()
+
+
+def load_catalogue(driver):
+    """Returns the catalogue of the loaded standards (cached)."""
+    return _catalogue.get(driver)
+
+
+def query_numbers(query):
+    """Standard numbers mentioned in a query, 'Eurocode 3' / 'EC3' count as 1993."""
+    numbers = set(_NUMBER.findall(query))
+    numbers.update(f"199{part}" for part in _EUROCODE.findall(query))
+    return numbers
+
+
+def route_partitions(query, category, catalogue):
+    """
+    Returns the partitions to search for a query and how they were chosen ('category', 'query' or 'all').
+    A number in the query selects the standards with the same number or a more specific one ('1993' selects 'DIN 1993-1-3').
+    """
+    if category:
+        chosen = [standard for standard in catalogue if standard.category == category or standard.slug == partition_slug(category)]
+        if chosen:
+            return chosen, "category"
+    numbers = query_numbers(query)
+    if numbers:
+        chosen = [standard for standard in catalogue
+                  if any(own == number or own.startswith(number + "-") for own in standard.numbers() for number in numbers)]
+        if chosen:
+            return chosen, "query"
+    return list(catalogue), "all"
+
+
+@lru_cache(maxsize=1)
+def _executor():
+    return ThreadPoolExecutor(max_workers=int(os.environ.get("NORMGRAPH_PARTITION_WORKERS", "8")), thread_name_prefix="partition")
+
+
+def search_partitions(partitions, search, merge):
+    """
+    Searches the partitions in parallel and merges their rankings.
+
+    Args:
+    partitions (list): The partitions (Standard) to search.
+    search (callable): Function partition -> ranked dict of section ids (e.g. `RRFGraphQuery` restricted to the partition).
+    merge (callable): Function merging the rankings {category: [section ids]} into one ranked dict.
+
+    Returns:
+    dict: The merged ranking of the partitions searched in time, at most as long as the longest partition ranking.
+
+    Raises:
+    DeadlineExceeded: If no partition search finished within the request deadline (or the error of the failed searches).
+    """
+    if len(partitions) == 1:
+        return search(partitions[0])
+    # the context is copied, so the spans, the request deadline and the priority reach the worker threads
+    futures = [_executor().submit(contextvars.copy_context().run, search, partition) for partition in partitions]
+    remaining = remaining_budget()
+    done, _ = wait(futures, timeout=None if remaining is None else max(remaining, 0.0))
+    rankings, errors = {}, []
+    for partition, future in zip(partitions, futures):
+        if future not in done:
+            # the search finishes in the background, its ranking is discarded
+            future.cancel()
+            degrade("partition")
+        elif future.exception() is not None:
+            errors.append(future.exception())
+            degrade("partition")
+        else:
+            rankings[partition.category] = list(future.result().keys())
+    if not rankings:
+        raise errors[0] if errors else DeadlineExceeded("no partition search finished within the request deadline")
+    with span("partitions.merge", partitions=len(rankings)):
+        merged = merge(rankings)
+    # the merged ranking is cut to the size of a single partition ranking, so the context doesn't grow with the number of partitions
+    limit = max((len(ranking) for ranking in rankings.values()), default=0)
+    return dict(list(merged.items())[:limit])
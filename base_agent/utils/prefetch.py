@@ -0,0 +1,108 @@
+"""
+This module provides the speculative retrieval of the agent node.
+
+For factual questions the agent model first routes the turn to `DocumentSearch`, only then the `DocumentRetriever` tool embeds its query and searches the graph. With speculative retrieval enabled, `call_agent_model` starts the hybrid ranking for the raw user message in a background thread the moment the turn starts, so the query embedding and the graph searches overlap with the routing call of the model. The pending ranking is held in a slot per thread (conversation).
+
+The first `DocumentRetriever` call of the turn takes the slot: if it asks for the same number of results and its query is close enough to the user message (share of the query's stemmed terms contained in the message), the speculative ranking is used and only the context of its sections is rendered, otherwise it is discarded and the query is retrieved as usual. The data type filter of the tool call (NORMGRAPH_RETRIEVAL_FILTERS, see filters.py) is only known after the routing call, so the ranking is retrieved without filter and the filter is applied to the ranked sections when the slot is taken (`filter_ranking`). With filters enabled, matching sections that rank below the unfiltered candidates are therefore missed, NORMGRAPH_RETRIEVAL_FILTERS=0 keeps the speculative and the regular retrieval identical. Waiting for a pending speculative result is bounded by the request deadline. Slots that are not taken are replaced by the next turn or expire.
+
+Configuration through environment variables:
+- NORMGRAPH_SPECULATIVE_RETRIEVAL: '1' enables the speculative retrieval (default: disabled)
+- NORMGRAPH_PREFETCH_MIN_SIMILARITY: minimum share of query terms contained in the user message (default: 0.6)
+- NORMGRAPH_PREFETCH_WORKERS: threads running speculative retrievals (default: 4)
+
+Functions:
+- speculative_retrieval_enabled: Function returning whether speculative retrieval is enabled.
+- query_similarity: Function comparing an issued query with the prefetched text.
+- start_prefetch: Function starting the speculative retrieval of a thread.
+- take_prefetch: Function returning the speculative result of a thread if it matches the issued query.
+- run_in_background: Function running a function on the prefetch threads (e.g. the early dispatch of plan steps).
+"""
+
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from functools import lru_cache
+
+from base_agent.utils.deadline import DeadlineExceeded, remaining_budget
+from base_agent.utils.lexical import tokenize
+from base_agent.utils.tracing import span
+
+SLOT_TTL_S = 120
+
+_slots = {}
+_lock = threading.Lock()
+
+
+def speculative_retrieval_enabled():
+    return os.environ.get("NORMGRAPH_SPECULATIVE_RETRIEVAL", "").lower() in ("1", "true", "yes")
+
+
+@lru_cache(maxsize=1)
+def _executor():
+    return ThreadPoolExecutor(max_workers=int(os.environ.get("NORMGRAPH_PREFETCH_WORKERS", "4")), thread_name_prefix="prefetch")
+
+
+def query_similarity(query, text):
+    """Share of the stemmed terms of `query` that are contained in `text` (the issued query is usually a shortened reformulation of the user message)."""
+    query_terms = set(tokenize(query))
+    if not query_terms:
+        return 0.0
+    return len(query_terms & set(tokenize(text))) / len(query_terms)
+
+
+def start_prefetch(thread_id, text, retrieve, key=None):
+    """
+    Starts the speculative retrieval `retrieve(text)` for a thread in the background, replacing a previous slot of the thread.
+    `key` identifies the retrieval parameters (e.g. number of results and filter), only a retrieval with the same key takes the result.
+    """
+    if thread_id is None or not text:
+        return
+    now = time.monotonic()
+    with _lock:
+        for stale in [thread for thread, (_, _, _, started) in _slots.items() if now - started > SLOT_TTL_S]:
+            del _slots[stale]
+    # the context is copied, so the span of the retrieval is a child of the current node span
+    future = _executor().submit(contextvars.copy_context().run, _run, text, retrieve)
+    with _lock:
+        _slots[thread_id] = (text, key, future, now)
+
+
+def run_in_background(func, *args):
+    """Runs `func(*args)` on the prefetch threads with the current context (tracing spans). Returns the future."""
+    return _executor().submit(contextvars.copy_context().run, func, *args)
+
+
+def _run(text, retrieve):
+    with span("prefetch.retrieve"):
+        return retrieve(text)
+
+
+def take_prefetch(thread_id, query, key=None):
+    """
+    Takes the slot of a thread. Returns the speculative result if it was retrieved with the same `key` and `query` is close enough to the prefetched text, otherwise None.
+
+    Raises:
+    DeadlineExceeded: If the speculative result is not ready within the remaining budget of the request.
+    """
+    with _lock:
+        slot = _slots.pop(thread_id, None) if thread_id is not None else None
+    if slot is None:
+        return None
+
+    text, slot_key, future, _ = slot
+    similarity = query_similarity(query, text)
+    hit = slot_key == key and similarity >= float(os.environ.get("NORMGRAPH_PREFETCH_MIN_SIMILARITY", "0.6"))
+    with span("prefetch.take", hit=hit, similarity=round(similarity, 3), key_match=slot_key == key) as take_span:
+        if not hit:
+            future.cancel()
+            return None
+        try:
+            # the speculative retrieval started earlier, waiting for it is never slower than retrieving again
+            return future.result(timeout=remaining_budget())
+        except FutureTimeout:
+            raise DeadlineExceeded("speculative retrieval exceeded the request deadline")
+        except Exception as error:
+            take_span.record_error(error)
+            return None
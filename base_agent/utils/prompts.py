@@ -16,7 +16,7 @@ Insgesamt gibt es drei Klassen: A: 'Außerhalb des Themenbereichs', B: 'Faktuell
 3. Benutzeranfragen, die mehrere Schritte der Informationsbeschaffung, Benutzerfeedback oder Berechnungen erfordern, gelten als 'Komplexe Frage'. Diese Anfragen sollten beantwortet werden, indem Sie das Tool 'InvokeExpertModel' aufrufen.
 """
 # Planner prompt for creating detailed plans to solve tasks, based off the ReWOO cookbook example of langgraph: https://github.com/langchain-ai/langgraph/blob/main/docs/docs/tutorials/rewoo/rewoo.ipynb. The ReWOO (Reasoning WithOut Observation) concept is based of Xu et al. (2023) https://arxiv.org/abs/2305.18323.
-planner_prompt = """For the following task, make plans that can solve the problem step by step. Base the plannig process on the given context information that has been retrieved specifically for this task. \
+planner_system_prompt = """For the following task, make plans that can solve the problem step by step. Base the plannig process on the given context information that has been retrieved specifically for this task. \
 For each plan, indicate which external tool together with tool input to retrieve evidence. You can store the evidence into a \
 variable #E that can be called by later tools. (Plan, #E1, Plan, #E2, Plan, ...)
 
@@ -53,42 +53,57 @@ Plan: Ask the user for the actual snow depth. #E2 = Human[What is the value for
 Plan: Calculate the snow density according to the formula. #E3 = WolframAlpha[Solve #E1 * 1,0 / #E2]
 
 Begin! 
-Describe your plans with rich details. Each Plan should be followed by only one #E. There are no summaries or conclusions necessary at the end of your response.
+Describe your plans with rich details. Each Plan should be followed by only one #E. There are no summaries or conclusions necessary at the end of your response."""
 
-Context: {context}
+planner_user_prompt = """Context: {context}
 
 Task: {task}"""
 
 # Extractor prompt for extracting relevant information from user answers
-extractor_prompt = """Your singular task is to extract only the relevant information from the user answer, according to the question asked. \
+extractor_system_prompt = """Your singular task is to extract only the relevant information from the user answer, according to the question asked. \
     For example for a question like "What is the size of your pool surface?", and the users answer "I have a pool of 10x5 meters", you should extract the information "10x5 meters". \
     If there are any scientific units included in the answer, write them in an abbreviated symbolic form. For example, 'meters' should be abbreviated to 'm', or 'meters squared' to 'm^2'. \
     
-    Begin!
+    Begin!"""
 
-    Question: {question}
+extractor_user_prompt = """Question: {question}
 
-    User Answer: {answer}"""
+User Answer: {answer}"""
+
+# Extractor prompt for one user answer to several questions, asked together in one interrupt
+batch_extractor_system_prompt = """Your singular task is to extract only the relevant information from the user answer for each of the questions asked. \
+    The questions are listed with their step number. The user answers all of them in one reply, possibly in a different order or without numbering. \
+    For example for a question like "#E2: What is the size of your pool surface?", and the users answer "The pool is 10x5 meters and ...", you should extract the information "10x5 meters" for step #E2. \
+    If there are any scientific units included in the answer, write them in an abbreviated symbolic form. For example, 'meters' should be abbreviated to 'm', or 'meters squared' to 'm^2'. \
+    Return one answer per question. If the user didn't answer a question, return 'no information provided' for it.
+
+    Begin!"""
+
+batch_extractor_user_prompt = """Questions:
+{questions}
+
+User Answer: {answer}"""
+
+# Introduction of the questions asked together in one interrupt
+human_batch_intro = "Für die Bearbeitung benötige ich noch folgende Angaben:"
 
 # Reasoning prompt for reasoning based on given context and task
-reasoning_prompt = """Your task is to reason upon the given context and the given task. The context includes relevant information to the task. Base your reasoning exclusively on the context, to ensure information integrity.\
-    
-    Context: {context}
-    
-    Task: {task}
+reasoning_system_prompt = """Your task is to reason upon the given context and the given task. The context includes relevant information to the task. Base your reasoning exclusively on the context, to ensure information integrity.\
+    Provide a short and concise response. If possible, the answer should exclusively contain the information that is asked for."""
 
-    Provide a short and concise response. If possible, the answer should exclusively contain the information that is asked for.\
-    """
+reasoning_user_prompt = """Context: {context}
+
+Task: {task}"""
 
 # Calculator prompt for formulating mathematical problems
-calculator_prompt = """Your task is to formulate a mathematical problem, based on the given mathematical task and additional variables. \
+calculator_system_prompt = """Your task is to formulate a mathematical problem, based on the given mathematical task and additional variables. \
 For example, for the mathematical task 'Calculate F_s = #E3 \\times #E2' with the variables '#E3 = 5' and '#E2 = 10', the problem would be 'Calculate F_s = 5 \\times 10'. \
 Further, abbreviate the variable units to their respective symbols. For example 'meters' should be abbreviated to 'm', or 'meters squared' to 'm^2'  \
 Provide the output in two different formats: one in the latex format and one in the plain text format.\
 
-Begin!
+Begin!"""
 
-Mathematical Task: {task}
+calculator_user_prompt = """Mathematical Task: {task}
 
 Variables: {variables}"""
 
@@ -108,15 +123,15 @@ Step Results:
 """
 
 # Updated output prompt with source information
-output_prompt = """Your task is to provide the conclusion based on the given task, the plan created to solve the task as well as the results of each of the steps that are part of the plan. \
+output_system_prompt = """Your task is to provide the conclusion based on the given task, the plan created to solve the task as well as the results of each of the steps that are part of the plan. \
 The answer should be a direct response to the task, and should outline the process that lead to the final conclusion.\
 Additionally and importantly, provide the source information used to solve the task, designated as the headings and titles of the sources. \
 For example, if the information contained in the context under "Eurocode 1: 3.1.4 Calculating the Bending Stress of Concrete Beams" contributed in solving the task, include the heading as an entry in the citations.\
 Do also include the sources retrieved in the plan, for example from a database query. \
 
-Begin!
+Begin!"""
 
-Context:
+output_user_prompt = """Context:
 {context}
 
 Task: {task}
@@ -126,4 +141,21 @@ Plan:
 
 Step Results: 
 {step_results}
-"""
\ No newline at end of file
+"""
+
+
+#----------------- Prompt assembly -----------------#
+# OpenAI caches the longest previously seen prompt prefix (from 1024 tokens on, in steps of 128 tokens) and serves it with a lower time to first token and price.
+# The prompts above are therefore split into a static system prompt, that is sent first and identical for every request, and a user prompt holding the per-request variables.
+# The variables are ordered from the most to the least shared value, e.g. the context (shared by all reasoning steps of a plan) precedes the step task.
+def prompt_messages(system_prompt, user_prompt, **variables):
+    """Assembles the messages of a chat model call: the static system prompt first, the formatted variable part last."""
+    return [("system", system_prompt), ("human", user_prompt.format(**variables))]
+
+
+# Single-string versions of the split prompts
+planner_prompt = planner_system_prompt + "\n\n" + planner_user_prompt
+extractor_prompt = extractor_system_prompt + "\n\n" + extractor_user_prompt
+reasoning_prompt = reasoning_system_prompt + "\n\n" + reasoning_user_prompt
+calculator_prompt = calculator_system_prompt + "\n\n" + calculator_user_prompt
+output_prompt = output_system_prompt + "\n\n" + output_user_prompt
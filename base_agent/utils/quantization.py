@@ -0,0 +1,247 @@
+"""
+This module provides quantised embedding storage and a two-stage vector search on top of it.
+
+At ingestion time (see `voyage_embed.ipynb`), every embedding additionally gets compact codes stored on its `Embedding` node:
+- value_int8 / int8_scale: int8 codes with a per-vector scale (1 byte per dimension instead of 4)
+- value_bin: sign bits packed into bytes (1 bit per dimension)
+
+The quantised index loads only these codes into memory. A query first runs a fast candidate pass over the codes (dot product for int8, hamming distance for binary codes), optionally on the first `dim` dimensions only (Matryoshka truncation). Only the top `k * oversample` candidates are rescored with their full-precision vectors, fetched from the graph by id.
+
+Configuration through environment variables (the index replaces the local float mirror of vector_index.py when set):
+- NORMGRAPH_VECTOR_QUANTIZATION: '' (disabled, default), 'int8' or 'binary'
+- NORMGRAPH_VECTOR_TRUNCATE_DIM: number of leading dimensions used by the candidate pass (default: all)
+- NORMGRAPH_VECTOR_OVERSAMPLE: candidates per requested result that are rescored (default: 4)
+
+Note: voyage-multilingual-2 is not trained for Matryoshka truncation, so truncated candidate passes need a larger oversampling factor. `helper_notebooks_benchmark/quantization_eval.py` reports memory and recall of each setting against the float index.
+
+Modules and Classes:
+- QuantizedIndex: Class holding the codes and performing the two-stage search.
+
+Functions:
+- configured_quantization: Function returning the configured quantisation kind, truncation and oversampling.
+- quantize_int8: Function computing int8 codes with per-vector scales.
+- quantize_binary: Function computing packed sign bits.
+- truncate: Function truncating and re-normalizing vectors.
+- to_storage: Function computing the node properties stored at ingestion.
+"""
+
+import os
+
+import numpy as np
+
+from base_agent.utils.embedders import embedding_label
+from base_agent.utils.tracing import span
+from base_agent.utils.vector_index import PAGE_SIZE, VECTOR_MODEL, filtered_rows
+
+BLOCK_SIZE = 20000
+
+# number of set bits of every byte value, used for the hamming distance of packed codes
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+# formatted with the label of the embedding nodes of the model (see embedders.py)
+CODES_PAGE_CYPHER = """
+MATCH (chunk)-[:HAS_EMBEDDING]->(e:{label})
+WHERE e.model = $model
+MATCH (chunk)-[:PART_OF]->(section)
+RETURN e.id AS embedding_id, e.value_int8 AS int8, e.int8_scale AS scale, e.value_bin AS bin,
+       CASE WHEN e.value_int8 IS NULL OR e.value_bin IS NULL THEN e.value END AS value,
+       chunk.id AS chunk_id, section.id AS section_id, section.title AS title, chunk.data_types AS data_types, chunk.category AS category
+ORDER BY e.id
+SKIP $skip LIMIT $limit
+"""
+
+VECTORS_CYPHER = """
+MATCH (e:{label}) WHERE e.id IN $ids
+RETURN e.id AS id, e.value AS value
+"""
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / (np.linalg.norm(vectors, axis=-1, keepdims=True) + 1e-12)
+
+
+def truncate(vectors, dim):
+    """Keeps the first `dim` dimensions (Matryoshka truncation) and re-normalizes the vectors."""
+    return _normalize(np.asarray(vectors, dtype=np.float32)[..., :dim])
+
+
+def quantize_int8(vectors):
+    """Symmetric int8 quantisation with one scale per vector: vector ~= codes * scale."""
+    vectors = _normalize(np.atleast_2d(vectors))
+    scales = np.abs(vectors).max(axis=1) / 127.0 + 1e-12
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def quantize_binary(vectors):
+    """Binary quantisation: the sign bit of every dimension, packed into bytes."""
+    return np.packbits(np.atleast_2d(vectors) > 0, axis=1)
+
+
+def to_storage(embedding):
+    """
+    Computes the quantised properties of an `Embedding` node at ingestion time.
+
+    Returns:
+    dict: {'value_int8': bytes, 'int8_scale': float, 'value_bin': bytes}
+    """
+    codes, scales = quantize_int8(embedding)
+    return {
+        "value_int8": codes[0].tobytes(),
+        "int8_scale": float(scales[0]),
+        "value_bin": quantize_binary(embedding)[0].tobytes(),
+    }
+
+
+def _as_bytes(value):
+    # the neo4j driver returns byte arrays as bytes, older nodes may store lists of ints
+    return value if isinstance(value, (bytes, bytearray)) else bytes(np.asarray(value, dtype=np.uint8))
+
+
+class QuantizedIndex:
+    """Two-stage vector search: candidate pass over int8 or binary codes, rescoring of the top candidates with the full-precision vectors."""
+
+    def __init__(self, codes, scales, embedding_ids, chunk_ids, section_ids, titles, kind, driver=None, dim=None, oversample=4, data_types=None, categories=None, model=VECTOR_MODEL):
+        self.codes = codes
+        self.scales = scales
+        self.embedding_ids = embedding_ids
+        self.chunk_ids = chunk_ids
+        self.section_ids = section_ids
+        self.titles = titles
+        self.kind = kind
+        self.driver = driver
+        self.dim = dim
+        self.oversample = oversample
+        self.version = None
+        self.data_types = data_types if data_types is not None else [None] * len(chunk_ids)
+        self.categories = categories if categories is not None else [None] * len(chunk_ids)
+        self.label = embedding_label(model)
+        self._allowed = {}
+
+    @classmethod
+    def load(cls, driver, kind, dim=None, oversample=4, model=VECTOR_MODEL):
+        """Loads the codes of all embeddings of `model` from the graph. Embeddings without stored codes are quantised while loading."""
+        code_pages, scale_pages = [], []
+        embedding_ids, chunk_ids, section_ids, titles, data_types, categories = [], [], [], [], [], []
+        skip = 0
+        while True:
+            records, _, _ = driver.execute_query(CODES_PAGE_CYPHER.format(label=embedding_label(model)), model=model, skip=skip, limit=PAGE_SIZE)
+            if not records:
+                break
+            for record in records:
+                if record["value"] is not None:
+                    stored = to_storage(record["value"])
+                    int8, scale, binary = stored["value_int8"], stored["int8_scale"], stored["value_bin"]
+                else:
+                    int8, scale, binary = record["int8"], record["scale"], record["bin"]
+                if kind == "int8":
+                    code_pages.append(np.frombuffer(_as_bytes(int8), dtype=np.int8))
+                    scale_pages.append(scale)
+                else:
+                    code_pages.append(np.frombuffer(_as_bytes(binary), dtype=np.uint8))
+                embedding_ids.append(record["embedding_id"])
+                chunk_ids.append(record["chunk_id"])
+                section_ids.append(record["section_id"])
+                titles.append(record["title"])
+                data_types.append(record["data_types"])
+                categories.append(record["category"])
+            skip += PAGE_SIZE
+
+        codes = np.vstack(code_pages) if code_pages else np.zeros((0, 1024 if kind == "int8" else 128), dtype=np.int8 if kind == "int8" else np.uint8)
+        scales = np.asarray(scale_pages, dtype=np.float32) if kind == "int8" else None
+        return cls(codes, scales, embedding_ids, chunk_ids, section_ids, titles, kind, driver, dim, oversample, data_types, categories, model)
+
+    @classmethod
+    def from_vectors(cls, vectors, embedding_ids, chunk_ids, section_ids, titles, kind, driver=None, dim=None, oversample=4):
+        """Builds the index from float vectors (e.g. the local float mirror), used for evaluations."""
+        codes, scales = [], []
+        for i in range(0, len(vectors), BLOCK_SIZE):
+            block = np.asarray(vectors[i:i + BLOCK_SIZE])
+            if kind == "int8":
+                block_codes, block_scales = quantize_int8(block)
+                codes.append(block_codes)
+                scales.append(block_scales)
+            else:
+                codes.append(quantize_binary(block))
+        return cls(np.vstack(codes), np.concatenate(scales) if scales else None, embedding_ids, chunk_ids, section_ids, titles, kind, driver, dim, oversample)
+
+    def memory_bytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def candidates(self, query, n, allowed=None):
+        """Candidate pass over the codes: returns the rows of the n best candidates, only among the `allowed` rows if given."""
+        subset = allowed[0] if allowed is not None else None
+        count = len(subset) if subset is not None else len(self.chunk_ids)
+        n = min(n, count)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        scores = np.empty(count, dtype=np.float32)
+
+        def block(values, i):
+            return values[i:i + BLOCK_SIZE] if subset is None else values[subset[i:i + BLOCK_SIZE]]
+
+        if self.kind == "int8":
+            dim = self.dim or self.codes.shape[1]
+            query_part = query[:dim]
+            for i in range(0, count, BLOCK_SIZE):
+                scores[i:i + BLOCK_SIZE] = (block(self.codes, i)[:, :dim].astype(np.float32) @ query_part) * block(self.scales, i)
+        else:
+            width = (self.dim // 8) if self.dim else self.codes.shape[1]
+            query_bits = quantize_binary(query)[0][:width]
+            for i in range(0, count, BLOCK_SIZE):
+                # smaller hamming distance = more similar
+                scores[i:i + BLOCK_SIZE] = -POPCOUNT[np.bitwise_xor(block(self.codes, i)[:, :width], query_bits)].sum(axis=1, dtype=np.int32)
+
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top])]
+        return subset[top] if subset is not None else top
+
+    def rescore(self, query, rows, vectors=None):
+        """
+        Rescores candidate rows with their full-precision vectors, fetched from the graph by id unless `vectors` (row -> vector) is given.
+        """
+        if vectors is None:
+            ids = [self.embedding_ids[row] for row in rows]
+            with span("neo4j.rescore_vectors", candidates=len(ids)):
+                records, _, _ = self.driver.execute_query(VECTORS_CYPHER.format(label=self.label), ids=ids)
+            by_id = {record["id"]: record["value"] for record in records}
+            rows = np.asarray([row for row in rows if self.embedding_ids[row] in by_id], dtype=np.int64)
+            matrix = _normalize([by_id[self.embedding_ids[row]] for row in rows]) if len(rows) else np.zeros((0, len(query)), dtype=np.float32)
+        else:
+            matrix = _normalize(vectors[rows])
+        similarities = matrix @ query
+        order = np.argsort(-similarities)
+        return rows[order], similarities[order]
+
+    def top_chunks(self, query_vector, k, vectors=None, allowed=None):
+        """Returns the rows and cosine similarities of the k nearest chunks after rescoring."""
+        query = _normalize(query_vector)
+        with span("quantized.candidates", kind=self.kind, dim=self.dim or 0):
+            rows = self.candidates(query, k * self.oversample, allowed)
+        if not len(rows):
+            return rows, np.zeros(0, dtype=np.float32)
+        rows, similarities = self.rescore(query, rows, vectors)
+        return rows[:k], similarities[:k]
+
+    def search(self, query_vector, k, score_threshold, search_filter=None):
+        """Top-k search with the result shape and score normalization of `LocalVectorIndex.search`."""
+        rows, similarities = self.top_chunks(query_vector, k, allowed=filtered_rows(self, search_filter))
+        results = {}
+        for row, similarity in zip(rows, similarities):
+            score = float((1.0 + similarity) / 2.0)
+            if score <= score_threshold:
+                continue
+            section_id = self.section_ids[row]
+            if section_id not in results or results[section_id]["maxScore"] < score:
+                results[section_id] = {"title": self.titles[row], "id": section_id, "maxScore": score}
+        return list(results.values())
+
+
+def configured_quantization():
+    kind = os.environ.get("NORMGRAPH_VECTOR_QUANTIZATION", "").lower()
+    if kind and kind not in ("int8", "binary"):
+        raise ValueError(f"NORMGRAPH_VECTOR_QUANTIZATION must be 'int8' or 'binary', got '{kind}'")
+    dim = int(os.environ["NORMGRAPH_VECTOR_TRUNCATE_DIM"]) if os.environ.get("NORMGRAPH_VECTOR_TRUNCATE_DIM") else None
+    oversample = int(os.environ.get("NORMGRAPH_VECTOR_OVERSAMPLE", "4"))
+    return kind, dim, oversample
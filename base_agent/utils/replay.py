@@ -0,0 +1,269 @@
+"""
+This module provides a record/replay layer for the external dependencies of the application (OpenAI chat models, the OpenAI calculator Assistant, the VoyageAI embedding client and the neo4j driver).
+
+In record mode, the real responses are captured into a local fixture store. In replay mode, the recorded responses are returned without any network access, optionally delayed by a configurable synthetic latency. This allows deterministic, offline performance measurements of the application's own code (parsing, rank fusion, context rendering).
+
+The mode is configured through environment variables:
+- NORMGRAPH_REPLAY_MODE: 'off' (default), 'record' or 'replay'
+- NORMGRAPH_FIXTURE_DIR: directory of the fixture store (default: './fixtures')
+- NORMGRAPH_REPLAY_LATENCY_MS: synthetic latency in replay mode, either a single value for all dependencies (e.g. '50') or per dependency (e.g. 'llm=800,embedding=120,neo4j=15,assistant=3000')
+
+Modules and Classes:
+- FixtureStore: Class storing recorded responses as json-lines, one file per dependency.
+- FixtureLLMCache: LangChain cache recording and replaying chat model generations.
+- ReplayEmbeddingClient: Wrapper around the VoyageAI client.
+- ReplayDriver: Wrapper around the neo4j driver.
+- ReplayMissError: Raised in replay mode when no recording exists for a request.
+
+Functions:
+- replay_mode: Function returning the configured mode.
+- replayable: Function recording or replaying an arbitrary call.
+- get_llm_cache: Function returning the cache to attach to chat models (None if the layer is disabled).
+- embedding_client: Function wrapping the embedding client factory.
+- graph_driver: Function wrapping the neo4j driver.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from functools import lru_cache
+from types import SimpleNamespace
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+MODES = ("off", "record", "replay")
+
+
+class ReplayMissError(LookupError):
+    """Raised in replay mode if a request has not been recorded."""
+
+
+def replay_mode():
+    mode = os.environ.get("NORMGRAPH_REPLAY_MODE", "off").lower()
+    if mode not in MODES:
+        raise ValueError(f"NORMGRAPH_REPLAY_MODE must be one of {MODES}, got '{mode}'")
+    return mode
+
+
+def _parse_latencies(value):
+    # '50' -> {'*': 0.05}; 'llm=800,neo4j=15' -> {'llm': 0.8, 'neo4j': 0.015}
+    latencies = {}
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        if "=" in part:
+            kind, ms = part.split("=", 1)
+            latencies[kind.strip()] = float(ms) / 1000
+        else:
+            latencies["*"] = float(part) / 1000
+    return latencies
+
+
+def synthetic_latency(kind):
+    latencies = _parse_latencies(os.environ.get("NORMGRAPH_REPLAY_LATENCY_MS", ""))
+    return latencies.get(kind, latencies.get("*", 0.0))
+
+
+def fixture_key(*parts):
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class FixtureStore:
+    """Stores recorded responses as json-lines files (<kind>.jsonl) in the fixture directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _path(self, kind):
+        return os.path.join(self.directory, f"{kind}.jsonl")
+
+    def _load(self, kind):
+        if kind not in self._entries:
+            entries = {}
+            path = self._path(kind)
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as fixture_file:
+                    for line in fixture_file:
+                        if line.strip():
+                            entry = json.loads(line)
+                            entries[entry["key"]] = entry["value"]
+            self._entries[kind] = entries
+        return self._entries[kind]
+
+    def get(self, kind, key):
+        with self._lock:
+            entries = self._load(kind)
+            if key not in entries:
+                raise ReplayMissError(f"no recorded '{kind}' response for key {key[:12]}... in {self.directory}")
+            return entries[key]
+
+    def put(self, kind, key, value):
+        with self._lock:
+            self._load(kind)[key] = value
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(kind), "a", encoding="utf-8") as fixture_file:
+                fixture_file.write(json.dumps({"key": key, "value": value}, ensure_ascii=False, default=str) + "\n")
+
+    def entries(self, kind):
+        with self._lock:
+            return dict(self._load(kind))
+
+
+@lru_cache(maxsize=1)
+def get_store():
+    return FixtureStore(os.environ.get("NORMGRAPH_FIXTURE_DIR", "fixtures"))
+
+
+def replayable(kind, key_parts, call, encode=lambda value: value, decode=lambda value: value):
+    """
+    Records or replays the result of `call` depending on the configured mode.
+
+    Args:
+    kind (str): Name of the dependency (used for the fixture file and the synthetic latency).
+    key_parts (list): JSON-serializable request parameters identifying the call.
+    call (callable): Function performing the real request.
+    encode/decode (callable): Conversion of the result to/from a JSON-serializable value.
+    """
+    mode = replay_mode()
+    if mode == "off":
+        return call()
+
+    key = fixture_key(kind, key_parts)
+    if mode == "replay":
+        value = get_store().get(kind, key)
+        latency = synthetic_latency(kind)
+        if latency:
+            time.sleep(latency)
+        return decode(value)
+
+    result = call()
+    get_store().put(kind, key, encode(result))
+    return result
+
+
+#----------------- Chat models -----------------#
+def _strip_message_ids(value):
+    # message ids are random uuids assigned by the add_messages reducer and must not be part of the fixture key
+    if isinstance(value, dict):
+        return {k: _strip_message_ids(v) for k, v in value.items() if k != "id" or not isinstance(v, str)}
+    if isinstance(value, list):
+        return [_strip_message_ids(v) for v in value]
+    return value
+
+
+class FixtureLLMCache(BaseCache):
+    """LangChain cache recording (record mode) or replaying (replay mode) chat model generations."""
+
+    kind = "llm"
+
+    def _key(self, prompt, llm_string):
+        try:
+            prompt = _strip_message_ids(json.loads(prompt))
+        except ValueError:
+            pass
+        return fixture_key(self.kind, prompt, llm_string)
+
+    def lookup(self, prompt, llm_string):
+        if replay_mode() != "replay":
+            # always call the model while recording, so fixtures can be refreshed
+            return None
+        value = get_store().get(self.kind, self._key(prompt, llm_string))
+        latency = synthetic_latency(self.kind)
+        if latency:
+            time.sleep(latency)
+        return [loads(generation) for generation in value]
+
+    def update(self, prompt, llm_string, return_val):
+        if replay_mode() == "record":
+            get_store().put(self.kind, self._key(prompt, llm_string), [dumps(generation) for generation in return_val])
+
+    def clear(self, **kwargs):
+        pass
+
+
+def get_llm_cache():
+    """Returns the cache to attach to chat models, or None if the replay layer is disabled."""
+    if replay_mode() == "off":
+        return None
+    return FixtureLLMCache()
+
+
+#----------------- Embedding client -----------------#
+class ReplayEmbeddingClient:
+    """Wrapper around the VoyageAI client. The real client is only created when it is actually needed."""
+
+    kind = "embedding"
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._factory()
+        return self._client
+
+    def embed(self, texts, model=None, input_type=None, **kwargs):
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        embeddings = replayable(
+            self.kind,
+            [texts, model, input_type, kwargs],
+            lambda: self.client.embed(texts, model=model, input_type=input_type, **kwargs).embeddings,
+        )
+        return SimpleNamespace(embeddings=embeddings)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def embedding_client(factory):
+    """Creates the embedding client, wrapped by the replay layer if it is enabled."""
+    if replay_mode() == "off":
+        return factory()
+    return ReplayEmbeddingClient(factory)
+
+
+#----------------- Graph database driver -----------------#
+def _json_record(record):
+    # byte array properties (quantised embeddings) are stored as lists of ints
+    return {key: list(value) if isinstance(value, (bytes, bytearray)) else value for key, value in record.items()}
+
+
+class ReplayDriver:
+    """Wrapper around the neo4j driver, recording the records returned by `execute_query`."""
+
+    kind = "neo4j"
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    def execute_query(self, query, parameters_=None, **kwargs):
+        parameters = dict(parameters_ or {}, **kwargs)
+
+        def call():
+            records, summary, keys = self._driver.execute_query(query, parameters)
+            return [dict(record) for record in records], summary, list(keys)
+
+        records, summary, keys = replayable(
+            self.kind,
+            [query, parameters],
+            call,
+            encode=lambda result: {"records": [_json_record(record) for record in result[0]], "keys": result[2]},
+            decode=lambda value: (value["records"], None, value["keys"]),
+        )
+        return records, summary, keys
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+
+def graph_driver(driver):
+    """Wraps the neo4j driver with the replay layer if it is enabled."""
+    if replay_mode() == "off":
+        return driver
+    return ReplayDriver(driver)
@@ -0,0 +1,274 @@
+"""
+This module provides the section tree classes and the materialised section renderings of the graph.
+
+The retrieval context of a section consists of its ancestor headings, its title, its chunks (ordered by their sequence number) and the contents of the sections referenced by its chunks. Sections only change at ingestion time, so the ingestion pipeline (see `markdown_ingestion.ipynb`) stores the rendering of each section on its node:
+- rendered: the section title, its chunks and the referenced sections, rendered like `Section.render`
+- chunk_ids: the ids of its chunks in rendering order
+- ancestor_ids / ancestor_nums / ancestor_titles: the path from the document root down to the parent of the section
+
+Materialised sections carry the label `RenderedSection` with an index on their id, so the retrieval of the context is a single indexed lookup instead of the 3-hop traversal and the reference sub-query of `RetrieveSections`. Sections that are not materialised yet are rendered from the live graph by the caller.
+
+After an update of the graph, only the touched subtrees are materialised again (`rematerialize`): the changed sections, all sections below them (their ancestor path may have changed) and the sections whose chunks reference one of them.
+
+Modules and Classes:
+- Section, Chunk: Classes of the section tree, rendered into the retrieval context.
+
+Functions:
+- ensure_rendered_section_index: Function creating the index of the materialised sections.
+- load_sections: Function building sections with their chunks and referenced sections from the live graph.
+- materialize_sections: Function rendering sections and storing the renderings on their nodes.
+- touched_sections: Function returning the sections whose rendering depends on the given sections.
+- rematerialize: Function materialising the touched subtrees after an update.
+- lookup_sections: Function fetching the materialised renderings of sections by id.
+- render_materialized: Function assembling the context from materialised renderings.
+"""
+
+from base_agent.utils.tracing import span
+
+ANCESTOR_LEVELS = 2     # ancestor headings rendered above a section (parent and superparent, as in `RetrieveSections`)
+MATERIALIZE_BATCH = 500
+
+INDEX_CYPHER = "CREATE INDEX `rendered-section-id` IF NOT EXISTS FOR (n:RenderedSection) ON (n.id)"
+
+ALL_SECTIONS_CYPHER = """
+MATCH (chunk)-[:PART_OF]->(section)
+WHERE chunk.content IS NOT NULL
+RETURN DISTINCT section.id AS id
+"""
+
+CHUNKS_CYPHER = """
+MATCH (chunk)-[:PART_OF]->(section)
+WHERE section.id IN $ids AND chunk.content IS NOT NULL
+OPTIONAL MATCH (chunk)-[:REFERENCES]->(ref)
+RETURN section.id AS section_id, section.num AS num, section.title AS title, chunk.id AS chunk_id, chunk.content AS content, chunk.`sequence-num` AS rank, collect(ref.id) AS ref_ids
+ORDER BY rank
+"""
+
+ANCESTORS_CYPHER = """
+MATCH (section)
+WHERE section.id IN $ids
+OPTIONAL MATCH path = (section)-[:PART_OF*1..]->(root)
+WHERE NOT (root)-[:PART_OF]->()
+WITH section, path ORDER BY length(path) DESC
+WITH section, head(collect(path)) AS path
+RETURN section.id AS id, CASE WHEN path IS NULL THEN [] ELSE [node IN reverse(tail(nodes(path))) | [node.id, node.num, node.title]] END AS ancestors
+"""
+
+REFERENCES_CYPHER = """
+MATCH (chunk)-[:PART_OF]->(section)
+WHERE section.id IN $ids AND chunk.content IS NOT NULL
+RETURN section.id AS parent_id, section.title AS title, section.num AS num, chunk.id AS chunk_id, chunk.content AS content, chunk.`sequence-num` AS rank
+ORDER BY rank
+"""
+
+STORE_CYPHER = """
+UNWIND $batch AS item
+MATCH (section {id: item.id})
+SET section:RenderedSection, section.rendered = item.rendered, section.chunk_ids = item.chunk_ids,
+    section.ancestor_ids = item.ancestor_ids, section.ancestor_nums = item.ancestor_nums, section.ancestor_titles = item.ancestor_titles
+"""
+
+TOUCHED_CYPHER = """
+MATCH (chunk)-[:PART_OF]->(section)-[:PART_OF*0..]->(changed)
+WHERE changed.id IN $ids AND chunk.content IS NOT NULL
+RETURN DISTINCT section.id AS id
+"""
+
+REFERENCING_CYPHER = """
+MATCH (section)<-[:PART_OF]-(chunk)-[:REFERENCES]->(ref)
+WHERE ref.id IN $ids
+RETURN DISTINCT section.id AS id
+"""
+
+LOOKUP_CYPHER = """
+MATCH (section:RenderedSection)
+WHERE section.id IN $ids
+RETURN section.id AS id, section.rendered AS rendered, section.ancestor_ids AS ancestor_ids, section.ancestor_nums AS ancestor_nums, section.ancestor_titles AS ancestor_titles
+"""
+
+
+#----------------- Section tree -----------------#
+class Section:
+    __slots__ = ("id", "parent_id", "title", "num", "elements", "isReference")
+
+    def __init__(self, id, parent_id, title='', num='', elements=None, isReference=False):
+        self.id = id
+        self.parent_id = parent_id
+        self.title = title
+        self.num = num
+        self.elements = elements if elements is not None else []  # Subsections or chunks
+        self.isReference = isReference
+
+    def render(self, parts):
+        parts.append(f"{self.num} {self.title}\n")  # Double line break after the title
+        for element in self.elements:
+            element.render(parts)
+
+    def __str__(self):
+        parts = []
+        self.render(parts)
+        return "".join(parts)
+
+class Chunk:
+    __slots__ = ("id", "content", "rank", "type", "references")
+
+    def __init__(self, id, content, rank, type, references=None):
+        self.id = id
+        self.content = content
+        self.rank = rank
+        self.type = type
+        self.references = references if references else []  # List of referenced sections
+
+    def render(self, parts):
+        parts.append(f"\n\n{self.content}")  # Double line break after chunk content
+        for ref in self.references:
+            parts.append("\n\nReferenziert: ")
+            ref.render(parts)
+            parts.append("\n\n")  # Double line break after each reference
+
+    def __str__(self):
+        parts = []
+        self.render(parts)
+        return "".join(parts)
+
+
+#----------------- Materialisation (ingestion) -----------------#
+def ensure_rendered_section_index(driver):
+    """Creates the index of the materialised sections, if it doesn't exist yet."""
+    driver.execute_query(INDEX_CYPHER)
+
+
+def _records(driver, cypher, **parameters):
+    records, _, _ = driver.execute_query(cypher, **parameters)
+    return [dict(record) for record in records]
+
+
+def _reference_sections(driver, ref_ids):
+    ref_sections = {}
+    if not ref_ids:
+        return ref_sections
+    for row in _records(driver, REFERENCES_CYPHER, ids=list(ref_ids)):
+        ref_section = ref_sections.get(row['parent_id'])
+        if ref_section is None:
+            ref_section = Section(row['parent_id'], parent_id=None, title=row['title'], num=row['num'], isReference=True)
+            ref_sections[row['parent_id']] = ref_section
+        ref_section.elements.append(Chunk(row['chunk_id'], row['content'], row['rank'], type=""))
+    return ref_sections
+
+
+def load_sections(driver, section_ids):
+    """
+    Builds the given sections with their chunks (in sequence order) and the sections referenced by the chunks from the live graph.
+
+    Returns:
+    dict: The sections by id, sections without chunks are missing.
+    """
+    sections = {}
+    references = []
+    for row in _records(driver, CHUNKS_CYPHER, ids=list(section_ids)):
+        section = sections.get(row['section_id'])
+        if section is None:
+            section = Section(row['section_id'], parent_id=None, title=row['title'], num=row['num'])
+            sections[row['section_id']] = section
+        chunk = Chunk(row['chunk_id'], row['content'], row['rank'], type="chunk")
+        section.elements.append(chunk)
+        references.extend((chunk, ref_id) for ref_id in row['ref_ids'])
+
+    ref_sections = _reference_sections(driver, {ref_id for _, ref_id in references})
+    for chunk, ref_id in references:
+        if ref_id in ref_sections:
+            chunk.references.append(ref_sections[ref_id])
+    return sections
+
+
+def _materialize_batch(driver, section_ids):
+    sections = load_sections(driver, section_ids)
+    ancestors = {row['id']: row['ancestors'] for row in _records(driver, ANCESTORS_CYPHER, ids=list(sections))}
+    batch = []
+    for section_id, section in sections.items():
+        path = ancestors.get(section_id, [])
+        batch.append({
+            "id": section_id,
+            "rendered": str(section),
+            "chunk_ids": [chunk.id for chunk in section.elements],
+            "ancestor_ids": [node[0] for node in path],
+            "ancestor_nums": [node[1] or '' for node in path],
+            "ancestor_titles": [node[2] or '' for node in path],
+        })
+    if batch:
+        driver.execute_query(STORE_CYPHER, batch=batch)
+    return len(batch)
+
+
+def materialize_sections(driver, section_ids=None):
+    """
+    Renders sections and stores the renderings, chunk ids and ancestor paths on their nodes.
+
+    Args:
+    driver: The neo4j driver.
+    section_ids (list): The sections to materialise, all sections containing chunks if None.
+
+    Returns:
+    int: The number of materialised sections.
+    """
+    if section_ids is None:
+        section_ids = [row['id'] for row in _records(driver, ALL_SECTIONS_CYPHER)]
+    section_ids = list(dict.fromkeys(section_ids))
+
+    count = 0
+    with span("sections.materialize", sections=len(section_ids)):
+        for i in range(0, len(section_ids), MATERIALIZE_BATCH):
+            count += _materialize_batch(driver, section_ids[i:i + MATERIALIZE_BATCH])
+    return count
+
+
+def touched_sections(driver, changed_ids):
+    """Returns the sections whose rendering depends on the changed sections: the sections below them and the sections referencing one of those."""
+    below = [row['id'] for row in _records(driver, TOUCHED_CYPHER, ids=list(changed_ids))]
+    referencing = [row['id'] for row in _records(driver, REFERENCING_CYPHER, ids=list(changed_ids) + below)]
+    return list(dict.fromkeys(below + referencing))
+
+
+def rematerialize(driver, changed_ids):
+    """Update hook for the ingestion pipeline: materialises the subtrees touched by changes of the given sections or chapters."""
+    return materialize_sections(driver, touched_sections(driver, changed_ids))
+
+
+#----------------- Lookup (retrieval) -----------------#
+def lookup_sections(section_ids, driver):
+    """
+    Fetches the materialised renderings of sections with a single indexed lookup.
+
+    Returns:
+    dict: The rows of the materialised sections by id, sections without a rendering are missing.
+    """
+    with span("neo4j.MaterializedSections", sections=len(section_ids)) as lookup_span:
+        records, _, _ = driver.execute_query(LOOKUP_CYPHER, ids=list(section_ids))
+        lookup_span.set("rows", len(records))
+    return {record['id']: dict(record) for record in records}
+
+
+def render_materialized(rows, levels=ANCESTOR_LEVELS):
+    """
+    Assembles the context from materialised renderings: sections sharing ancestors are grouped below the ancestor headings, in the order of `rows`.
+    """
+    tree = {}
+    for row in rows:
+        path = list(zip(row['ancestor_ids'] or [], row['ancestor_nums'] or [], row['ancestor_titles'] or []))[-levels:] if levels else []
+        node = tree
+        for ancestor in path:
+            node = node.setdefault(ancestor, {})
+        node.setdefault(None, []).append(row['rendered'])
+
+    parts = []
+
+    def render(node):
+        for key, value in node.items():
+            if key is None:
+                parts.extend(value)
+            else:
+                parts.append(f"{key[1]} {key[2]}\n")
+                render(value)
+
+    render(tree)
+    return "".join(parts)
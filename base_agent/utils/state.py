@@ -40,6 +40,7 @@ class AgentState(TypedDict):
     plan: Plan
     plan_index: int
     step_results: Annotated[StepResult, operator.add]
+    human_batch: List[str]     # step numbers of the Human steps asked together in the pending interrupt
     context: str
     response: str
     log: str
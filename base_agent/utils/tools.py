@@ -21,16 +21,32 @@ This module provides a set of tools and utilities for interacting with various A
 """
 
 #--------------Import Dependencies-------------------#
-from typing import List
+import asyncio
+from typing import List, Optional
 from langchain_core.tools import tool
+from langchain_core.runnables import RunnableConfig
 from pydantic import BaseModel, Field
 from pydantic.v1 import BaseModel as BaseModelV1, Field as FieldV1
 import os
 import re
+import tiktoken
+from functools import lru_cache
 #from openai import OpenAI
 import voyageai
 from neo4j import GraphDatabase
 from collections import defaultdict, deque
+from base_agent.utils.replay import graph_driver, embedding_client
+from base_agent.utils.embedders import embedding_backend, embedding_model, vector_index_name, create_embedding_client, VOYAGE_MODEL
+from base_agent.utils.tracing import span, traced
+from base_agent.utils.vector_index import get_local_index
+from base_agent.utils.lexical import lexical_search
+from base_agent.utils.filters import filter_for, filter_condition, filter_oversample, filter_ranking, with_category
+from base_agent.utils.partitions import partitions_enabled, known_categories, load_catalogue, route_partitions, search_partitions
+from base_agent.utils.cache import TTLCache
+from base_agent.utils.prefetch import take_prefetch
+from base_agent.utils.sections import Section, Chunk, lookup_sections, render_materialized
+from base_agent.utils.admission import AdmissionProxy
+from base_agent.utils.deadline import DeadlineProxy, DeadlineExceeded, budget_low, low_budget_s, degrade, track_degradation
 
 #----------------- Define envs -----------------#
 neo4j_uri = os.environ["NEO4J_URI"]
@@ -38,12 +54,24 @@ neo4j_user = os.environ["NEO4J_USER"]
 neo4j_password = os.environ["NEO4J_PASSWORD"]
 wolfram_alpha_appid = os.environ["WOLFRAM_ALPHA_APPID"]
 #EMBEDDING_MODEL  = "text-embedding-3-small" # can be shortened
-EMBEDDING_MODEL = 'voyage-multilingual-2'
-driver = GraphDatabase.driver(neo4j_uri, auth=(neo4j_user, neo4j_password))
+# 'voyage-multilingual-2' or the local model with NORMGRAPH_EMBEDDER=local (see embedders.py)
+EMBEDDING_MODEL = embedding_model()
+EMBEDDING_INDEX = vector_index_name(EMBEDDING_MODEL)
+EMBED_SPAN = f"{embedding_backend()}.embed"
+# Retrieval parameters (evaluated with helper_notebooks_benchmark/retrieval_eval.py)
+DOCUMENT_RETRIEVER_K = 5        # vector search results of the DocumentRetriever tool
+SEARCH_DATABASE_K = 3           # vector search results of the SearchDataBase tool
+VECTOR_SCORE_THRESHOLD = 0.8    # minimum cosine similarity of vector search results
+RRF_K = 60                      # constant of the reciprocal rank fusion
+# both clients are wrapped by the record/replay layer if NORMGRAPH_REPLAY_MODE is set (see replay.py)
+# their calls are bounded by the dependency timeouts and the request deadline, the read-only calls are hedged (see deadline.py)
+# a hedge of the local embedding backend would only compete for the same CPU, so only the VoyageAI calls are hedged
+# every call holds a concurrency slot of its dependency while it runs (see admission.py)
+driver = DeadlineProxy(AdmissionProxy(graph_driver(GraphDatabase.driver(neo4j_uri, auth=(neo4j_user, neo4j_password))), "neo4j", ["execute_query"]),
+                       "neo4j", ["execute_query"], hedge=True)
 #openai_client = OpenAI ()
-vo = voyageai.Client()
-
-print("Driver and OpenAI client initialized...")
+vo = DeadlineProxy(AdmissionProxy(embedding_client(create_embedding_client), "embedding", ["embed"]), "embedding", ["embed"],
+                   hedge=EMBEDDING_MODEL == VOYAGE_MODEL)
 
 #----------------- Define Data Classes -----------------#
 class Step(BaseModel):
@@ -74,6 +102,7 @@ class Plan(BaseModel):
 class StepResult(BaseModel):
     step_number: str
     result: str
+    full_tokens: Optional[int] = None   # tokens of the result before its compaction (see compaction.py), None if not compacted
 
 class Calculation(BaseModel):
     """Calculation to be performed by the Calculator tool. Includes the mathematical calculation in latex and plain text format."""
@@ -81,62 +110,61 @@ class Calculation(BaseModel):
     problem_latex: str = Field(description="Mathematical calculation to be performed. Input the equation in latex format.")
     problem_plain_text: str = Field(description="Mathematical calculation to be performed. Input the equation in plain text format.")
 
-class Conclusion(BaseModel):
-    """The conclusion to the task that was solved by the system, given the plan created to solve the task, as well as the results of each of the steps that are part of the plan. The conclusion also contains the source information used to solve the task as citations."""
-    
-    conclusion: str = Field(description="The conclusion based on the given task, the plan created to solve the task as well as the results of each of the steps that are part of the plan. The answer should be a direct response to the task, and should outline the process that lead to the final conclusion. Use markdown to format the text and make it more easily readable.")
-    citations: List[str] = Field(description="Source information used to solve the task, designated as the headings and titles of the sources. The citations consists of strings in a list format. Only include the headings and titles of the sources, not the full content of the sources. A citation entry consists of the source document title printed in brackets (e.g. [Eurocode 1]), as well as the specific section number and title of the source used (e.g. 4.5.6 Calculating Wind Load Configurations) -> Exemplary citation entry: 'Eurocode 1: 4.5.6 Calculating Wind Load Configurations'. Also include tables, equations graphs or similar information, that was retrieved during the plan execution. Only extract the relevant information used for the task, and exclude any irrelevant information from the context.")
+class ExtractedAnswer(BaseModel):
+    step_number: str = Field(description="The step number of the question, e.g. '#E2'.")
+    answer: str = Field(description="The information extracted from the user answer for this question.")
 
-class Section:
-    def __init__(self, id, parent_id, title='', num='', elements=[], isReference=False):
-        self.id = id
-        self.parent_id = parent_id
-        self.title = title
-        self.num = num
-        self.elements = elements  # Subsections or chunks
-        self.isReference = isReference
+class ExtractedAnswers(BaseModel):
+    """Information extracted from one user answer to several questions, one entry per question."""
 
-    def __str__(self):
-        section_str = ""
-        if self.isReference:
-            section_str += f"{self.num} {self.title}\n"  # Double line break after the title
+    answers: List[ExtractedAnswer] = Field(description="The extracted answers, one for each question.")
 
-            for element in self.elements:
-                section_str += f"{element.__str__()}"
+class ReasonedAnswer(BaseModel):
+    """Answer to a reasoning step, together with a self-assessment of its reliability. Used by the small model of the model cascade (see cascade.py)."""
 
-            return section_str
-        else:
-            section_str += f"{self.num} {self.title}\n"  # Double line break after the title
-
-            for element in self.elements:
-                section_str += f"{element.__str__()}"
-
-            return section_str
+    answer: str = Field(description="Short and concise answer to the task, exclusively based on the context.")
+    confidence: float = Field(description="Confidence between 0 and 1 that the answer is correct and fully supported by the context. Use a low value if the context is insufficient or the task requires complex reasoning.")
 
-class Chunk:
-    def __init__(self, id, content, rank, type, references=None):
-        self.id = id
-        self.content = content
-        self.rank = rank
-        self.type = type
-        self.references = references if references else []  # List of referenced sections
-
-    def __str__(self):
-        chunk_str = f"\n\n{self.content}"  # Double line break after chunk content
-        for ref in self.references:
-            chunk_str += f"\n\nReferenziert: {ref.__str__()}\n\n"  # Double line break after each reference
+class Conclusion(BaseModel):
+    """The conclusion to the task that was solved by the system, given the plan created to solve the task, as well as the results of each of the steps that are part of the plan. The conclusion also contains the source information used to solve the task as citations."""
+    
+    conclusion: str = Field(description="The conclusion based on the given task, the plan created to solve the task as well as the results of each of the steps that are part of the plan. The answer should be a direct response to the task, and should outline the process that lead to the final conclusion. Use markdown to format the text and make it more easily readable.")
+    citations: List[str] = Field(description="Source information used to solve the task, designated as the headings and titles of the sources. The citations consists of strings in a list format. Only include the headings and titles of the sources, not the full content of the sources. A citation entry consists of the source document title printed in brackets (e.g. [Eurocode 1]), as well as the specific section number and title of the source used (e.g. 4.5.6 Calculating Wind Load Configurations) -> Exemplary citation entry: 'Eurocode 1: 4.5.6 Calculating Wind Load Configurations'. Also include tables, equations graphs or similar information, that was retrieved during the plan execution. Only extract the relevant information used for the task, and exclude any irrelevant information from the context.")
 
-        return chunk_str
 
 #----------------- Define Retrieval Utils -----------------#
-def get_embedding(client, text, model):
-    response = client.embed(
-                    texts=text,
-                    model=model,
-                    input_type="query",
-                )
+# Query embeddings and retrieval results are shared between threads and questions, identical concurrent requests are computed once
+embedding_cache = TTLCache(maxsize=4096)
+retrieval_cache = TTLCache(maxsize=1024)
+ranking_cache = TTLCache(maxsize=1024)
+EMBED_BATCH_SIZE = 128
+
+def _embed_query(client, text, model):
+    with span(EMBED_SPAN, model=model):
+        response = client.embed(
+                        texts=text,
+                        model=model,
+                        input_type="query",
+                    )
     return response.embeddings[0]
 
+def get_embedding(client, text, model):
+    return embedding_cache.get_or_compute((model, text), lambda: _embed_query(client, text, model))
+
+def embed_queries(texts, client=None, model=EMBEDDING_MODEL):
+    """
+    Embeds many queries with one request per batch of EMBED_BATCH_SIZE texts and stores them in the embedding cache, so later `get_embedding` calls of the same texts need no request.
+    """
+    client = client or vo
+    missing = [text for text in dict.fromkeys(texts) if embedding_cache.get((model, text)) is None]
+    for i in range(0, len(missing), EMBED_BATCH_SIZE):
+        batch = missing[i:i + EMBED_BATCH_SIZE]
+        with span(EMBED_SPAN, model=model, texts=len(batch)):
+            response = client.embed(texts=batch, model=model, input_type="query")
+        for text, embedding in zip(batch, response.embeddings):
+            embedding_cache.put((model, text), embedding)
+    return len(missing)
+
 def reciprocal_rank_fusion(queries, d, k, searchResults, rank_func):
     # based on code from https://safjan.com/implementing-rank-fusion-in-python/ by Krystian Safjan
     return sum([1.0 / (k + rank_func(searchResults[q], d)) if d in searchResults[q] else 0 for q in queries])
@@ -151,58 +179,97 @@ def gather_unique_values(dictionary):
             unique_values.add(value)
     return list(unique_values)
 
-def apply_reciprocal_rank_fusion(dist_results, queries, searchResults):
+def apply_reciprocal_rank_fusion(dist_results, queries, searchResults, k=RRF_K):
     # Create the dictionary with the function outputs
-    k = 60
     result_dict = {doc: reciprocal_rank_fusion(queries, doc, k, searchResults, rank_func) for doc in dist_results}
     # Sort the dictionary by values in descending order
     sorted_result_dict = dict(sorted(result_dict.items(), key=lambda item: item[1], reverse=True))
     return sorted_result_dict
 
-def RRFGraphQuery(query: str, k: int, driver: GraphDatabase.driver, client: voyageai.Client):
+@traced("RRFGraphQuery")
+def RRFGraphQuery(query: str, k: int, driver: GraphDatabase.driver, client: voyageai.Client, score_threshold: float = VECTOR_SCORE_THRESHOLD, rrf_k: int = RRF_K, search_filter=None, partition=None):
     """
-    Takes a query and returns the top k results from the graph database
+    Takes a query and returns the top k results from the graph database, restricted to the chunks and sections matching `search_filter` (data type / category, see filters.py) if given
+    With a `partition` (Standard, see partitions.py) only the indexes of the partition are searched.
+    A search leg that exceeds the request deadline is dropped from the fusion (see deadline.py), the query fails only if both legs are dropped.
     """
-    # Perform TextSearch
-    indexName = "titles" # Index containing section and chapter titles
-    textCypher= f"CALL db.index.fulltext.queryNodes('{indexName}', '{query}') YIELD node, score RETURN DISTINCT node.title AS title, node.id AS id, score"
+    # Perform TextSearch (parameterised full-text search over titles, optionally chunk contents, or local BM25, see lexical.py)
+    try:
+        lexicalResults = lexical_search(query, driver, search_filter, partition)
+    except DeadlineExceeded:
+        lexicalResults = None
+        degrade("lexical")
 
-    textResults, summary, _ = driver.execute_query(
-    textCypher, indexName=indexName)
+    # Perform VectorSearch
+    try:
+        vectorResults = _vector_search(query, k, driver, client, score_threshold, search_filter, partition)
+    except DeadlineExceeded:
+        if lexicalResults is None:
+            raise
+        vectorResults = []
+        degrade("vector")
+
+    searchResults = dict(lexicalResults or {}, vecSearch=[result['id'] for result in vectorResults])
+    unique_values = gather_unique_values(searchResults)
 
-    print("Text search results retrieved...")
+    # Perform Reciprocal Rank Fusion
+    queries = list(searchResults.keys())
+    with span("rrf", candidates=len(unique_values)):
+        ranked_results = apply_reciprocal_rank_fusion(unique_values, queries, searchResults, rrf_k)
+    return ranked_results
 
-    # Perform VectorSearch
-    vecIndex = 'content-embeddings-vo'
+def _vector_search(query, k, driver, client, score_threshold, search_filter, partition=None):
+    vecIndex = EMBEDDING_INDEX
+    if partition is not None:
+        if EMBEDDING_MODEL == VOYAGE_MODEL:
+            vecIndex = partition.vector_index
+        else:
+            # the partitions only have vector indexes of the VoyageAI embeddings, the index of the model is filtered by the category of the partition
+            search_filter = with_category(search_filter, partition.category)
     resultCount = k
-    queryEmbedding = get_embedding(client, query, EMBEDDING_MODEL)
-    print("Embedding generated...")
     vectorCypher = '''
 WITH $queryEmbedding AS queryVector
 CALL db.index.vector.queryNodes($vecIndex, $resultCount, queryVector)
-YIELD node, score WHERE score > 0.8
+YIELD node, score WHERE score > $scoreThreshold
 MATCH (node)<-[:HAS_EMBEDDING]-(chunk)-[:PART_OF]->(root)
 RETURN DISTINCT root.title as title, root.id AS id, MAX(score) AS maxScore
 '''
-    vectorResults, summary, _ = driver.execute_query(
-    vectorCypher, queryEmbedding=queryEmbedding, vecIndex=vecIndex, resultCount=resultCount)
-
-    print("Vector search results retrieved...")
-
-    searchResults = {'textSearch': [result['id'] for result in textResults], 'vecSearch': [result['id'] for result in vectorResults]}
-    unique_values = gather_unique_values(searchResults)
-    print("Unique values gathered...")
-
-    # Perform Reciprocal Rank Fusion
-    queries = ['textSearch', 'vecSearch']
-    ranked_results = apply_reciprocal_rank_fusion(unique_values, queries, searchResults)
-    print("RRF performed...")
-    return ranked_results
+    # the neo4j vector index has no pre-filter: more candidates are requested and filtered on their chunks inside the query
+    vectorFilteredCypher = f'''
+WITH $queryEmbedding AS queryVector
+CALL db.index.vector.queryNodes($vecIndex, $candidateCount, queryVector)
+YIELD node, score WHERE score > $scoreThreshold
+MATCH (node)<-[:HAS_EMBEDDING]-(chunk)-[:PART_OF]->(root)
+WHERE {filter_condition("chunk")}
+WITH root, score ORDER BY score DESC LIMIT $resultCount
+RETURN DISTINCT root.title as title, root.id AS id, MAX(score) AS maxScore
+'''
+    queryEmbedding = get_embedding(client, query, EMBEDDING_MODEL)
+    local_index = get_local_index(driver)
+    if local_index is not None:
+        # in-process mirror of the vector index (enabled with NORMGRAPH_LOCAL_VECTOR_INDEX or NORMGRAPH_VECTOR_QUANTIZATION, see vector_index.py)
+        with span("local.vector", kind=local_index.kind, k=resultCount, filtered=search_filter is not None) as vector_span:
+            local_filter = with_category(search_filter, partition.category) if partition is not None else search_filter
+            vectorResults = local_index.search(queryEmbedding, resultCount, score_threshold, local_filter)
+            vector_span.set("rows", len(vectorResults))
+    elif search_filter is not None:
+        with span("neo4j.vector", index=vecIndex, k=resultCount, filtered=True) as vector_span:
+            vectorResults, summary, _ = driver.execute_query(
+            vectorFilteredCypher, queryEmbedding=queryEmbedding, vecIndex=vecIndex, resultCount=resultCount, candidateCount=resultCount * filter_oversample(),
+            scoreThreshold=score_threshold, **search_filter.parameters())
+            vector_span.set("rows", len(vectorResults))
+    else:
+        with span("neo4j.vector", index=vecIndex, k=resultCount) as vector_span:
+            vectorResults, summary, _ = driver.execute_query(
+            vectorCypher, queryEmbedding=queryEmbedding, vecIndex=vecIndex, resultCount=resultCount, scoreThreshold=score_threshold)
+            vector_span.set("rows", len(vectorResults))
+    return vectorResults
 
 def parse_records_to_dict(elements):
     new_list = [dict(element) for element in elements]
     return new_list
 
+@traced("RetrieveSections")
 def RetrieveSections(results, driver):
     cypher = """
 CALL apoc.cypher.runMany(
@@ -219,7 +286,9 @@ CALL apoc.cypher.runMany(
   {statistics: false}
 );
 """
-    node_information, summary, _ = driver.execute_query(cypher, ids=results)
+    with span("neo4j.RetrieveSections", sections=len(results)) as sections_span:
+        node_information, summary, _ = driver.execute_query(cypher, ids=results)
+        sections_span.set("rows", len(node_information))
     node_information = parse_records_to_dict(node_information)
 
     return node_information
@@ -230,142 +299,196 @@ WHERE section.id IN $ids
 RETURN section.id AS parent_id, section.title AS title, section.num AS num, chunk.id AS chunk_id, chunk.content AS content, chunk.`sequence-num` AS rank
 ORDER BY rank
 """
-    ref_section, summary, _ = driver.execute_query(refCypher, ids=ref_id)
+    with span("neo4j.RetrieveReferences", sections=len(ref_id)) as references_span:
+        ref_section, summary, _ = driver.execute_query(refCypher, ids=ref_id)
+        references_span.set("rows", len(ref_section))
     ref_section = parse_records_to_dict(ref_section)
     return ref_section
 
-def parse_query_response(query_response):
-    # Create dictionaries to hold sections and chunks by their IDs
+def build_reference_sections(ref_ids):
+    # one query for all referenced sections instead of one query per reference
+    ref_sections = {}
+    for e in RetrieveReferences(list(ref_ids)):
+        ref_section = ref_sections.get(e['parent_id'])
+        if ref_section is None:
+            ref_section = Section(e['parent_id'], parent_id=None, title=e['title'], num=e['num'], isReference=True)
+            ref_sections[e['parent_id']] = ref_section
+        ref_section.elements.append(Chunk(e['chunk_id'], e['content'], e['rank'], type=""))
+    return ref_sections
+
+@traced("parse_query_response")
+def parse_query_response(query_response, expand_references=True):
+    """
+    Builds the section tree (superparent -> parent -> section -> chunks, chunks -> referenced sections) from the rows of `RetrieveSections` in O(n) and returns its root.
+    Without `expand_references` the referenced sections are not fetched (used when the request deadline is close).
+    """
+    # Dictionaries holding sections and chunks by their IDs
     sections = {}
     chunks = {}
+    references = []
 
     # First pass: Create Sections and Chunks from the query response
     for row in query_response:
         result = row['result']
         if result['type'] == 'chunk':
-            # Create super section
             super_id = result['super_id']
-            super_title = result['super_title']
-            super_num = result['super_num']
-            
             if super_id not in sections:
-                super_section = Section(id=super_id, parent_id=None, title=super_title, num=super_num, elements=[])
-                sections[super_id] = super_section
+                sections[super_id] = Section(id=super_id, parent_id=None, title=result['super_title'], num=result['super_num'])
 
-            # Create a parent section
             parent_id = result['parent_id']
-            parent_title = result['parent_title']
-            parent_num = result['parent_num']
-
             if parent_id not in sections:
-                parent_section = Section(id=parent_id, parent_id=super_id, title=parent_title, num=parent_num, elements=[])
-                sections[parent_id] = parent_section
+                sections[parent_id] = Section(id=parent_id, parent_id=super_id, title=result['parent_title'], num=result['parent_num'])
 
-            # Create a Section
             section_id = result['section_id']
-            title = result['title']
-            num = result['num']
-            parent_id = result['parent_id']
-
-
             if section_id not in sections:
-                section = Section(id=section_id, parent_id=parent_id, title=title, num=num, elements=[])
-                sections[section_id] = section
-
-
-            chunk_id = result['chunk.id']
-            content = result['content']
-            rank = result['rank']
-            chunk_type = result['type']
-            chunk = Chunk(id=chunk_id, content=content, rank=rank, type=chunk_type)
+                sections[section_id] = Section(id=section_id, parent_id=parent_id, title=result['title'], num=result['num'])
 
+            chunk = Chunk(id=result['chunk.id'], content=result['content'], rank=result['rank'], type=result['type'])
+            chunks[chunk.id] = chunk
             sections[section_id].elements.append(chunk)
-        
-            # Create a chunk
-            #chunk_id = result['chunk.id']
-            #content = result['content']
-            #rank = result['rank']
-            #chunk_type = result['type']
-            #chunk = Chunk(id=chunk_id, content=content, rank=rank, type=chunk_type)
-
-            # Add chunk to the chunks dictionary
-            #chunks[chunk_id] = chunk
-
 
         elif result['type'] == 'reference':
-            # This is a reference, so update the chunk it refers to
-            chunk_id = result['chunk_id']
-            ref_id = result['ref_id']
-            found = False
-
-            for section in sections.values():
-                if found:
-                    break
-                print(section)
-                for element in section.elements:
-                    if element.id == chunk_id:
-
-                        # Query the referenced section
-                        # Instantiate a new section object
-                        ref_data = RetrieveReferences([ref_id])
-                        ref_chunks = []
-                        for e in ref_data:
-                            chunk = Chunk(e['chunk_id'], e['content'], e['rank'], type="")
-                            ref_chunks.append(chunk)
-
-                        ref_section = Section(ref_data[0]['parent_id'], parent_id=None, title=ref_data[0]['title'], num=ref_data[0]['num'], elements=ref_chunks, isReference=True)
-                        element.references.append(ref_section)
-                        found = True
-                        break
-                    
-
-
-            #if chunk_id in chunks:
-            #    chunks[chunk_id].references.append(ref_id)
-            #    print(ref_id)
+            # References are resolved after all chunks are known
+            references.append((result['chunk_id'], result['ref_id']))
 
         else:
-            # Create a section
             section_id = result['section_id']
-            title = result.get('title')
-            num = result.get('num')
-            parent_id = result['parent_id']
-
-            # Check if section already exists, otherwise create it
             if section_id not in sections:
-                section = Section(id=section_id, title=title, num=num)
-                sections[section_id] = section
+                sections[section_id] = Section(id=section_id, parent_id=result.get('parent_id'), title=result.get('title'), num=result.get('num'))
 
-    # Second pass: Build the hierarchy of sections and attach chunks
+    # Attach the referenced sections to their chunks
+    if references and expand_references:
+        ref_sections = build_reference_sections({ref_id for _, ref_id in references})
+        for chunk_id, ref_id in references:
+            if chunk_id in chunks and ref_id in ref_sections:
+                chunks[chunk_id].references.append(ref_sections[ref_id])
+
+    # Second pass: Build the hierarchy of sections by looking up each parent by its ID
     root_section = None
-    
     for section in sections.values():
         if section.parent_id is None:
-            root_section = section
-            break
+            if root_section is None:
+                root_section = section
+        elif section.parent_id in sections:
+            sections[section.parent_id].elements.append(section)
 
-    assigned_sections = []
-    for section in sections.values():
-        if section.parent_id == root_section.id:
-            root_section.elements.append(section)
-            assigned_sections.append(section.id)
-
-    for section in sections.values():
-        if section.id not in assigned_sections:
-            for parent_section in root_section.elements:
-                if section.parent_id == parent_section.id:
-                    parent_section.elements.append(section)
-                    assigned_sections.append(section.id)
-                    break
+    return root_section
 
+# Section trees are only changed by the ingestion, so they are reused between retrievals of the same sections
+section_tree_cache = TTLCache(maxsize=256)
 
+def get_section_tree(section_ids, driver):
+    """
+    Returns the root of the section tree for the given section ids (shared between calls, must not be mutated).
+    """
+    if budget_low(low_budget_s()):
+        # close to the deadline the references are not expanded, the incomplete tree is not cached
+        degrade("references")
+        return parse_query_response(RetrieveSections(list(section_ids), driver), expand_references=False)
+    key = tuple(sorted(section_ids))
+    return section_tree_cache.get_or_compute(key, lambda: parse_query_response(RetrieveSections(list(section_ids), driver)))
+
+def get_section_context(section_ids, driver):
+    """
+    Renders the context of the given sections. Materialised sections (see sections.py) are fetched with a single indexed lookup, sections without a rendering are built from the live graph.
+    A fetch that exceeds the request deadline is degraded (see deadline.py): without the lookup all sections are built from the live graph, without the section tree the context only contains the materialised sections.
+    """
+    try:
+        materialized = lookup_sections(section_ids, driver)
+    except DeadlineExceeded:
+        materialized = {}
+        degrade("sections")
+    context = render_materialized([materialized[section_id] for section_id in section_ids if section_id in materialized])
+    missing = [section_id for section_id in section_ids if section_id not in materialized]
+    if missing:
+        try:
+            root_section = get_section_tree(missing, driver)
+        except DeadlineExceeded:
+            root_section = None
+            degrade("sections")
+        if root_section is not None:
+            context += root_section.__str__()
+    return context
+
+def merge_rankings(rankings, rrf_k=RRF_K):
+    """Merges the rankings of several searches (e.g. of partitions) with the reciprocal rank fusion."""
+    return apply_reciprocal_rank_fusion(gather_unique_values(rankings), list(rankings.keys()), rankings, rrf_k)
+
+def ranked_sections(query, k, search_filter=None):
+    """
+    Ranks the sections for a query with `RRFGraphQuery`. With partitioned search (see partitions.py) the query is routed to the partitions of the relevant standards, which are searched in parallel and merged.
+    """
+    if partitions_enabled():
+        catalogue = load_catalogue(driver)
+        if catalogue:
+            partitions, mode = route_partitions(query, search_filter.category if search_filter is not None else None, catalogue)
+            with span("partitions.search", mode=mode, partitions=len(partitions)):
+                return search_partitions(partitions, lambda partition: RRFGraphQuery(query, k, driver, vo, search_filter=search_filter, partition=partition), merge_rankings)
+    return RRFGraphQuery(query, k, driver, vo, search_filter=search_filter)
+
+def ranked_section_ids(query, k, search_filter=None):
+    """
+    Returns the ranked section ids of a query (without matches for the `search_filter` the ranking without filter). Rankings are cached, rankings degraded to meet the request deadline are not.
+    """
+    degradations = []
 
+    def compute():
+        with track_degradation() as recorded:
+            results = ranked_sections(query, k, search_filter)
+            if not results and search_filter is not None:
+                with span("filters.fallback"):
+                    results = ranked_sections(query, k)
+        degradations.extend(recorded)
+        return list(results.keys())
 
-    return root_section
+    return ranking_cache.get_or_compute((query, k, search_filter), compute, cacheable=lambda _: not degradations)
 
 def reduce_linebreaks(text):
     return re.sub(r'\n{3,}', '\n\n', text)
 
+def retrieve_context(query, k, search_filter=None):
+    """
+    Hybrid retrieval of the rendered section context for a query, shared by the retrieval tools and the expert nodes. Results are cached and identical concurrent queries are retrieved once.
+    With a `search_filter` (see filters.py) only matching chunks and sections are searched, if nothing matches the query is retrieved without the filter.
+    Contexts degraded to meet the request deadline (see deadline.py) are returned but not cached.
+    """
+    degradations = []
+
+    def compute():
+        with track_degradation() as recorded:
+            # the ranking is cached separately, the compaction of step results (see compaction.py) reuses it
+            context = reduce_linebreaks(get_section_context(ranked_section_ids(query, k, search_filter), driver))
+        degradations.extend(recorded)
+        return context
+
+    return retrieval_cache.get_or_compute((query, k, search_filter), compute, cacheable=lambda _: not degradations)
+
+def retrieve_context_for_thread(query, k, thread_id, search_filter=None):
+    """
+    Like `retrieve_context`, but takes the speculative ranking of the thread (see prefetch.py) if its text matches the query and it was ranked with the same `k`.
+    The ranking is retrieved without filter, a `search_filter` is applied to the ranked sections (without matches the unfiltered ranking is used, like `ranked_section_ids`).
+    """
+    ranking = take_prefetch(thread_id, query, key=k)
+    if ranking is None:
+        return retrieve_context(query, k, search_filter)
+    if search_filter is not None:
+        ranking = filter_ranking(ranking, search_filter, driver) or ranking
+    return reduce_linebreaks(get_section_context(ranking, driver))
+
+# number of results of the speculative ranking, a retrieval with another k doesn't take it
+PREFETCH_KEY = DOCUMENT_RETRIEVER_K
+
+def prefetch_retrieval(text):
+    """Speculative ranking of a user message without filter, started by the agent node."""
+    return ranked_section_ids(text, PREFETCH_KEY)
+
+@lru_cache(maxsize=1)
+def _token_encoding():
+    return tiktoken.get_encoding("o200k_base") # tokenizer of gpt-4o and gpt-4o-mini
+
+def count_tokens(text):
+    return len(_token_encoding().encode(text, disallowed_special=()))
+
 def parse_steps_fixed(input_string):
     # Split the input by "Plan:" to isolate each plan
     plans = input_string.split("Plan:")
@@ -408,6 +531,41 @@ def parse_steps_fixed(input_string):
 
     return steps
 
+class IncrementalPlanParser:
+    """
+    Parses the planner output while it is streamed: `feed` returns every step, whose line is complete, exactly once. The steps are parsed with `parse_steps_fixed`, so they are identical to the steps of the complete plan.
+    """
+    # a step is complete once its input is closed and its line ended, e.g. '... #E1 = DataBase[Schneelast]\n'
+    _STEP_END = re.compile(r"#E\d+\s*=\s*\w+\s*\[.*?\][^\n]*\n", re.DOTALL)
+
+    def __init__(self):
+        self.text = ""
+        self.emitted = 0    # number of "Plan:" blocks already returned
+
+    def feed(self, chunk):
+        self.text += chunk
+        return self._complete_steps(final=False)
+
+    def close(self):
+        """Returns the steps of the remaining blocks at the end of the stream."""
+        return self._complete_steps(final=True)
+
+    def _complete_steps(self, final):
+        blocks = self.text.split("Plan:")[1:]
+        steps = []
+        while self.emitted < len(blocks):
+            block = blocks[self.emitted]
+            is_last = self.emitted == len(blocks) - 1
+            if is_last and not final and not self._STEP_END.search(block):
+                break
+            try:
+                steps.extend(parse_steps_fixed("Plan:" + block))
+            except (AttributeError, ValueError):
+                # block without a step (e.g. trailing text), the complete plan is validated by parse_steps_fixed and sort_steps
+                pass
+            self.emitted += 1
+        return steps
+
 def sort_steps(steps):
     # Step 1: Build a graph and in-degree map
     graph = defaultdict(list)
@@ -443,20 +601,15 @@ def sort_steps(steps):
 #----------------- Define the LLM tools -----------------#
 
 @tool
-async def DocumentRetriever(query: str, data_type: str):
+@traced("tool.DocumentRetriever")
+async def DocumentRetriever(query: str, data_type: str, config: RunnableConfig = None):
     """Call to retrieve relevant documents from a specialized database."""
 
-    results = RRFGraphQuery(query, 5, driver, vo)
-    
-    #print("DocumentRetriever: Results retrieved...")
-    keys = [key for key in results.keys()]
-    results = RetrieveSections(keys, driver)
-    root_section = parse_query_response(results)
-
-    context = root_section.__str__()
-    context = reduce_linebreaks(context)
+    # the retrieval is blocking, it runs in a worker thread so concurrent graph invocations are not serialized
+    thread_id = ((config or {}).get("configurable") or {}).get("thread_id")
+    # the data type is applied as a pre-filter of the search (see filters.py)
+    context = await asyncio.to_thread(retrieve_context_for_thread, query, DOCUMENT_RETRIEVER_K, thread_id, filter_for(data_type))
     
-    # ToDo: Support type filters
     #context = "Document Placeholder"
     return {'retrieved information': context}
     
@@ -486,18 +639,12 @@ InvokeExpertModel.name = "InvokeExpertModel"
 InvokeExpertModel.description = "Returns the result of a complex user query, retrieved from the expert model. Call this tool to answer complex user queries, that require a detailed explanation or a highly specialized answer regarding civil engineering based proofs, processes, or mathematical calculations. Include all relevant information from the user as well as the conversation history to ensure the best possible results."
 
 @tool
+@traced("tool.SearchDataBase")
 async def SearchDataBase(query: str, data_type: str, category: str):
     """Call to retrieve relevant documents required for answering the user query from a database, containing information about civil engineering processes and terminology."""
     
     # modified version of the DocumentRetriever tool containing additional category information for the PLM to use
-    results = RRFGraphQuery(query, 3, driver, vo)
-    #print("SearchDataBase: Results retrieved...")
-    keys = [key for key in results.keys()]
-    results = RetrieveSections(keys, driver)
-    root_section = parse_query_response(results)
-
-    context = root_section.__str__()
-    context = reduce_linebreaks(context)
+    context = await asyncio.to_thread(retrieve_context, query, SEARCH_DATABASE_K, filter_for(data_type, category))
     
     #context = "Context Placeholder" + f"Query: {query}, Data Type: {data_type}, Category: {category}"
     return {'retrieved information': context}
@@ -506,8 +653,9 @@ class SearchDataBaseInput(BaseModelV1):
     query: str = FieldV1(description="Searchquery to retrieve relevant context information for highly complex user queries from a specialized database.")
     data_type: str = FieldV1(description="Category of the subject to be searched. Choose from the predifined categories depending on the type of information the user query is about.", 
                           enum=["Definition", "Parameter", "Equation", "Table", "Process", "Proof", "Other"])
+    # the loaded standards are configured with NORMGRAPH_STANDARDS, with partitioned search the category routes the query (see partitions.py)
     category: str = FieldV1(description="Thematic category of civil engineering to be searched. Choose depending on the topic of the user query: 'DIN 1993-1-3' for Snowloads",
-                       enum=["DIN 1993-1-3", "Other"])
+                       enum=known_categories())
     
 SearchDataBase.args_schema = SearchDataBaseInput
 SearchDataBase.name = "SearchDataBase"
@@ -0,0 +1,370 @@
+"""
+This module provides a lightweight tracing layer for the application. Every graph node and every external call (neo4j queries, VoyageAI embeddings, OpenAI chat models and the calculator Assistant) is recorded as a span. Spans are nested through a context variable, so a node span contains the spans of the tool and database calls it performed.
+
+Finished spans are handed to span processors. Two exporters are configured through environment variables:
+- NORMGRAPH_TRACE_FILE: path of a json-lines file, one finished span per line
+- NORMGRAPH_OTLP_ENDPOINT (or OTEL_EXPORTER_OTLP_ENDPOINT): base url of an OTLP/HTTP collector (e.g. 'http://localhost:4318'), spans are sent as OTLP json
+
+Both exporters batch spans in a background thread, so exporting is not on the critical path of a request.
+
+Langfuse is supported as an optional callback, configured through the standard variables LANGFUSE_PUBLIC_KEY, LANGFUSE_SECRET_KEY and LANGFUSE_HOST.
+
+Modules and Classes:
+- Span: Class representing a single timed operation.
+- BatchExporter, JSONLExporter, OTLPExporter: Classes exporting finished spans.
+- TracingCallbackHandler: LangChain callback handler recording chat model calls with token usage.
+
+Functions:
+- span: Context manager opening a child span of the current span.
+- traced: Decorator recording every call of a function as a span.
+- start_span / end_span: Functions for spans that can't be expressed as a context manager.
+- current_span: Function returning the active span.
+- add_span_processor: Function registering a function called with every finished span.
+- add_span_start_processor: Function registering a function called with every started span.
+- traced_node: Function wrapping a graph node with a span.
+- get_callbacks: Function returning the callback handlers to attach to chat models.
+"""
+
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from functools import lru_cache
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables import Runnable, RunnableLambda
+from langchain_core.runnables.config import run_in_executor
+
+_current_span = contextvars.ContextVar("normgraph_current_span", default=None)
+_processors = []
+_start_processors = []
+
+
+class Span:
+    """A single timed operation. Attributes are added with `set`, the span is finished with `end_span`."""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "status", "_start_perf", "duration")
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self._start_perf = time.perf_counter()
+        self.duration = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.status = "error"
+        self.attributes["error.type"] = type(error).__name__
+        self.attributes["error.message"] = str(error)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_unix_nano": self.start_ns,
+            "end_unix_nano": self.end_ns,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+def current_span():
+    return _current_span.get()
+
+
+def add_span_processor(processor):
+    """Registers a function that is called with every finished span."""
+    _processors.append(processor)
+
+
+def remove_span_processor(processor):
+    if processor in _processors:
+        _processors.remove(processor)
+
+
+def add_span_start_processor(processor):
+    """Registers a function that is called with every started span."""
+    _start_processors.append(processor)
+
+
+def start_span(name, parent=None, **attributes):
+    """Creates a span without activating it. The parent defaults to the current span."""
+    new_span = Span(name, parent if parent is not None else _current_span.get(), attributes)
+    for processor in _start_processors:
+        try:
+            processor(new_span)
+        except Exception:
+            pass
+    return new_span
+
+
+def end_span(span):
+    span.duration = time.perf_counter() - span._start_perf
+    span.end_ns = span.start_ns + int(span.duration * 1e9)
+    for processor in _processors:
+        try:
+            processor(span)
+        except Exception:
+            pass
+
+
+@contextmanager
+def span(name, **attributes):
+    """Opens a child span of the current span, which is active until the block is left."""
+    new_span = start_span(name, **attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        end_span(new_span)
+
+
+def traced(name):
+    """Decorator recording every call of the decorated (sync or async) function as a span."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+#----------------- Graph nodes -----------------#
+def _accepts_config(func):
+    try:
+        return "config" in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _node_attributes(name, config):
+    configurable = (config or {}).get("configurable", {})
+    metadata = (config or {}).get("metadata", {})
+    return {"node": name, "thread_id": configurable.get("thread_id"), "step": metadata.get("langgraph_step")}
+
+
+def traced_node(name, node):
+    """
+    Wraps a graph node (function or Runnable) with a span named 'node.<name>'.
+
+    Sync and async execution are both supported: Runnables (e.g. the ToolNode with async tools) are invoked with `invoke`/`ainvoke`, sync functions are run in an executor when the graph is executed asynchronously. The node config is forwarded if the node accepts it.
+    The request deadline (see deadline.py) and the priority (see admission.py) of the config are active while the node runs.
+    """
+    # imported here, both modules import this module
+    from base_agent.utils.admission import priority_scope
+    from base_agent.utils.deadline import deadline_scope
+
+    is_runnable = isinstance(node, Runnable)
+    pass_config = not is_runnable and _accepts_config(node)
+
+    def call(state, config):
+        if is_runnable:
+            return node.invoke(state, config)
+        return node(state, config) if pass_config else node(state)
+
+    def _sync(state, config):
+        with span(f"node.{name}", **_node_attributes(name, config)), deadline_scope(config), priority_scope(name, config):
+            return call(state, config)
+
+    async def _async(state, config):
+        with span(f"node.{name}", **_node_attributes(name, config)), deadline_scope(config), priority_scope(name, config):
+            if is_runnable:
+                return await node.ainvoke(state, config)
+            return await run_in_executor(config, call, state, config)
+
+    return RunnableLambda(_sync, afunc=_async, name=name)
+
+
+#----------------- Chat models -----------------#
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records every chat model call as a span 'llm.<model>' with token usage and time to first token."""
+
+    def __init__(self):
+        self._spans = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        metadata = metadata or {}
+        model = metadata.get("ls_model_name") or (kwargs.get("invocation_params") or {}).get("model_name", "chat")
+        self._spans[run_id] = start_span(f"llm.{model}", model=model, node=metadata.get("langgraph_node"))
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        llm_span = self._spans.get(run_id)
+        if llm_span is not None and "ttft_ms" not in llm_span.attributes:
+            llm_span.set("ttft_ms", round((time.perf_counter() - llm_span._start_perf) * 1000, 3))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        llm_span = self._spans.pop(run_id, None)
+        if llm_span is None:
+            return
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                llm_span.set("input_tokens", llm_span.attributes.get("input_tokens", 0) + usage.get("input_tokens", 0))
+                llm_span.set("output_tokens", llm_span.attributes.get("output_tokens", 0) + usage.get("output_tokens", 0))
+                cached = (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+                llm_span.set("cached_tokens", llm_span.attributes.get("cached_tokens", 0) + cached)
+        end_span(llm_span)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        llm_span = self._spans.pop(run_id, None)
+        if llm_span is not None:
+            llm_span.record_error(error)
+            end_span(llm_span)
+
+
+@lru_cache(maxsize=1)
+def get_callbacks():
+    """Returns the callback handlers attached to every chat model: the tracing handler and, if configured, Langfuse."""
+    callbacks = [TracingCallbackHandler()]
+    if os.environ.get("LANGFUSE_PUBLIC_KEY") and os.environ.get("LANGFUSE_SECRET_KEY"):
+        from langfuse.callback import CallbackHandler
+        # reads LANGFUSE_PUBLIC_KEY, LANGFUSE_SECRET_KEY and LANGFUSE_HOST from the environment
+        callbacks.append(CallbackHandler())
+    return callbacks
+
+
+#----------------- Exporters -----------------#
+class BatchExporter:
+    """Collects finished spans in a queue and exports them in batches from a background thread."""
+
+    def __init__(self, max_batch=256, interval=1.0):
+        self.max_batch = max_batch
+        self.interval = interval
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=type(self).__name__)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def __call__(self, finished_span):
+        self._queue.put(finished_span.to_dict())
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        batch = self._drain()
+        while batch:
+            try:
+                self.export(batch)
+            except Exception:
+                pass
+            batch = self._drain()
+
+    def export(self, batch):
+        raise NotImplementedError
+
+
+class JSONLExporter(BatchExporter):
+    """Appends finished spans to a json-lines file."""
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self._lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def export(self, batch):
+        with self._lock, open(self.path, "a", encoding="utf-8") as trace_file:
+            for finished_span in batch:
+                trace_file.write(json.dumps(finished_span, ensure_ascii=False, default=str) + "\n")
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, str):
+        return {"stringValue": value}
+    return {"stringValue": json.dumps(value, ensure_ascii=False, default=str)}
+
+
+class OTLPExporter(BatchExporter):
+    """Sends finished spans as OTLP/HTTP json to a collector (e.g. a local OpenTelemetry collector or Jaeger)."""
+
+    def __init__(self, endpoint, service_name="normgraph", timeout=5, **kwargs):
+        endpoint = endpoint.rstrip("/")
+        self.url = endpoint if endpoint.endswith("/v1/traces") else endpoint + "/v1/traces"
+        self.service_name = service_name
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def _to_otlp(self, finished_span):
+        otlp_span = {
+            "traceId": finished_span["trace_id"],
+            "spanId": finished_span["span_id"],
+            "name": finished_span["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(finished_span["start_unix_nano"]),
+            "endTimeUnixNano": str(finished_span["end_unix_nano"]),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in finished_span["attributes"].items() if value is not None],
+            "status": {"code": 2 if finished_span["status"] == "error" else 1},
+        }
+        if finished_span["parent_id"]:
+            otlp_span["parentSpanId"] = finished_span["parent_id"]
+        return otlp_span
+
+    def export(self, batch):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "normgraph"}, "spans": [self._to_otlp(finished_span) for finished_span in batch]}],
+            }]
+        }
+        request = urllib.request.Request(self.url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"}, method="POST")
+        urllib.request.urlopen(request, timeout=self.timeout).close()
+
+
+def _configure_exporters():
+    trace_file = os.environ.get("NORMGRAPH_TRACE_FILE")
+    if trace_file:
+        add_span_processor(JSONLExporter(trace_file))
+    otlp_endpoint = os.environ.get("NORMGRAPH_OTLP_ENDPOINT") or os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+    if otlp_endpoint:
+        add_span_processor(OTLPExporter(otlp_endpoint))
+
+
+_configure_exporters()
@@ -0,0 +1,333 @@
+"""
+This module provides an optional in-process mirror of the chunk embeddings stored in the graph database. With the mirror enabled, the vector leg of `RRFGraphQuery` is answered locally instead of querying the neo4j vector index of the embedding model (`content-embeddings-vo`, see embedders.py), so neo4j is only used for the full-text search and for fetching the section contents.
+
+The embeddings are loaded page by page into a memory-mapped, normalized float32 matrix in a local cache directory, together with the chunk -> section mapping. Top-k queries are answered by one of three structures:
+- 'flat': exact search over the whole matrix (default for small corpora)
+- 'ivf': inverted file index (k-means clustering, only the nearest clusters are scanned)
+- 'hnsw': HNSW graph, requires the optional package `hnswlib`
+
+The mirror is keyed on the graph version (number of embeddings and the last embedding id). `refresh_if_stale` checks the version at most every NORMGRAPH_VECTOR_REFRESH_S seconds and rebuilds the mirror in a background thread, `on_graph_update` forces a rebuild after an ingestion run.
+
+Configuration through environment variables:
+- NORMGRAPH_LOCAL_VECTOR_INDEX: '' (disabled, default), 'auto', 'flat', 'ivf' or 'hnsw'
+- NORMGRAPH_VECTOR_CACHE: cache directory of the memory-mapped matrices (default: '.vector_cache')
+- NORMGRAPH_VECTOR_REFRESH_S: minimum interval between graph version checks (default: 300)
+- NORMGRAPH_VECTOR_QUANTIZATION: 'int8' or 'binary' replaces the float mirror with the two-stage search over quantised codes of `quantization.py`
+
+The data type and category tags of the chunks (see filters.py) are mirrored as well, a search with a filter only scores the rows of matching chunks. The graph version includes the number of tagged chunks, so tagging the graph rebuilds the mirror.
+
+Modules and Classes:
+- LocalVectorIndex: Class holding the embedding matrix and the search structure.
+
+Functions:
+- graph_version: Function returning the version of the embeddings in the graph.
+- filtered_rows: Function returning the rows of an index matching a data type / category filter.
+- get_local_index: Function returning the shared index (None if disabled).
+- on_graph_update: Function forcing a refresh of the shared index.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from base_agent.utils.deadline import unbounded
+from base_agent.utils.embedders import embedding_label, embedding_model
+from base_agent.utils.filters import allowed_rows
+from base_agent.utils.tracing import span
+
+PAGE_SIZE = 5000
+FLAT_LIMIT = 20000      # below this corpus size, exact search is faster than any index
+VECTOR_MODEL = embedding_model()    # the model of the configured embedding backend (see embedders.py)
+
+# formatted with the label of the embedding nodes of the model (see embedders.py)
+VERSION_CYPHER = """
+MATCH (e:{label}) WHERE e.model = $model
+OPTIONAL MATCH (chunk)-[:HAS_EMBEDDING]->(e)
+RETURN count(e) AS count, max(e.id) AS last, count(chunk.data_types) AS tagged
+"""
+
+EMBEDDING_PAGE_CYPHER = """
+MATCH (chunk)-[:HAS_EMBEDDING]->(e:{label})
+WHERE e.model = $model
+MATCH (chunk)-[:PART_OF]->(section)
+RETURN e.id AS embedding_id, e.value AS value, chunk.id AS chunk_id, section.id AS section_id, section.title AS title, chunk.data_types AS data_types, chunk.category AS category
+ORDER BY e.id
+SKIP $skip LIMIT $limit
+"""
+
+
+def filtered_rows(index, search_filter):
+    """Returns the rows and the row mask of the chunks of an index matching the filter (cached per filter on the index), None without a filter."""
+    if search_filter is None:
+        return None
+    allowed = index._allowed.get(search_filter)
+    if allowed is None:
+        rows = np.asarray(allowed_rows(search_filter, index.data_types, index.categories), dtype=np.int64)
+        mask = np.zeros(len(index.chunk_ids), dtype=bool)
+        mask[rows] = True
+        allowed = index._allowed[search_filter] = (rows, mask)
+    return allowed
+
+
+def graph_version(driver, model=VECTOR_MODEL):
+    records, _, _ = driver.execute_query(VERSION_CYPHER.format(label=embedding_label(model)), model=model)
+    record = records[0] if records else {"count": 0, "last": None, "tagged": 0}
+    return hashlib.sha1(f"{model}:{record['count']}:{record['last']}:{record['tagged']}".encode("utf-8")).hexdigest()[:16]
+
+
+class _IVF:
+    """Inverted file index: vectors are grouped by their nearest k-means centroid, queries only scan the `nprobe` nearest groups."""
+
+    def __init__(self, vectors, iterations=10, seed=0):
+        n = len(vectors)
+        self.nlist = max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(vectors[np.sort(rng.choice(n, min(n, self.nlist * 64), replace=False))])
+        centroids = sample[rng.choice(len(sample), self.nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=self.nlist)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+            centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+        self.centroids = centroids
+
+        assignment = np.concatenate([np.argmax(np.asarray(vectors[i:i + PAGE_SIZE]) @ centroids.T, axis=1) for i in range(0, n, PAGE_SIZE)])
+        self.order = np.argsort(assignment, kind="stable")
+        self.offsets = np.searchsorted(assignment[self.order], np.arange(self.nlist + 1))
+
+    def candidates(self, query, nprobe):
+        nprobe = min(nprobe, self.nlist)
+        nearest = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in nearest])
+
+
+class LocalVectorIndex:
+    """In-memory mirror of the chunk embeddings with top-k search, returning results in the shape of the neo4j vector query."""
+
+    def __init__(self, vectors, chunk_ids, section_ids, titles, version, kind="auto", data_types=None, categories=None):
+        self.vectors = vectors
+        self.chunk_ids = chunk_ids
+        self.section_ids = section_ids
+        self.titles = titles
+        self.version = version
+        self.data_types = data_types if data_types is not None else [None] * len(chunk_ids)
+        self.categories = categories if categories is not None else [None] * len(chunk_ids)
+        self._allowed = {}
+        self.kind = self._select_kind(kind, len(chunk_ids))
+        self._ivf = None
+        self._hnsw = None
+        if self.kind == "ivf":
+            self._ivf = _IVF(vectors)
+        elif self.kind == "hnsw":
+            self._hnsw = self._build_hnsw(vectors)
+
+    @staticmethod
+    def _select_kind(kind, n):
+        if kind in ("auto", "1", "true"):
+            if n <= FLAT_LIMIT:
+                return "flat"
+            try:
+                import hnswlib  # noqa: F401
+                return "hnsw"
+            except ImportError:
+                return "ivf"
+        return kind
+
+    @staticmethod
+    def _build_hnsw(vectors):
+        import hnswlib
+        index = hnswlib.Index(space="ip", dim=vectors.shape[1])
+        index.init_index(max_elements=len(vectors), ef_construction=200, M=16)
+        for i in range(0, len(vectors), PAGE_SIZE):
+            index.add_items(np.asarray(vectors[i:i + PAGE_SIZE]), np.arange(i, min(i + PAGE_SIZE, len(vectors))))
+        return index
+
+    @classmethod
+    def load(cls, driver, cache_dir, kind="auto", model=VECTOR_MODEL):
+        """
+        Loads all embeddings of `model` from the graph into a memory-mapped matrix in `cache_dir`. An existing matrix of the same graph version is reused.
+        """
+        version = graph_version(driver, model)
+        matrix_path = os.path.join(cache_dir, f"embeddings-{version}.f32")
+        meta_path = os.path.join(cache_dir, f"embeddings-{version}.json")
+
+        if not (os.path.exists(matrix_path) and os.path.exists(meta_path)):
+            os.makedirs(cache_dir, exist_ok=True)
+            cls._download(driver, matrix_path, meta_path, model)
+
+        with open(meta_path, encoding="utf-8") as meta_file:
+            meta = json.load(meta_file)
+        shape = (len(meta["chunk_ids"]), meta["dim"])
+        vectors = np.memmap(matrix_path, dtype=np.float32, mode="r", shape=shape) if shape[0] else np.zeros((0, meta["dim"]), dtype=np.float32)
+        return cls(vectors, meta["chunk_ids"], meta["section_ids"], meta["titles"], version, kind, meta.get("data_types"), meta.get("categories"))
+
+    @staticmethod
+    def _download(driver, matrix_path, meta_path, model):
+        records, _, _ = driver.execute_query(VERSION_CYPHER.format(label=embedding_label(model)), model=model)
+        capacity = records[0]["count"] if records else 0
+        chunk_ids, section_ids, titles, data_types, categories = [], [], [], [], []
+        matrix = None
+        dim = 1024
+        skip = 0
+        # pages are written straight into the memory-mapped file, so the full matrix is never held in memory
+        while skip < capacity:
+            records, _, _ = driver.execute_query(EMBEDDING_PAGE_CYPHER.format(label=embedding_label(model)), model=model, skip=skip, limit=PAGE_SIZE)
+            if not records:
+                break
+            page = np.asarray([record["value"] for record in records], dtype=np.float32)
+            page /= np.linalg.norm(page, axis=1, keepdims=True) + 1e-12
+            if matrix is None:
+                dim = page.shape[1]
+                matrix = np.memmap(matrix_path + ".tmp", dtype=np.float32, mode="w+", shape=(capacity, dim))
+            matrix[len(chunk_ids):len(chunk_ids) + len(page)] = page
+            for record in records:
+                chunk_ids.append(record["chunk_id"])
+                section_ids.append(record["section_id"])
+                titles.append(record["title"])
+                data_types.append(record["data_types"])
+                categories.append(record["category"])
+            skip += PAGE_SIZE
+
+        if matrix is not None:
+            matrix.flush()
+            del matrix
+            os.replace(matrix_path + ".tmp", matrix_path)
+        else:
+            open(matrix_path, "wb").close()
+
+        with open(meta_path, "w", encoding="utf-8") as meta_file:
+            json.dump({"dim": dim, "chunk_ids": chunk_ids, "section_ids": section_ids, "titles": titles,
+                       "data_types": data_types, "categories": categories}, meta_file)
+
+    def top_chunks(self, query_vector, k, nprobe=8, allowed=None):
+        """Returns the row indices and cosine similarities of the k nearest chunks, only among the `allowed` rows if given."""
+        if not len(self.chunk_ids):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        query = np.array(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) + 1e-12
+        k = min(k, len(self.chunk_ids))
+
+        if allowed is not None and (len(allowed[0]) <= FLAT_LIMIT or (self._hnsw is None and self._ivf is None)):
+            # pre-filtered exact search over the matching rows only
+            rows = allowed[0]
+        elif self._hnsw is not None:
+            self._hnsw.set_ef(max(64, 4 * k))
+            if allowed is not None:
+                mask = allowed[1]
+                rows, distances = self._hnsw.knn_query(query, k=min(k, len(allowed[0])), filter=lambda label: mask[label])
+            else:
+                rows, distances = self._hnsw.knn_query(query, k=k)
+            return rows[0].astype(np.int64), 1.0 - distances[0]
+        else:
+            rows = self._ivf.candidates(query, nprobe) if self._ivf is not None else None
+            if rows is not None and allowed is not None:
+                rows = rows[allowed[1][rows]]
+        scores = (self.vectors[rows] if rows is not None else self.vectors) @ query
+        k = min(k, len(scores))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return (rows[top] if rows is not None else top), scores[top]
+
+    def search(self, query_vector, k, score_threshold, search_filter=None):
+        """
+        Top-k vector search with the semantics of the neo4j query in `RRFGraphQuery`: the k nearest chunks above the score threshold, grouped by their section with the maximum score.
+        neo4j reports cosine similarities normalized to [0, 1] as (1 + cos) / 2, the same normalization is applied here.
+        """
+        rows, similarities = self.top_chunks(query_vector, k, allowed=filtered_rows(self, search_filter))
+        results = {}
+        for row, similarity in zip(rows, similarities):
+            score = float((1.0 + similarity) / 2.0)
+            if score <= score_threshold:
+                continue
+            section_id = self.section_ids[row]
+            if section_id not in results or results[section_id]["maxScore"] < score:
+                results[section_id] = {"title": self.titles[row], "id": section_id, "maxScore": score}
+        return list(results.values())
+
+
+#----------------- Shared index -----------------#
+_index = None
+_lock = threading.Lock()
+_last_check = 0.0
+_refreshing = False
+
+
+def _configured_kind():
+    return os.environ.get("NORMGRAPH_LOCAL_VECTOR_INDEX", "").lower() or os.environ.get("NORMGRAPH_VECTOR_QUANTIZATION", "").lower()
+
+
+def _cache_dir():
+    return os.environ.get("NORMGRAPH_VECTOR_CACHE", ".vector_cache")
+
+
+def _rebuild(driver):
+    global _index, _refreshing
+    try:
+        from base_agent.utils.quantization import QuantizedIndex, configured_quantization
+        quantization, dim, oversample = configured_quantization()
+        # loading the index is not bounded by the deadline of the request that triggered it
+        with unbounded(), span("local_index.load") as load_span:
+            if quantization:
+                index = QuantizedIndex.load(driver, quantization, dim, oversample)
+                index.version = graph_version(driver)
+                load_span.set("memory_bytes", index.memory_bytes())
+            else:
+                index = LocalVectorIndex.load(driver, _cache_dir(), _configured_kind())
+            load_span.set("vectors", len(index.chunk_ids))
+            load_span.set("kind", index.kind)
+        _index = index
+    finally:
+        _refreshing = False
+
+
+def refresh_if_stale(driver, force=False):
+    """Rebuilds the shared index in a background thread if the graph version changed."""
+    global _last_check, _refreshing
+    interval = float(os.environ.get("NORMGRAPH_VECTOR_REFRESH_S", "300"))
+    now = time.monotonic()
+    with _lock:
+        if _refreshing or (not force and now - _last_check < interval):
+            return
+        _last_check = now
+        _refreshing = True
+    try:
+        stale = force or _index is None or graph_version(driver) != _index.version
+    except Exception:
+        stale = False
+    if stale:
+        threading.Thread(target=_rebuild, args=(driver,), daemon=True, name="LocalVectorIndexRefresh").start()
+    else:
+        _refreshing = False
+
+
+def get_local_index(driver):
+    """
+    Returns the shared local index, or None if it is disabled. The first call loads the index synchronously, later calls trigger background refreshes when the graph version changes.
+    """
+    global _last_check
+    if not _configured_kind():
+        return None
+    if _index is None:
+        with _lock:
+            if _index is None:
+                _rebuild(driver)
+                _last_check = time.monotonic()
+        return _index
+    refresh_if_stale(driver)
+    return _index
+
+
+def on_graph_update(driver):
+    """Refresh hook for the ingestion pipeline: rebuilds the shared index if the embeddings changed."""
+    if _configured_kind():
+        refresh_if_stale(driver, force=True)
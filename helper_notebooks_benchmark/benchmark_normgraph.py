@@ -0,0 +1,476 @@
+"""
+Automated benchmark runner for the full NormGraph application graph.
+
+The script feeds the questions of `questions.csv` through the compiled `graph` of `base_agent/agent.py` and records per question:
+- the end-to-end wall time
+- the wall time spent in each graph node
+- the number of LLM, embedding and Neo4j calls
+- the prompt- and completion-token counts of all LLM calls, and the prompt tokens served from OpenAI's prompt cache
+- the time to first token of every streaming LLM call, per graph node
+- the attempts of the model cascade of the expert nodes (see `base_agent/utils/cascade.py`): escalations and latency per model
+- the tokens of the database step results before and after their compaction (see `base_agent/utils/compaction.py`, enabled with `NORMGRAPH_STEP_COMPACTION=1`)
+
+`HumanFeedback` interrupts are answered automatically from a fixture file (`human_feedback.json`), so expert plans containing `Human[...]` steps run without manual interaction. With `NORMGRAPH_BATCH_HUMAN_STEPS=1` the dependency-free `Human[...]` steps of a plan are asked in one interrupt, the `interrupts` column shows the saved interrupt/resume cycles.
+
+The per-question results are written to a csv-file comparable to `results/token_counts_*.csv`, a json-file contains the aggregated statistics (p50/p95/p99 latencies, per-node timings, call counts).
+
+Usage (run from the repository root, so `base_agent` is importable):
+```shell
+python -m helper_notebooks_benchmark.benchmark_normgraph --concurrency 4 --limit 10
+```
+"""
+
+import argparse
+import asyncio
+import contextvars
+import csv
+import json
+import os
+import re
+import time
+import uuid
+from typing import Dict, List
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import HumanMessage
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+from base_agent.agent import graph
+from base_agent.utils import tools
+from base_agent.utils.deadline import with_budget
+from base_agent.utils.tracing import add_span_processor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Statistics of the question that is currently processed. Set per asyncio task, so concurrent questions don't mix up their counts.
+_current_stats = contextvars.ContextVar("normgraph_benchmark_stats", default=None)
+
+
+class QuestionStats:
+    """Collects all measurements of a single benchmark question."""
+
+    def __init__(self, question: str):
+        self.question = question
+        self.response = ""
+        self.latency = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.llm_calls = 0
+        self.embedding_calls = 0
+        self.neo4j_calls = 0
+        self.interrupts = 0
+        self.node_times: Dict[str, List[float]] = {}
+        self.ttft: Dict[str, List[float]] = {}
+        self.cascade_attempts: List[Dict] = []
+        self.step_tokens_full = 0
+        self.step_tokens_compacted = 0
+        self.error = ""
+
+    def add_node_time(self, node: str, duration: float):
+        self.node_times.setdefault(node, []).append(duration)
+
+    def to_row(self) -> Dict:
+        return {
+            "question": self.question,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "latency_s": round(self.latency, 3),
+            "llm_calls": self.llm_calls,
+            "embedding_calls": self.embedding_calls,
+            "neo4j_calls": self.neo4j_calls,
+            "interrupts": self.interrupts,
+            "escalations": sum(1 for attempt in self.cascade_attempts if not attempt["accepted"]),
+            "step_tokens_full": self.step_tokens_full,
+            "step_tokens_compacted": self.step_tokens_compacted,
+            "node_times_s": json.dumps({node: round(sum(times), 3) for node, times in self.node_times.items()}),
+            "error": self.error,
+            "response": self.response,
+        }
+
+
+class BenchmarkCallbackHandler(BaseCallbackHandler):
+    """Callback handler measuring the wall time of each graph node and the token usage of each LLM call."""
+
+    def __init__(self, stats: QuestionStats):
+        self.stats = stats
+        self._node_starts = {}
+        self._llm_starts = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # only the outermost run of a node carries the node name, nested runnables inherit the metadata
+        if node is not None and kwargs.get("name") == node:
+            self._node_starts[run_id] = (node, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish_node(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish_node(run_id)
+
+    def _finish_node(self, run_id):
+        started = self._node_starts.pop(run_id, None)
+        if started is not None:
+            node, start = started
+            self.stats.add_node_time(node, time.perf_counter() - start)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        self._llm_starts[run_id] = ((metadata or {}).get("langgraph_node") or "", time.perf_counter())
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        started = self._llm_starts.pop(run_id, None)
+        if started is not None:
+            node, start = started
+            self.stats.ttft.setdefault(node, []).append(time.perf_counter() - start)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._llm_starts.pop(run_id, None)
+        self.stats.llm_calls += 1
+        prompt_tokens, completion_tokens = _token_usage(response)
+        self.stats.prompt_tokens += prompt_tokens
+        self.stats.completion_tokens += completion_tokens
+        self.stats.cached_tokens += _cached_tokens(response)
+
+
+def _token_usage(response):
+    """Extracts prompt- and completion-tokens from an LLMResult (streamed and non-streamed responses)."""
+    prompt_tokens = 0
+    completion_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            usage = getattr(message, "usage_metadata", None)
+            if usage:
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+
+    if prompt_tokens == 0 and completion_tokens == 0 and response.llm_output:
+        token_usage = response.llm_output.get("token_usage") or {}
+        prompt_tokens = token_usage.get("prompt_tokens", 0)
+        completion_tokens = token_usage.get("completion_tokens", 0)
+
+    return prompt_tokens, completion_tokens
+
+
+def _cached_tokens(response):
+    """Extracts the prompt tokens served from the provider's prompt cache from an LLMResult."""
+    cached_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+            cached_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+    return cached_tokens
+
+
+class CountingEmbeddingClient:
+    """Proxy around the VoyageAI client counting embedding calls of the current question."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def embed(self, *args, **kwargs):
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.embedding_calls += 1
+        return self._client.embed(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class CountingDriver:
+    """Proxy around the neo4j driver counting the queries of the current question."""
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    def execute_query(self, *args, **kwargs):
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.neo4j_calls += 1
+        return self._driver.execute_query(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+
+def record_cascade_attempt(finished_span):
+    """Span processor collecting the attempts of the model cascade of the current question."""
+    stats = _current_stats.get()
+    if stats is not None and finished_span.name == "cascade.attempt":
+        stats.cascade_attempts.append({
+            "node": finished_span.attributes.get("node", ""),
+            "model": finished_span.attributes.get("model", ""),
+            "accepted": bool(finished_span.attributes.get("accepted")),
+            "duration": finished_span.duration,
+        })
+
+
+def record_compaction(finished_span):
+    """Span processor collecting the token reduction of the compacted step results per plan of the current question."""
+    stats = _current_stats.get()
+    if stats is not None and finished_span.name == "compaction.plan":
+        stats.step_tokens_full += finished_span.attributes.get("full_tokens", 0)
+        stats.step_tokens_compacted += finished_span.attributes.get("compacted_tokens", 0)
+
+
+def install_counters():
+    """Wraps the module level clients of `base_agent.utils.tools` with counting proxies."""
+    add_span_processor(record_cascade_attempt)
+    add_span_processor(record_compaction)
+    if not isinstance(tools.vo, CountingEmbeddingClient):
+        tools.vo = CountingEmbeddingClient(tools.vo)
+    if not isinstance(tools.driver, CountingDriver):
+        tools.driver = CountingDriver(tools.driver)
+
+
+def load_questions(filename: str) -> List[str]:
+    """
+    Load the benchmark questions from a csv-file.
+
+    Args:
+    filename (str): Path to the csv-file (column 'Questions', delimiter ';').
+
+    Returns:
+    List[str]: The list of questions.
+    """
+    with open(filename, newline='', encoding='utf-8-sig') as input_file:
+        reader = csv.DictReader(input_file, delimiter=';')
+        return [row['Questions'].strip() for row in reader if row['Questions'].strip()]
+
+
+def load_feedback_fixture(filename: str) -> Dict:
+    with open(filename, encoding='utf-8') as fixture_file:
+        return json.load(fixture_file)
+
+
+def answer_for(question: str, fixture: Dict) -> str:
+    """
+    Select the fixture answer for a question asked by a `Human[...]` step. Questions of several steps asked together (numbered lines, see `NORMGRAPH_BATCH_HUMAN_STEPS`) are answered line by line.
+
+    Args:
+    question (str): The question the expert model asks the user.
+    fixture (Dict): The fixture containing keyword based answers and a default answer.
+
+    Returns:
+    str: The answer to feed back into the graph.
+    """
+    numbered = re.findall(r"^\s*(\d+)\.\s+(.+)$", question, re.MULTILINE)
+    if len(numbered) > 1:
+        return "\n".join(f"{number}. {answer_for(text, fixture)}" for number, text in numbered)
+
+    lowered = question.lower()
+    for entry in fixture.get("answers", []):
+        if any(keyword.lower() in lowered for keyword in entry["match"]):
+            return entry["answer"]
+    return fixture.get("default", "")
+
+
+async def run_question(question: str, fixture: Dict, max_interrupts: int, budget_s: float = None) -> QuestionStats:
+    """
+    Run a single question through the graph, answering `HumanFeedback` interrupts from the fixture.
+
+    Args:
+    question (str): The benchmark question.
+    fixture (Dict): The human feedback fixture.
+    max_interrupts (int): Safety limit of interrupt/resume cycles per question.
+    budget_s (float): Optional latency budget per graph invocation (see `base_agent/utils/deadline.py`).
+
+    Returns:
+    QuestionStats: The measurements of the run.
+    """
+    stats = QuestionStats(question)
+    _current_stats.set(stats)
+    config = {
+        "configurable": {"thread_id": str(uuid.uuid4())},
+        "callbacks": [BenchmarkCallbackHandler(stats)],
+        "recursion_limit": 100,
+    }
+
+    start = time.perf_counter()
+    try:
+        graph_input = {"messages": [HumanMessage(question)]}
+        while True:
+            await graph.ainvoke(graph_input, with_budget(config, budget_s) if budget_s else config)
+            state = await graph.aget_state(config)
+            if "HumanFeedback" not in state.next:
+                break
+            if stats.interrupts >= max_interrupts:
+                raise RuntimeError(f"exceeded {max_interrupts} HumanFeedback interrupts")
+
+            stats.interrupts += 1
+            asked = state.values["messages"][-1].content
+            await graph.aupdate_state(config, {"messages": [HumanMessage(answer_for(asked, fixture))]})
+            graph_input = None
+
+        messages = state.values.get("messages", [])
+        stats.response = "\n".join(str(message.content) for message in messages[1:] if message.type == "ai" and message.content)
+    except Exception as e:
+        stats.error = f"{type(e).__name__}: {e}"
+    stats.latency = time.perf_counter() - start
+
+    print(f"Antwort für die Frage: '{question}' wurde generiert ({stats.latency:.1f}s). \nPrompt Tokens: {stats.prompt_tokens}; Completion Tokens: {stats.completion_tokens} \n")
+    return stats
+
+
+async def run_benchmark(questions: List[str], fixture: Dict, concurrency: int, max_interrupts: int, budget_s: float = None) -> List[QuestionStats]:
+    """
+    Run all questions through the graph, processing up to `concurrency` questions at the same time.
+    """
+    install_counters()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(question):
+        async with semaphore:
+            return await run_question(question, fixture, max_interrupts, budget_s)
+
+    return await asyncio.gather(*(bounded(question) for question in questions))
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Linear interpolated percentile (q in [0, 100]) of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize_cascade(results: List[QuestionStats]) -> Dict:
+    """
+    Aggregate the attempts of the model cascade: escalation rate and latency per node and model.
+
+    The saved latency is estimated per node as the number of steps answered by the small model times the difference of the mean latencies of the large and the small model, minus the time spent on escalated small-model attempts.
+    """
+    attempts: Dict[str, Dict[str, List[Dict]]] = {}
+    for result in results:
+        for attempt in result.cascade_attempts:
+            attempts.setdefault(attempt["node"], {}).setdefault(attempt["model"], []).append(attempt)
+
+    summary = {}
+    for node, models in sorted(attempts.items()):
+        small = models.get("mini", [])
+        large = models.get("base", [])
+        escalated = sum(1 for attempt in small if not attempt["accepted"])
+        mean = {model: sum(attempt["duration"] for attempt in node_attempts) / len(node_attempts) for model, node_attempts in models.items()}
+        saved = (len(small) - escalated) * (mean["base"] - mean["mini"]) - escalated * mean["mini"] if small and large else 0.0
+        summary[node] = {
+            "steps": sum(1 for node_attempts in models.values() for attempt in node_attempts if attempt["accepted"]),
+            "small_model_attempts": len(small),
+            "escalation_rate": round(escalated / len(small), 4) if small else 0.0,
+            "mean_latency_s": {model: round(value, 3) for model, value in mean.items()},
+            "estimated_latency_saved_s": round(saved, 3),
+        }
+    return summary
+
+
+def summarize(results: List[QuestionStats], wall_time: float, concurrency: int) -> Dict:
+    """Aggregate the per-question measurements to the benchmark summary."""
+    latencies = [result.latency for result in results if not result.error]
+
+    node_times: Dict[str, List[float]] = {}
+    ttft: Dict[str, List[float]] = {}
+    for result in results:
+        for node, times in result.node_times.items():
+            node_times.setdefault(node, []).extend(times)
+        for node, times in result.ttft.items():
+            ttft.setdefault(node, []).extend(times)
+    prompt_tokens = sum(result.prompt_tokens for result in results)
+    cached_tokens = sum(result.cached_tokens for result in results)
+    step_tokens_full = sum(result.step_tokens_full for result in results)
+    step_tokens_compacted = sum(result.step_tokens_compacted for result in results)
+
+    return {
+        "questions": len(results),
+        "errors": sum(1 for result in results if result.error),
+        "concurrency": concurrency,
+        "wall_time_s": round(wall_time, 3),
+        "throughput_questions_per_min": round(len(results) / wall_time * 60, 2) if wall_time else 0.0,
+        "latency_s": {
+            "mean": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+        },
+        "totals": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": sum(result.completion_tokens for result in results),
+            "cached_tokens": cached_tokens,
+            "prompt_cache_hit_ratio": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+            "llm_calls": sum(result.llm_calls for result in results),
+            "embedding_calls": sum(result.embedding_calls for result in results),
+            "neo4j_calls": sum(result.neo4j_calls for result in results),
+            "interrupts": sum(result.interrupts for result in results),
+            "step_tokens_full": step_tokens_full,
+            "step_tokens_compacted": step_tokens_compacted,
+            "step_token_reduction": round(1 - step_tokens_compacted / step_tokens_full, 4) if step_tokens_full else 0.0,
+        },
+        "nodes": {
+            node: {
+                "calls": len(times),
+                "total_s": round(sum(times), 3),
+                "mean_s": round(sum(times) / len(times), 3),
+                "p50_s": round(percentile(times, 50), 3),
+                "p95_s": round(percentile(times, 95), 3),
+            }
+            for node, times in sorted(node_times.items())
+        },
+        "ttft": {
+            node: {
+                "calls": len(times),
+                "p50_s": round(percentile(times, 50), 3),
+                "p95_s": round(percentile(times, 95), 3),
+            }
+            for node, times in sorted(ttft.items())
+        },
+        "cascade": summarize_cascade(results),
+    }
+
+
+def save_results(results: List[QuestionStats], summary: Dict, output_prefix: str):
+    """
+    Save the per-question results to `<output_prefix>.csv` and the summary to `<output_prefix>.json`.
+    """
+    rows = [result.to_row() for result in results]
+    with open(output_prefix + ".csv", 'w', newline='', encoding='utf-8') as output_file:
+        dict_writer = csv.DictWriter(output_file, rows[0].keys())
+        dict_writer.writeheader()
+        dict_writer.writerows(rows)
+
+    with open(output_prefix + ".json", 'w', encoding='utf-8') as output_file:
+        json.dump(summary, output_file, indent=2, ensure_ascii=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the NormGraph application graph.")
+    parser.add_argument("--questions", default=os.path.join(BENCHMARK_DIR, "questions.csv"))
+    parser.add_argument("--feedback", default=os.path.join(BENCHMARK_DIR, "human_feedback.json"), help="fixture answering HumanFeedback interrupts")
+    parser.add_argument("--output", default=os.path.join(BENCHMARK_DIR, "results", "token_counts_NormGraph"), help="output path without file extension")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=None, help="only run the first N questions")
+    parser.add_argument("--max-interrupts", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=None, help="latency budget per graph invocation in seconds")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)[:args.limit]
+    fixture = load_feedback_fixture(args.feedback)
+
+    start = time.perf_counter()
+    results = asyncio.run(run_benchmark(questions, fixture, args.concurrency, args.max_interrupts, args.budget))
+    summary = summarize(results, time.perf_counter() - start, args.concurrency)
+
+    save_results(results, summary, args.output)
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
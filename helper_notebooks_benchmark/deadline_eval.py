@@ -0,0 +1,177 @@
+"""
+Tail-latency evaluation of the request deadlines, dependency timeouts and hedged calls (`base_agent/utils/deadline.py`).
+
+The retrieval of a request (lexical query, query embedding and vector query, lookup of the section context) is simulated against the in-process fakes of `fakes.py`, whose latency profiles have a slow tail. Every configuration runs the same requests:
+- none: no timeouts and no hedging
+- timeouts: per-dependency timeouts and the request budget, a leg exceeding the deadline is dropped
+- hedged: additionally a duplicate request after the p95 latency of the dependency
+
+Reported per configuration: p50/p95/p99 request latency, failed requests (deadline exceeded before any result), degraded requests (a dropped leg), the share of hedged calls and how often the hedge answered first. No credentials or network access are needed.
+
+Usage (run from the repository root):
+```shell
+python -m helper_notebooks_benchmark.deadline_eval --requests 2000 --concurrency 8 --neo4j 15:0.02:2000 --embedding 60:0.02:3000 --budget 1.5
+```
+"""
+
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from base_agent.utils import deadline
+from base_agent.utils.deadline import DeadlineExceeded, DeadlineProxy, deadline_scope, unbounded, with_budget
+from base_agent.utils.tracing import add_span_processor, remove_span_processor, span
+from helper_notebooks_benchmark.fakes import FakeEmbeddingClient, FakeGraphDriver, parse_profile
+
+CONFIGURATIONS = {
+    "none": {"NORMGRAPH_HEDGE": "", "bounded": False},
+    "timeouts": {"NORMGRAPH_HEDGE": "", "bounded": True},
+    "hedged": {"NORMGRAPH_HEDGE": "embedding,neo4j", "bounded": True},
+}
+WARMUP_REQUESTS = 50    # requests filling the latency trackers before the measurement
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class _CallCounter:
+    """Span processor counting the bounded calls of the evaluation."""
+
+    def __init__(self):
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_won = 0
+        self.exceeded = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, finished_span):
+        if not finished_span.name.startswith("eval.call."):
+            return
+        with self._lock:
+            self.calls += 1
+            self.hedged += bool(finished_span.attributes.get("hedged"))
+            self.hedge_won += bool(finished_span.attributes.get("hedge_won"))
+            self.exceeded += bool(finished_span.attributes.get("deadline_exceeded"))
+
+
+def simulated_request(number, driver, client, budget_s, bounded):
+    """
+    Runs the retrieval of one request like `RRFGraphQuery` and `get_section_context`: a leg exceeding the deadline is dropped, the request fails if both legs are dropped or the context lookup exceeds the deadline.
+
+    Returns:
+    tuple: (latency in seconds, failed, degraded)
+    """
+    scope = deadline_scope(with_budget({}, budget_s)) if bounded else unbounded()
+    start = time.perf_counter()
+    legs = 0
+    failed = False
+    with scope:
+        try:
+            with span("eval.call.lexical"):
+                driver.execute_query("lexical", query=f"question {number}")
+            legs += 1
+        except DeadlineExceeded:
+            pass
+        try:
+            with span("eval.call.embed"):
+                client.embed(texts=[f"question {number}"], model="fake", input_type="query")
+            with span("eval.call.vector"):
+                driver.execute_query("vector", query=f"question {number}")
+            legs += 1
+        except DeadlineExceeded:
+            pass
+        try:
+            if legs == 0:
+                raise DeadlineExceeded("both retrieval legs exceeded the deadline")
+            with span("eval.call.lookup"):
+                driver.execute_query("lookup", query=f"question {number}")
+        except DeadlineExceeded:
+            failed = True
+    return time.perf_counter() - start, failed, not failed and legs < 2
+
+
+def evaluate(name, settings, args):
+    """
+    Runs all requests with one configuration against freshly seeded fakes.
+
+    Returns:
+    dict: Latency percentiles, failed and degraded requests and hedge statistics of the configuration.
+    """
+    os.environ["NORMGRAPH_HEDGE"] = settings["NORMGRAPH_HEDGE"]
+    os.environ["NORMGRAPH_TIMEOUTS"] = f"neo4j={args.neo4j_timeout},embedding={args.embedding_timeout}"
+    # the latency trackers are process-wide, every configuration starts without history
+    deadline._trackers.clear()
+    driver = DeadlineProxy(FakeGraphDriver(parse_profile(args.neo4j, seed=args.seed)), "neo4j", ["execute_query"], hedge=True)
+    client = DeadlineProxy(FakeEmbeddingClient(parse_profile(args.embedding, seed=args.seed + 1), dim=args.dim), "embedding", ["embed"], hedge=True)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(lambda number: simulated_request(number, driver, client, args.budget, settings["bounded"]), range(WARMUP_REQUESTS)))
+        counter = _CallCounter()
+        add_span_processor(counter)
+        try:
+            start = time.perf_counter()
+            results = list(executor.map(lambda number: simulated_request(number, driver, client, args.budget, settings["bounded"]), range(args.requests)))
+            wall_time = time.perf_counter() - start
+        finally:
+            remove_span_processor(counter)
+
+    latencies = [latency for latency, _, _ in results]
+    return {
+        "configuration": name,
+        "requests": len(results),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies) * 1000, 1),
+        "failed": sum(failed for _, failed, _ in results),
+        "degraded": sum(degraded for _, _, degraded in results),
+        "calls_exceeded": counter.exceeded,
+        "hedge_rate": round(counter.hedged / counter.calls, 4) if counter.calls else 0.0,
+        "hedge_wins": counter.hedge_won,
+        "requests_per_s": round(len(results) / wall_time, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate timeouts and hedged calls against fake services with slow tails.")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--neo4j", default="15:0.02:2000", help="latency profile of neo4j 'p50_ms:tail_prob:tail_ms'")
+    parser.add_argument("--embedding", default="60:0.02:3000", help="latency profile of the embedding service 'p50_ms:tail_prob:tail_ms'")
+    parser.add_argument("--neo4j-timeout", type=float, default=1.0)
+    parser.add_argument("--embedding-timeout", type=float, default=1.0)
+    parser.add_argument("--budget", type=float, default=1.5, help="latency budget per request in seconds")
+    parser.add_argument("--dim", type=int, default=8, help="dimension of the fake embeddings")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--configurations", nargs="+", choices=list(CONFIGURATIONS), default=list(CONFIGURATIONS))
+    parser.add_argument("--output", default=None, help="output path without file extension (csv and json)")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.configurations:
+        result = evaluate(name, CONFIGURATIONS[name], args)
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output + ".csv", 'w', newline='', encoding='utf-8') as output_file:
+            dict_writer = csv.DictWriter(output_file, results[0].keys())
+            dict_writer.writeheader()
+            dict_writer.writerows(results)
+        with open(args.output + ".json", 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
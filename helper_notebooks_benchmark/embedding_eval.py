@@ -0,0 +1,152 @@
+"""
+Query latency and retrieval quality of the embedding backends (`base_agent/utils/embedders.py`): VoyageAI and the local CPU model.
+
+For every backend the questions of `questions.csv` are embedded one by one, like the query embedding of a retrieval without a cache hit, and once in batches:
+- first call: latency of the first request (model load of the local backend, connection setup of VoyageAI)
+- p50/p95/p99 latency of a single query embedding and the throughput of the batched embedding
+- recall@k, MRR and nDCG@k of the labelled questions (`retrieval_labels.json`) for the vector search alone and for the hybrid ranking (vector search fused with the lexical leg, like `RRFGraphQuery`)
+
+The retrieval quality needs the embeddings of the model in the graph (`reembed` in `voyage_embed.ipynb`), backends without embeddings only report the latency. The vector scores of the models are distributed differently, so every backend is evaluated at each `--threshold`.
+
+Usage (run from the repository root):
+```shell
+python -m helper_notebooks_benchmark.embedding_eval --backends voyage local --threshold 0.0 0.8 --output results/embedding_eval
+```
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from typing import Dict, List
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+from base_agent.utils import tools
+from base_agent.utils.embedders import create_embedding_client, embedding_label, embedding_model, vector_index_name
+from base_agent.utils.lexical import lexical_search
+from helper_notebooks_benchmark.benchmark_normgraph import load_questions, percentile
+from helper_notebooks_benchmark.retrieval_eval import load_labels, ndcg_at_k, recall_at_k, reciprocal_rank
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+COUNT_CYPHER = "MATCH (e:{label} {{model: $model}}) RETURN count(e) AS count"
+
+VECTOR_CYPHER = """
+CALL db.index.vector.queryNodes($vecIndex, $resultCount, $queryEmbedding)
+YIELD node, score WHERE score > $scoreThreshold
+MATCH (node)<-[:HAS_EMBEDDING]-(chunk)-[:PART_OF]->(root)
+RETURN root.id AS id, MAX(score) AS maxScore
+ORDER BY maxScore DESC
+"""
+
+
+def measure_latency(client, model: str, questions: List[str], repeat: int) -> Dict:
+    """
+    Embeds every question on its own (`repeat` times) and all questions in batches, directly with the client (no embedding cache).
+
+    Returns:
+    Dict: First call latency, single query latency percentiles and batch throughput.
+    """
+    start = time.perf_counter()
+    client.embed(["Warmup"], model=model, input_type="query")
+    first_call = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(repeat):
+        for question in questions:
+            start = time.perf_counter()
+            client.embed([question], model=model, input_type="query")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, len(questions), tools.EMBED_BATCH_SIZE):
+        client.embed(questions[i:i + tools.EMBED_BATCH_SIZE], model=model, input_type="query")
+    batch_time = time.perf_counter() - start
+
+    return {
+        "first_call_ms": round(first_call * 1000, 1),
+        "query_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "query_p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "query_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "batch_texts_per_s": round(len(questions) / batch_time, 1) if batch_time else 0.0,
+    }
+
+
+def measure_quality(client, model: str, labels: List[Dict], k: int, threshold: float, rrf_k: int) -> Dict:
+    """
+    Evaluates the vector search over the index of the model and its fusion with the lexical leg on the labelled questions.
+
+    Returns:
+    Dict: recall@k, MRR and nDCG@k of the vector and the hybrid ranking.
+    """
+    vector_metrics, hybrid_metrics = [], []
+    for entry in labels:
+        query_embedding = client.embed([entry["question"]], model=model, input_type="query").embeddings[0]
+        records, _, _ = tools.driver.execute_query(VECTOR_CYPHER, vecIndex=vector_index_name(model), resultCount=k,
+                                                   queryEmbedding=query_embedding, scoreThreshold=threshold)
+        vector_ranking = [record["id"] for record in records]
+        search_results = dict(lexical_search(entry["question"], tools.driver), vecSearch=vector_ranking)
+        fused = tools.apply_reciprocal_rank_fusion(tools.gather_unique_values(search_results), list(search_results.keys()), search_results, rrf_k)
+        hybrid_ranking = list(fused.keys())
+        for metrics, ranking in ((vector_metrics, vector_ranking), (hybrid_metrics, hybrid_ranking)):
+            metrics.append((recall_at_k(ranking, entry["expected"], k), reciprocal_rank(ranking, entry["expected"]), ndcg_at_k(ranking, entry["expected"], k)))
+
+    n = len(labels)
+    result = {}
+    for name, metrics in (("vector", vector_metrics), ("hybrid", hybrid_metrics)):
+        result[f"{name}_recall_at_k"] = round(sum(metric[0] for metric in metrics) / n, 4)
+        result[f"{name}_mrr"] = round(sum(metric[1] for metric in metrics) / n, 4)
+        result[f"{name}_ndcg_at_k"] = round(sum(metric[2] for metric in metrics) / n, 4)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare query latency and retrieval quality of the embedding backends.")
+    parser.add_argument("--backends", nargs="+", choices=["voyage", "local"], default=["voyage", "local"])
+    parser.add_argument("--questions", default=os.path.join(BENCHMARK_DIR, "questions.csv"))
+    parser.add_argument("--labels", default=os.path.join(BENCHMARK_DIR, "retrieval_labels.json"))
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3, help="single query embeddings per question")
+    parser.add_argument("--k", type=int, default=tools.DOCUMENT_RETRIEVER_K)
+    parser.add_argument("--threshold", type=float, nargs="+", default=[0.0, tools.VECTOR_SCORE_THRESHOLD])
+    parser.add_argument("--rrf-k", type=int, default=tools.RRF_K)
+    parser.add_argument("--output", default=None, help="output path without file extension (csv and json)")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)[:args.limit]
+    labels = load_labels(args.labels)
+
+    results = []
+    for backend in args.backends:
+        client = create_embedding_client(backend)
+        model = embedding_model(backend)
+        latency = measure_latency(client, model, questions, args.repeat)
+        records, _, _ = tools.driver.execute_query(COUNT_CYPHER.format(label=embedding_label(model)), model=model)
+        embeddings = records[0]["count"] if records else 0
+        if not embeddings or not labels:
+            print(f"{model}: no embeddings of the model in the graph or no labelled questions, only the latency is reported.")
+        for threshold in args.threshold:
+            result = {"backend": backend, "model": model, "embeddings": embeddings, "k": args.k, "score_threshold": threshold, **latency}
+            if embeddings and labels:
+                result.update(measure_quality(client, model, labels, args.k, threshold, args.rrf_k))
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        fields = list(dict.fromkeys(key for result in results for key in result))
+        with open(args.output + ".csv", 'w', newline='', encoding='utf-8') as output_file:
+            dict_writer = csv.DictWriter(output_file, fields)
+            dict_writer.writeheader()
+            dict_writer.writerows(results)
+        with open(args.output + ".json", 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+In-process fakes of the external services for the offline evaluations.
+
+The fakes answer like the neo4j driver and the VoyageAI client, but only sleep for a sampled latency instead of calling the service. The latency profile has a regular part around its median and a slow tail (e.g. a GC pause of the database or a queued embedding request), so timeouts and hedged requests can be evaluated without network access.
+
+The OpenAI API (chat completions incl. streaming and tool calls, the Assistants endpoints of the calculator) is faked by a local HTTP server in a separate process, so the real OpenAI and LangChain clients run unchanged against it (`OPENAI_BASE_URL`) and the server threads don't count towards the memory and threads of the measured process. What the fake model answers is decided by a responder function of the evaluation.
+
+Modules and Classes:
+- LatencyProfile: Class sampling call latencies with a configurable slow tail.
+- FakeGraphDriver: Fake of the neo4j driver (`execute_query`).
+- SyntheticGraph: Rows of the retrieval queries for the fake driver (search results and materialised sections).
+- FakeEmbeddingClient: Fake of the VoyageAI client (`embed`).
+- FakeEncoding: Fake of the tiktoken encoding (`encode`), the real encoding is downloaded on first use.
+- FakeOpenAIServer: Local HTTP server faking the OpenAI chat completions and Assistants API.
+
+Functions:
+- parse_profile: Function parsing a latency profile from a string.
+- stable_hash: Function hashing a value independently of the process (unlike `hash`).
+"""
+
+import hashlib
+import itertools
+import json
+import multiprocessing
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LatencyProfile:
+    """
+    Latencies with a median `p50_ms` (log-normal jitter) and a slow tail: with probability `tail_prob` a call takes `tail_ms` instead.
+    """
+
+    def __init__(self, p50_ms, tail_prob=0.0, tail_ms=0.0, jitter=0.25, seed=0):
+        self.p50_ms = p50_ms
+        self.tail_prob = tail_prob
+        self.tail_ms = tail_ms
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """Returns the latency of the next call in seconds."""
+        with self._lock:
+            if self._random.random() < self.tail_prob:
+                return self.tail_ms / 1000
+            return self.p50_ms * self._random.lognormvariate(0, self.jitter) / 1000
+
+    def __repr__(self):
+        return f"LatencyProfile(p50_ms={self.p50_ms}, tail_prob={self.tail_prob}, tail_ms={self.tail_ms})"
+
+
+def parse_profile(value, seed=0):
+    """Parses 'p50_ms[:tail_prob:tail_ms]', e.g. '15:0.02:2000' (2% of the calls take 2s)."""
+    parts = [float(part) for part in value.split(":")]
+    return LatencyProfile(parts[0], parts[1] if len(parts) > 1 else 0.0, parts[2] if len(parts) > 2 else 0.0, seed=seed)
+
+
+class FakeGraphDriver:
+    """Fake of the neo4j driver: `execute_query` sleeps for a sampled latency and returns the rows of `rows(cypher, parameters)` (no rows by default)."""
+
+    def __init__(self, profile, rows=None):
+        self.profile = profile
+        self.rows = rows
+        self.calls = 0
+
+    def execute_query(self, cypher, **parameters):
+        self.calls += 1
+        time.sleep(self.profile.sample())
+        records = self.rows(cypher, parameters) if self.rows is not None else []
+        return records, None, None
+
+    def close(self):
+        pass
+
+
+def stable_hash(value):
+    return int.from_bytes(hashlib.sha256(str(value).encode("utf-8")).digest()[:8], "big")
+
+
+class SyntheticGraph:
+    """
+    Rows function of `FakeGraphDriver` answering the retrieval queries of `base_agent/utils/tools.py` with a synthetic corpus of `sections` sections:
+    - full-text and vector searches return `k` section ids derived from the query (the same query finds the same sections)
+    - the lookup of materialised sections (see sections.py) returns a rendering of `section_chars` characters per section
+    All other queries return no rows.
+    """
+
+    def __init__(self, sections=500, k=5, section_chars=2000):
+        self.sections = sections
+        self.k = k
+        self.section_chars = section_chars
+
+    def _ids(self, key, count):
+        start = stable_hash(key) % self.sections
+        return [f"section-{(start + offset * 7) % self.sections}" for offset in range(count)]
+
+    def __call__(self, cypher, parameters):
+        if "RenderedSection" in cypher and "ids" in parameters:
+            return [self._section(section_id) for section_id in parameters["ids"]]
+        if "db.index.vector.queryNodes" in cypher:
+            # the embedding of the query decides the sections, its first value is enough to tell queries apart
+            ids = self._ids(parameters.get("queryEmbedding", [0])[0], parameters.get("resultCount", self.k))
+            return [{"title": f"Abschnitt {section_id}", "id": section_id, "maxScore": 0.9 - 0.01 * rank} for rank, section_id in enumerate(ids)]
+        if "db.index.fulltext.queryNodes" in cypher:
+            ids = self._ids(parameters.get("query", ""), min(parameters.get("limit", self.k), self.k))
+            return [{"title": f"Abschnitt {section_id}", "id": section_id, "score": 5.0 - 0.1 * rank} for rank, section_id in enumerate(ids)]
+        return []
+
+    def _section(self, section_id):
+        number = int(section_id.rsplit("-", 1)[1])
+        chapter = number // 50
+        text = f"Abschnitt {number}: " + "Die charakteristische Schneelast auf dem Boden ist nach der Schneelastzone zu bestimmen. " * (self.section_chars // 88 + 1)
+        return {
+            "id": section_id,
+            "rendered": text[:self.section_chars] + "\n",
+            "ancestor_ids": [f"chapter-{chapter}"],
+            "ancestor_nums": [str(chapter)],
+            "ancestor_titles": [f"Kapitel {chapter}"],
+        }
+
+
+class _EmbeddingResponse:
+    __slots__ = ("embeddings",)
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+
+class FakeEmbeddingClient:
+    """Fake of the VoyageAI client: `embed` sleeps for a sampled latency and returns deterministic pseudo-embeddings of the texts."""
+
+    def __init__(self, profile, dim=1024):
+        self.profile = profile
+        self.dim = dim
+        self.calls = 0
+
+    def _embedding(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        generator = random.Random(seed)
+        return [generator.uniform(-1, 1) for _ in range(self.dim)]
+
+    def embed(self, texts, model=None, input_type=None):
+        self.calls += 1
+        time.sleep(self.profile.sample())
+        texts = [texts] if isinstance(texts, str) else texts
+        return _EmbeddingResponse([self._embedding(text) for text in texts])
+
+
+class FakeEncoding:
+    """Fake of the tiktoken encoding: words and punctuation marks count as one token each (roughly the count of `o200k_base` for German text), without the download of the encoding."""
+
+    TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+    def encode(self, text, disallowed_special=()):
+        return [stable_hash(token) % 200000 for token in self.TOKEN_PATTERN.findall(text)]
+
+
+#----------------- OpenAI API -----------------#
+def _text(content):
+    # message contents are strings or lists of content parts
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def _tokens(text):
+    return max(1, len(text) // 4)
+
+
+class _OpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _json(self, payload, status=200):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _chunk(self, payload):
+        data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        self.server.fake.handle(self, "GET", self.path.split("?", 1)[0], None)
+
+    def do_POST(self):
+        self.server.fake.handle(self, "POST", self.path.split("?", 1)[0], self._body())
+
+
+class _OpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients closing their connection (cancelled or timed out requests) are expected under load
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+class FakeOpenAIServer:
+    """
+    Fake of the OpenAI API for the chat models and the calculator assistant of the application.
+
+    Args:
+    respond (callable): Function request body -> (content, tool_calls) deciding the answer of a chat completion, `tool_calls` is a list of (name, arguments dict).
+    llm_profile (LatencyProfile): Latency of a chat completion, streamed completions send their first chunk after `ttft_share` of it.
+    assistant_profile (LatencyProfile): Duration of an assistant run.
+    assistant_reply (str): Answer of the calculator assistant.
+    """
+
+    def __init__(self, respond, llm_profile, assistant_profile, assistant_reply="Das Ergebnis ist 0,85 kN/m².", ttft_share=0.3, chunk_chars=40):
+        self.respond = respond
+        self.llm_profile = llm_profile
+        self.assistant_profile = assistant_profile
+        self.assistant_reply = assistant_reply
+        self.ttft_share = ttft_share
+        self.chunk_chars = chunk_chars
+        self._ids = itertools.count(1)
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def _id(self, prefix):
+        return f"{prefix}_{next(self._ids)}"
+
+    def handle(self, handler, method, path, body):
+        parts = path.strip("/").split("/")[1:]    # without the 'v1' prefix
+        if parts == ["chat", "completions"] and method == "POST":
+            return self._completion(handler, body)
+        if parts[:1] == ["assistants"]:
+            return handler._json({"id": parts[1], "object": "assistant", "created_at": int(time.time()), "model": "gpt-4o",
+                                  "name": "calculator", "description": None, "instructions": None, "tools": [], "metadata": {}})
+        if parts == ["threads"]:
+            return handler._json({"id": self._id("thread"), "object": "thread", "created_at": int(time.time()), "metadata": {}, "tool_resources": None})
+        if parts[:1] == ["threads"] and parts[2:] == ["messages"]:
+            if method == "POST":
+                return handler._json(self._message(parts[1], "user", _text(body.get("content"))))
+            return handler._json({"object": "list", "data": [self._message(parts[1], "assistant", self.assistant_reply)],
+                                  "first_id": None, "last_id": None, "has_more": False})
+        if parts[:1] == ["threads"] and parts[2:3] == ["runs"]:
+            return handler._json(self._run(parts[1], parts[3] if len(parts) > 3 else None, cancel=parts[4:] == ["cancel"], assistant_id=(body or {}).get("assistant_id")))
+        return handler._json({"error": {"message": f"not faked: {method} {path}", "type": "invalid_request_error"}}, status=404)
+
+    def _completion(self, handler, body):
+        content, tool_calls = self.respond(body)
+        latency = self.llm_profile.sample()
+        prompt = "".join(_text(message.get("content")) for message in body.get("messages", []))
+        arguments = [(self._id("call"), name, json.dumps(args, ensure_ascii=False)) for name, args in tool_calls]
+        usage = {"prompt_tokens": _tokens(prompt), "completion_tokens": _tokens((content or "") + "".join(a for _, _, a in arguments)),
+                 "prompt_tokens_details": {"cached_tokens": 0}}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        calls = [{"id": call_id, "type": "function", "function": {"name": name, "arguments": args}} for call_id, name, args in arguments]
+        finish_reason = "tool_calls" if calls else "stop"
+        base = {"id": self._id("chatcmpl"), "created": int(time.time()), "model": body.get("model", "gpt-4o"), "system_fingerprint": None}
+
+        if not body.get("stream"):
+            time.sleep(latency)
+            message = {"role": "assistant", "content": content, "refusal": None}
+            if calls:
+                message["tool_calls"] = calls
+            return handler._json(dict(base, object="chat.completion", usage=usage,
+                                      choices=[{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}]))
+
+        pieces = [content[i:i + self.chunk_chars] for i in range(0, len(content or ""), self.chunk_chars)] or [""]
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        time.sleep(latency * self.ttft_share)
+        delay = latency * (1 - self.ttft_share) / len(pieces)
+
+        def chunk(delta, finish=None):
+            return dict(base, object="chat.completion.chunk", choices=[{"index": 0, "delta": delta, "finish_reason": finish, "logprobs": None}])
+
+        handler._chunk(chunk({"role": "assistant", "content": pieces[0]}))
+        for piece in pieces[1:]:
+            time.sleep(delay)
+            handler._chunk(chunk({"content": piece}))
+        if calls:
+            handler._chunk(chunk({"tool_calls": [dict(call, index=index) for index, call in enumerate(calls)]}))
+        handler._chunk(chunk({}, finish_reason))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            handler._chunk(dict(base, object="chat.completion.chunk", choices=[], usage=usage))
+        handler._chunk("[DONE]")
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.wfile.flush()
+
+    def _message(self, thread_id, role, text):
+        return {"id": self._id("msg"), "object": "thread.message", "created_at": int(time.time()), "thread_id": thread_id, "role": role,
+                "status": "completed", "attachments": [], "metadata": {}, "assistant_id": None, "run_id": None,
+                "content": [{"type": "text", "text": {"value": text, "annotations": []}}]}
+
+    def _run(self, thread_id, run_id, cancel=False, assistant_id=None):
+        with self._lock:
+            if run_id is None:
+                run_id = self._id("run")
+                self._runs[run_id] = {"assistant_id": assistant_id, "done_at": time.monotonic() + self.assistant_profile.sample(), "cancelled": False}
+            run = self._runs[run_id]
+            run["cancelled"] = run["cancelled"] or cancel
+            if run["cancelled"]:
+                status = "cancelled"
+            else:
+                status = "completed" if time.monotonic() >= run["done_at"] else "in_progress"
+        usage = {"prompt_tokens": 500, "completion_tokens": 120, "total_tokens": 620} if status == "completed" else None
+        return {"id": run_id, "object": "thread.run", "created_at": int(time.time()), "thread_id": thread_id, "assistant_id": run["assistant_id"],
+                "status": status, "model": "gpt-4o", "instructions": "", "tools": [], "metadata": {}, "usage": usage,
+                "parallel_tool_calls": True, "response_format": "auto", "tool_choice": "auto", "truncation_strategy": {"type": "auto", "last_messages": None}}
+
+    def _serve(self, ready):
+        server = _OpenAIServer(("127.0.0.1", 0), _OpenAIHandler)
+        server.fake = self
+        ready.send(server.server_address[1])
+        server.serve_forever()
+
+    def start(self):
+        """
+        Starts the server in a forked process.
+
+        Returns:
+        tuple: (process, base url to set as OPENAI_BASE_URL)
+        """
+        context = multiprocessing.get_context("fork")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=self._serve, args=(sender,), daemon=True)
+        process.start()
+        port = receiver.recv()
+        return process, f"http://127.0.0.1:{port}/v1"
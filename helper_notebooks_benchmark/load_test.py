@@ -0,0 +1,396 @@
+"""
+Load test of the application graph (`base_agent/agent.py:graph`) with simulated users against local fakes of OpenAI, VoyageAI and neo4j.
+
+Every concurrency level runs `concurrency` simulated users in a closed loop: a user sends a question, answers the `HumanFeedback` interrupts of the expert plan after a think time (answers from `human_feedback.json`) and starts the next conversation, until the conversations of the level are done. The external services are replaced by the fakes of `fakes.py`:
+- OpenAI: a local HTTP server in a separate process (chat completions with streaming, tool calls and structured outputs, the Assistants endpoints of the calculator), the OpenAI and LangChain clients run unchanged against it
+- VoyageAI and neo4j: in-process fakes behind the same timeout and admission wrappers as the real clients (or a neo4j test instance with `--live-neo4j`)
+- tiktoken: a fake encoding counting words and punctuation marks, since the `o200k_base` encoding is downloaded on first use (`--tiktoken` uses the real encoding, which needs network access or a `TIKTOKEN_CACHE_DIR` containing it)
+The fake models route every question to the expert model (`--doc-share` of the questions to the document search) and answer with a fixed plan of database, Human and LLM steps (`--calculation` adds a calculator step).
+
+Reported per concurrency level:
+- throughput (conversations per minute, graph turns per second) and p50/p95/p99 latency of the turns and conversations (without think time)
+- event-loop lag (delay of a periodic timer on the loop running the graph)
+- threads and RSS of the process at the start and the peak of the level, the RSS growth per additional thread and the RSS retained per conversation
+- checkpoint size (MemorySaver): serialised size of the last checkpoint and the number of checkpoints per conversation, total serialised size of the level
+- failed conversations: the count of failed and shed conversations and the distinct error messages with their counts
+
+Usage (run from the repository root, no credentials or network access needed):
+```shell
+python -m helper_notebooks_benchmark.load_test --concurrency 1 4 16 64 --conversations-per-user 3 --llm 800:0.02:6000
+```
+"""
+
+import argparse
+import asyncio
+import csv
+import gc
+import json
+import os
+import random
+import resource
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from helper_notebooks_benchmark.fakes import FakeEmbeddingClient, FakeEncoding, FakeGraphDriver, FakeOpenAIServer, SyntheticGraph, parse_profile, stable_hash
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PLAN_MARKER = "Each Plan should be followed by only one #E"     # part of the planner system prompt (see prompts.py)
+
+PLAN = """Plan: Suche die Regeln zur Bestimmung der Schneelast. #E1 = DataBase[Schneelast auf Dächern, Anfrage {request}]
+Plan: Frage nach dem Standort des Gebäudes. #E2 = Human[Wo steht das Gebäude (Standort) und wie hoch ist das Gelände?]
+Plan: Suche die Schneelastzone des Standorts. #E3 = DataBase[Schneelastzone für #E2]
+Plan: Bestimme die Schneelast aus den Ergebnissen. #E4 = LLM[Bestimme die Schneelast mit #E1, #E2 und #E3]
+"""
+CALCULATION_STEP = "Plan: Berechne die Schneelast auf dem Dach. #E5 = WolframAlpha[Berechne 0,8 * #E4]\n"
+
+
+#----------------- Fake models -----------------#
+def fill_schema(schema, definitions, question, answer, key=None):
+    """Returns a value matching a JSON schema: the question for 'query' and 'task', the answer for other strings, the first value of enums."""
+    if "$ref" in schema:
+        return fill_schema(definitions[schema["$ref"].rsplit("/", 1)[1]], definitions, question, answer, key)
+    for variants in ("anyOf", "oneOf", "allOf"):
+        if variants in schema:
+            options = [option for option in schema[variants] if option.get("type") != "null"]
+            return fill_schema(options[0], definitions, question, answer, key)
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = next(option for option in kind if option != "null")
+    if kind == "object" or "properties" in schema:
+        return {name: fill_schema(value, definitions, question, answer, name) for name, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [fill_schema(schema.get("items", {}), definitions, question, answer, key)]
+    if kind == "number":
+        return 0.9
+    if kind == "integer":
+        return 1
+    if kind == "boolean":
+        return True
+    return question if key in ("query", "task") else answer
+
+
+def _content(message):
+    # message contents are strings or lists of content parts
+    content = message.get("content")
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+class NormGraphResponder:
+    """
+    Decides the answers of the fake OpenAI server for the application graph:
+    - the agent model calls `InvokeExpertModel` (or `DocumentRetriever` for `doc_share` of the questions) and answers with text after the tool result
+    - the retriever model calls `SearchDataBase` with the task as query
+    - the planner answers with the fixed plan, structured outputs are filled from their schema, all other calls get a text answer
+    """
+
+    def __init__(self, calculation=False, doc_share=0.0, answer_chars=600):
+        self.plan = PLAN + (CALCULATION_STEP if calculation else "")
+        self.doc_share = doc_share
+        self.answer = ("Die charakteristische Schneelast ergibt sich aus der Schneelastzone und der Geländehöhe. " * (answer_chars // 90 + 1))[:answer_chars]
+
+    def __call__(self, body):
+        messages = body.get("messages", [])
+        users = [index for index, message in enumerate(messages) if message.get("role") == "user"]
+        question = _content(messages[users[-1]]) if users else ""
+        answered = any(message.get("role") == "tool" for message in messages[(users[-1] if users else 0):])
+
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"]["schema"]
+            return json.dumps(fill_schema(schema, schema.get("$defs", schema.get("definitions", {})), question, self.answer), ensure_ascii=False), []
+
+        tools = {tool["function"]["name"]: tool["function"].get("parameters", {}) for tool in body.get("tools") or []}
+        if tools and not (answered and body.get("tool_choice") != "required"):
+            if "InvokeExpertModel" in tools:
+                name = "DocumentRetriever" if stable_hash(question) % 1000 < self.doc_share * 1000 else "InvokeExpertModel"
+            else:
+                name = next(iter(tools))
+            parameters = tools[name]
+            return None, [(name, fill_schema(parameters, parameters.get("$defs", parameters.get("definitions", {})), question, self.answer))]
+
+        if any(PLAN_MARKER in _content(message) for message in messages if message.get("role") == "system"):
+            return self.plan.format(request=stable_hash(question) % 10 ** 6), []
+        return self.answer, []
+
+
+def _configure_environment(openai_url):
+    # the clients are created at import time, the credentials only need placeholders
+    for name, value in (("NEO4J_URI", "neo4j://127.0.0.1:7687"), ("NEO4J_USER", "neo4j"), ("NEO4J_PASSWORD", "load-test"),
+                        ("WOLFRAM_ALPHA_APPID", "load-test"), ("VOYAGE_API_KEY", "load-test"), ("OPENAI_API_KEY", "load-test")):
+        os.environ.setdefault(name, value)
+    os.environ["OPENAI_BASE_URL"] = openai_url
+    os.environ["NORMGRAPH_REPLAY_MODE"] = "off"
+
+
+def install_fakes(tools, args):
+    """Replaces the module level clients of `base_agent.utils.tools` with the fakes, wrapped like the real clients (timeouts, hedging, admission), and the tokenizer with the fake encoding."""
+    from base_agent.utils.admission import AdmissionProxy
+    from base_agent.utils.deadline import DeadlineProxy
+
+    if not args.live_neo4j:
+        fake_driver = FakeGraphDriver(parse_profile(args.neo4j, seed=args.seed), rows=SyntheticGraph(args.sections, section_chars=args.section_chars))
+        tools.driver = DeadlineProxy(AdmissionProxy(fake_driver, "neo4j", ["execute_query"]), "neo4j", ["execute_query"], hedge=True)
+    fake_client = FakeEmbeddingClient(parse_profile(args.embedding, seed=args.seed + 1), dim=args.dim)
+    tools.vo = DeadlineProxy(AdmissionProxy(fake_client, "embedding", ["embed"]), "embedding", ["embed"], hedge=True)
+    if not args.tiktoken:
+        # count_tokens looks the encoding up at call time
+        fake_encoding = FakeEncoding()
+        tools._token_encoding = lambda: fake_encoding
+
+
+#----------------- Measurements -----------------#
+def rss_bytes():
+    """Current resident set size of the process (peak RSS where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoadMonitor:
+    """Samples the event-loop lag, the number of threads and the RSS of the process while a level runs."""
+
+    def __init__(self, interval_s=0.05):
+        self.interval_s = interval_s
+        self.lags = []
+        self.start_threads = threading.active_count()
+        self.start_rss = rss_bytes()
+        self.peak_threads = self.start_threads
+        self.peak_rss = self.start_rss
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval_s)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval_s))
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss = max(self.peak_rss, rss_bytes())
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def checkpoint_sizes(graph, thread_ids):
+    """
+    Measures the checkpoints of the conversations in the checkpointer of the graph.
+
+    Returns:
+    tuple: (serialised sizes of the last checkpoint per conversation in bytes, number of checkpoints per conversation, total serialised size in bytes)
+    """
+    checkpointer = graph.checkpointer
+    last_sizes, counts, total = [], [], 0
+    for thread_id in thread_ids:
+        config = {"configurable": {"thread_id": thread_id}}
+        sizes = [len(checkpointer.serde.dumps_typed(checkpoint.checkpoint)[1]) for checkpoint in checkpointer.list(config)]
+        if sizes:
+            # list() returns the newest checkpoint first
+            last_sizes.append(sizes[0])
+            counts.append(len(sizes))
+            total += sum(sizes)
+    return last_sizes, counts, total
+
+
+#----------------- Simulated users -----------------#
+async def run_conversation(graph, question, fixture, user, args, scheduler):
+    """
+    Runs one conversation of a simulated user: the question and the answers to the `HumanFeedback` interrupts after a think time.
+
+    Returns:
+    dict: Thread id, latencies of the graph turns, interrupts and the error of the conversation (empty if answered, 'shed' if rejected by the admission control).
+    """
+    from langchain_core.messages import HumanMessage
+    from base_agent.utils.admission import Overloaded
+    from base_agent.utils.deadline import with_budget
+    from helper_notebooks_benchmark.benchmark_normgraph import answer_for
+
+    tenant = f"user-{user % args.tenants}"
+    config = {"configurable": {"thread_id": str(uuid.uuid4()), "tenant": tenant}, "recursion_limit": 100}
+    conversation = {"thread_id": config["configurable"]["thread_id"], "turns": [], "interrupts": 0, "error": ""}
+    graph_input = {"messages": [HumanMessage(question)]}
+    try:
+        while True:
+            start = time.perf_counter()
+            run_config = with_budget(config, args.budget) if args.budget else config
+            if scheduler is not None:
+                async with scheduler.admit(tenant, "interactive"):
+                    await graph.ainvoke(graph_input, run_config)
+            else:
+                await graph.ainvoke(graph_input, run_config)
+            conversation["turns"].append(time.perf_counter() - start)
+
+            state = await graph.aget_state(config)
+            if "HumanFeedback" not in state.next:
+                break
+            if conversation["interrupts"] >= args.max_interrupts:
+                raise RuntimeError(f"exceeded {args.max_interrupts} HumanFeedback interrupts")
+            conversation["interrupts"] += 1
+            # the user reads the question before answering
+            await asyncio.sleep(random.expovariate(1 / args.think_s) if args.think_s else 0)
+            await graph.aupdate_state(config, {"messages": [HumanMessage(answer_for(state.values["messages"][-1].content, fixture))]})
+            graph_input = None
+    except Overloaded:
+        conversation["error"] = "shed"
+    except Exception as e:
+        conversation["error"] = f"{type(e).__name__}: {e}"
+    return conversation
+
+
+async def run_level(graph, concurrency, questions, fixture, args):
+    """
+    Runs one concurrency level: `concurrency` simulated users in a closed loop until `concurrency * conversations_per_user` conversations are done.
+
+    Returns:
+    dict: The measurements of the level.
+    """
+    from base_agent.utils.admission import AdmissionScheduler
+    from helper_notebooks_benchmark.benchmark_normgraph import percentile
+
+    scheduler = AdmissionScheduler() if args.admission else None
+    total = concurrency * args.conversations_per_user
+    numbers = iter(range(total))
+    conversations = []
+
+    async def user(number):
+        # the users start spread over the ramp-up time
+        await asyncio.sleep(random.uniform(0, args.ramp_s))
+        for index in numbers:
+            question = questions[index % len(questions)]
+            if not args.repeat_questions:
+                # distinct questions don't hit the retrieval and embedding caches
+                question = f"{question} (Anfrage {concurrency}-{index})"
+            conversations.append(await run_conversation(graph, question, fixture, number, args, scheduler))
+
+    gc.collect()
+    monitor = LoadMonitor()
+    monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(user(number) for number in range(concurrency)))
+    wall_time = time.perf_counter() - start
+    await monitor.stop()
+    gc.collect()
+    end_rss = rss_bytes()
+
+    answered = [conversation for conversation in conversations if not conversation["error"]]
+    error_messages = Counter(conversation["error"] for conversation in conversations if conversation["error"] and conversation["error"] != "shed")
+    turns = [turn for conversation in answered for turn in conversation["turns"]]
+    latencies = [sum(conversation["turns"]) for conversation in answered]
+    last_sizes, counts, checkpoint_bytes = checkpoint_sizes(graph, [conversation["thread_id"] for conversation in conversations])
+    added_threads = monitor.peak_threads - monitor.start_threads
+    return {
+        "concurrency": concurrency,
+        "conversations": len(conversations),
+        "errors": sum(error_messages.values()),
+        "shed": sum(1 for conversation in conversations if conversation["error"] == "shed"),
+        "wall_time_s": round(wall_time, 3),
+        "conversations_per_min": round(len(answered) / wall_time * 60, 2) if wall_time else 0.0,
+        "turns_per_s": round(len(turns) / wall_time, 3) if wall_time else 0.0,
+        "turn_p50_s": round(percentile(turns, 50), 3),
+        "turn_p95_s": round(percentile(turns, 95), 3),
+        "turn_p99_s": round(percentile(turns, 99), 3),
+        "conversation_p50_s": round(percentile(latencies, 50), 3),
+        "conversation_p99_s": round(percentile(latencies, 99), 3),
+        "loop_lag_p50_ms": round(percentile(monitor.lags, 50) * 1000, 2),
+        "loop_lag_p99_ms": round(percentile(monitor.lags, 99) * 1000, 2),
+        "loop_lag_max_ms": round(max(monitor.lags, default=0.0) * 1000, 2),
+        "threads_start": monitor.start_threads,
+        "threads_peak": monitor.peak_threads,
+        "rss_start_mb": round(monitor.start_rss / 2 ** 20, 1),
+        "rss_peak_mb": round(monitor.peak_rss / 2 ** 20, 1),
+        "rss_end_mb": round(end_rss / 2 ** 20, 1),
+        # the worker threads of the executors stay alive, only the threads added by this level count
+        "rss_per_thread_kb": round((monitor.peak_rss - monitor.start_rss) / added_threads / 1024, 1) if added_threads > 0 else None,
+        "rss_retained_per_conversation_kb": round((end_rss - monitor.start_rss) / len(conversations) / 1024, 1) if conversations else 0.0,
+        "checkpoint_last_mean_kb": round(sum(last_sizes) / len(last_sizes) / 1024, 2) if last_sizes else 0.0,
+        "checkpoint_last_max_kb": round(max(last_sizes, default=0) / 1024, 2),
+        "checkpoints_per_conversation": round(sum(counts) / len(counts), 1) if counts else 0.0,
+        "checkpoint_total_mb": round(checkpoint_bytes / 2 ** 20, 2),
+        "error_messages": dict(error_messages.most_common()),
+    }
+
+
+async def run_levels(graph, questions, fixture, args):
+    if args.executor_workers:
+        # the synchronous graph nodes run in the default executor of the event loop
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.executor_workers))
+    results = []
+    for concurrency in args.concurrency:
+        result = await run_level(graph, concurrency, questions, fixture, args)
+        results.append(result)
+        print(json.dumps(result))
+        for message, count in result["error_messages"].items():
+            print(f"  {count} x {message}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the NormGraph application graph with simulated users against local fakes of the external services.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="simulated users per level")
+    parser.add_argument("--conversations-per-user", type=int, default=3)
+    parser.add_argument("--questions", default=os.path.join(BENCHMARK_DIR, "questions.csv"))
+    parser.add_argument("--feedback", default=os.path.join(BENCHMARK_DIR, "human_feedback.json"), help="fixture answering HumanFeedback interrupts")
+    parser.add_argument("--repeat-questions", action="store_true", help="repeat the questions verbatim (retrieval cache hits) instead of making them distinct")
+    parser.add_argument("--think-s", type=float, default=2.0, help="mean think time of a user before answering an interrupt")
+    parser.add_argument("--ramp-s", type=float, default=1.0, help="the users of a level start spread over this time")
+    parser.add_argument("--max-interrupts", type=int, default=5)
+    parser.add_argument("--llm", default="800:0.02:6000", help="latency profile of a chat completion 'p50_ms:tail_prob:tail_ms'")
+    parser.add_argument("--assistant", default="4000:0.05:20000", help="latency profile of a calculator assistant run")
+    parser.add_argument("--embedding", default="60:0.02:3000", help="latency profile of the embedding service")
+    parser.add_argument("--neo4j", default="15:0.02:2000", help="latency profile of neo4j")
+    parser.add_argument("--live-neo4j", action="store_true", help="query the neo4j instance of NEO4J_URI instead of the fake driver")
+    parser.add_argument("--sections", type=int, default=500, help="sections of the synthetic corpus")
+    parser.add_argument("--section-chars", type=int, default=2000, help="characters of a rendered section")
+    parser.add_argument("--dim", type=int, default=1024, help="dimension of the fake embeddings")
+    parser.add_argument("--tiktoken", action="store_true", help="count tokens with the real o200k_base encoding (downloaded on first use) instead of the fake encoding")
+    parser.add_argument("--calculation", action="store_true", help="add a calculator step to the plan of the fake planner")
+    parser.add_argument("--doc-share", type=float, default=0.0, help="share of the questions routed to the document search instead of the expert model")
+    parser.add_argument("--budget", type=float, default=None, help="latency budget per graph invocation in seconds")
+    parser.add_argument("--admission", action="store_true", help="admit the graph invocations through the admission control (NORMGRAPH_MAX_RUNS, NORMGRAPH_TENANT_LIMIT, ...)")
+    parser.add_argument("--tenants", type=int, default=8, help="tenants the simulated users belong to (admission control)")
+    parser.add_argument("--executor-workers", type=int, default=None, help="threads of the executor running the graph nodes (default: asyncio default)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="output path without file extension (csv and json)")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    server = FakeOpenAIServer(NormGraphResponder(args.calculation, args.doc_share), parse_profile(args.llm, seed=args.seed + 2), parse_profile(args.assistant, seed=args.seed + 3))
+    process, openai_url = server.start()
+    try:
+        # the application reads its configuration at import time, so it is imported after the environment points to the fakes
+        _configure_environment(openai_url)
+        from base_agent.agent import graph
+        from base_agent.utils import tools
+        from helper_notebooks_benchmark.benchmark_normgraph import load_feedback_fixture, load_questions
+
+        install_fakes(tools, args)
+        results = asyncio.run(run_levels(graph, load_questions(args.questions), load_feedback_fixture(args.feedback), args))
+    finally:
+        process.terminate()
+
+    if args.output:
+        with open(args.output + ".csv", 'w', newline='', encoding='utf-8') as output_file:
+            dict_writer = csv.DictWriter(output_file, results[0].keys())
+            dict_writer.writeheader()
+            # the error messages are written as a JSON object into their column
+            dict_writer.writerows(dict(result, error_messages=json.dumps(result["error_messages"], ensure_ascii=False)) for result in results)
+        with open(args.output + ".json", 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
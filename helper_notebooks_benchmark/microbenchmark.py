@@ -0,0 +1,180 @@
+"""
+Hermetic microbenchmark of the retrieval and expert-plan pipeline.
+
+The benchmark uses the record/replay layer of `base_agent/utils/replay.py`: in replay mode all neo4j-, VoyageAI- and OpenAI-responses are served from the local fixture store, so the measured timings only contain the application's own code (rank fusion, section parsing, context rendering, plan parsing) plus an optional synthetic latency.
+
+Besides the timings, the memory allocated per retrieval (section tree and rendered context) is measured with tracemalloc. Running the benchmark on two revisions with the same fixtures compares their memory footprint.
+
+Steps:
+- record fixtures once against the live services (requires the credentials in `.env`):
+```shell
+python -m helper_notebooks_benchmark.microbenchmark --mode record
+```
+  Running `benchmark_normgraph.py` with `NORMGRAPH_REPLAY_MODE=record` additionally records the planner outputs used for the plan-parsing stages.
+- run the benchmark offline (e.g. in CI):
+```shell
+python -m helper_notebooks_benchmark.microbenchmark --repeat 50 --output results/microbenchmark.json
+```
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Placeholder credentials, so the application modules can be imported without a live environment. No connection is opened in replay mode.
+OFFLINE_ENV = {
+    "NEO4J_URI": "bolt://localhost:7687",
+    "NEO4J_USER": "neo4j",
+    "NEO4J_PASSWORD": "replay",
+    "WOLFRAM_ALPHA_APPID": "replay",
+    "OPENAI_API_KEY": "replay",
+    "VOYAGE_API_KEY": "replay",
+}
+
+
+def configure(mode: str, fixture_dir: str):
+    os.environ["NORMGRAPH_REPLAY_MODE"] = mode
+    os.environ.setdefault("NORMGRAPH_FIXTURE_DIR", fixture_dir)
+    if mode == "replay":
+        os.environ.setdefault("NORMGRAPH_REPLAY_LATENCY_MS", "0")
+        for key, value in OFFLINE_ENV.items():
+            os.environ.setdefault(key, value)
+    else:
+        try:
+            from dotenv import load_dotenv
+            load_dotenv()
+        except ImportError:
+            pass
+
+
+def time_stage(timings: Dict[str, List[float]], stage: str, func: Callable, repeat: int):
+    """
+    Run `func` `repeat` times and store the duration of each call under `stage`.
+
+    Returns:
+    The result of the last call.
+    """
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.setdefault(stage, []).append(time.perf_counter() - start)
+    return result
+
+
+def measure_memory(memory: Dict[str, List[tuple]], stage: str, func: Callable):
+    """
+    Run `func` once under tracemalloc and store the retained and the peak allocation (bytes) under `stage`.
+
+    Returns:
+    The result of the call.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    memory.setdefault(stage, []).append((current - before, peak - before))
+    return result
+
+
+def recorded_plans() -> List[str]:
+    """Returns all recorded chat model outputs that contain an expert plan."""
+    from langchain_core.load import loads
+    from base_agent.utils.replay import get_store
+
+    plans = []
+    for generations in get_store().entries("llm").values():
+        for generation in generations:
+            text = loads(generation).text
+            if "Plan:" in text and "#E1" in text:
+                plans.append(text)
+    return plans
+
+
+def run(questions: List[str], repeat: int, k: int, memory: Dict[str, List[tuple]]) -> Dict[str, List[float]]:
+    from base_agent.utils import tools
+
+    timings: Dict[str, List[float]] = {}
+    for question in questions:
+        ranked = time_stage(timings, "RRFGraphQuery", lambda: tools.RRFGraphQuery(question, k, tools.driver, tools.vo), repeat)
+        keys = list(ranked.keys())
+
+        # rank fusion on its own, with two ranked lists of the size returned by the query
+        search_results = {'textSearch': keys, 'vecSearch': keys[::-1]}
+        unique_values = tools.gather_unique_values(search_results)
+        time_stage(timings, "reciprocal_rank_fusion", lambda: tools.apply_reciprocal_rank_fusion(unique_values, ['textSearch', 'vecSearch'], search_results), repeat)
+
+        if not keys:
+            continue
+        rows = time_stage(timings, "RetrieveSections", lambda: tools.RetrieveSections(keys, tools.driver), repeat)
+        root_section = time_stage(timings, "parse_query_response", lambda: tools.parse_query_response(rows), repeat)
+        # memory per retrieval: building the section tree and rendering the context
+        measure_memory(memory, "section_tree", lambda: tools.parse_query_response(rows))
+        measure_memory(memory, "render_context", lambda: tools.reduce_linebreaks(root_section.__str__()))
+        time_stage(timings, "render_context", lambda: tools.reduce_linebreaks(root_section.__str__()), repeat)
+        # materialised renderings: single indexed lookup of the sections (see base_agent/utils/sections.py)
+        time_stage(timings, "MaterializedSections", lambda: tools.get_section_context(keys, tools.driver), repeat)
+
+    for plan in recorded_plans():
+        steps = time_stage(timings, "parse_steps_fixed", lambda: tools.parse_steps_fixed(plan), repeat)
+        time_stage(timings, "sort_steps", lambda: tools.sort_steps(steps), repeat)
+
+    return timings
+
+
+def summarize(timings: Dict[str, List[float]], memory: Dict[str, List[tuple]]) -> Dict:
+    from helper_notebooks_benchmark.benchmark_normgraph import percentile
+
+    summary = {
+        stage: {
+            "calls": len(durations),
+            "median_ms": round(percentile(durations, 50) * 1000, 4),
+            "p95_ms": round(percentile(durations, 95) * 1000, 4),
+            "min_ms": round(min(durations) * 1000, 4),
+        }
+        for stage, durations in timings.items()
+    }
+    summary["memory_per_retrieval"] = {
+        stage: {
+            "retained_kb_mean": round(sum(retained for retained, _ in sizes) / len(sizes) / 1024, 2),
+            "peak_kb_mean": round(sum(peak for _, peak in sizes) / len(sizes) / 1024, 2),
+        }
+        for stage, sizes in memory.items()
+    }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline microbenchmark of the NormGraph retrieval and plan pipeline.")
+    parser.add_argument("--mode", choices=["record", "replay"], default="replay")
+    parser.add_argument("--fixtures", default=os.path.join(BENCHMARK_DIR, "fixtures"))
+    parser.add_argument("--questions", default=os.path.join(BENCHMARK_DIR, "questions.csv"))
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--output", default=None, help="optional json output file")
+    args = parser.parse_args()
+
+    configure(args.mode, args.fixtures)
+
+    from helper_notebooks_benchmark.benchmark_normgraph import load_questions
+    questions = load_questions(args.questions)[:args.limit]
+    repeat = 1 if args.mode == "record" else args.repeat
+
+    memory: Dict[str, List[tuple]] = {}
+    summary = summarize(run(questions, repeat, args.k, memory), memory)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(summary, output_file, indent=2)
+    json.dump(summary, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Memory and recall evaluation of the quantised two-stage vector search (`base_agent/utils/quantization.py`) against the float index.
+
+The float embeddings are loaded once into the local mirror of `vector_index.py` (exact 'flat' search, the reference). For every setting (int8 / binary codes, truncated candidate dimensions, oversampling factor) the quantised index is built from the same vectors and every question is searched with both indexes:
+- recall@k: share of the exact float top-k chunks found by the two-stage search
+- memory: bytes of the codes held in memory, compared to the float matrix
+- latency of the candidate pass and of the full two-stage search (rescoring uses the local float matrix here, in the agent the candidates are fetched from the graph)
+
+Usage (run from the repository root):
+```shell
+python -m helper_notebooks_benchmark.quantization_eval --kind int8 binary --dim 1024 512 256 --oversample 2 4 8 --output results/quantization_eval
+```
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+from base_agent.utils import tools
+from base_agent.utils.quantization import QuantizedIndex
+from base_agent.utils.vector_index import LocalVectorIndex
+from helper_notebooks_benchmark.benchmark_normgraph import load_questions, percentile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def evaluate(float_index: LocalVectorIndex, query_vectors: List, kind: str, dim: int, oversample: int, k: int) -> Dict:
+    """
+    Evaluate one quantisation setting against the exact float search.
+
+    Args:
+    float_index (LocalVectorIndex): Reference index with exact search.
+    query_vectors (List): Embedded questions.
+    kind (str): 'int8' or 'binary'.
+    dim (int): Dimensions used by the candidate pass.
+    oversample (int): Rescored candidates per result.
+    k (int): Number of results.
+
+    Returns:
+    Dict: Recall, memory and latency of the setting.
+    """
+    index = QuantizedIndex.from_vectors(float_index.vectors, [None] * len(float_index.chunk_ids), float_index.chunk_ids,
+                                        float_index.section_ids, float_index.titles, kind, dim=dim, oversample=oversample)
+    recalls, candidate_latencies, search_latencies = [], [], []
+    for query in query_vectors:
+        exact_rows, _ = float_index.top_chunks(query, k)
+        normalized = np.array(query, dtype=np.float32)
+        normalized /= np.linalg.norm(normalized) + 1e-12
+
+        start = time.perf_counter()
+        index.candidates(normalized, k * oversample)
+        candidate_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        rows, _ = index.top_chunks(query, k, vectors=float_index.vectors)
+        search_latencies.append(time.perf_counter() - start)
+
+        if len(exact_rows):
+            recalls.append(len(set(rows.tolist()) & set(exact_rows.tolist())) / len(exact_rows))
+
+    float_bytes = len(float_index.chunk_ids) * float_index.vectors.shape[1] * 4
+    return {
+        "kind": kind,
+        "dim": dim,
+        "oversample": oversample,
+        "k": k,
+        "recall_at_k": round(sum(recalls) / len(recalls), 4) if recalls else 0.0,
+        "memory_mb": round(index.memory_bytes() / 2**20, 2),
+        "float_memory_mb": round(float_bytes / 2**20, 2),
+        "compression": round(float_bytes / max(index.memory_bytes(), 1), 1),
+        "candidate_median_ms": round(percentile(candidate_latencies, 50) * 1000, 3),
+        "search_median_ms": round(percentile(search_latencies, 50) * 1000, 3),
+        "search_p95_ms": round(percentile(search_latencies, 95) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate memory and recall of quantised embeddings vs. the float index.")
+    parser.add_argument("--questions", default=os.path.join(BENCHMARK_DIR, "questions.csv"))
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--kind", nargs="+", choices=["int8", "binary"], default=["int8", "binary"])
+    parser.add_argument("--dim", type=int, nargs="+", default=[1024])
+    parser.add_argument("--oversample", type=int, nargs="+", default=[4])
+    parser.add_argument("--k", type=int, default=tools.DOCUMENT_RETRIEVER_K)
+    parser.add_argument("--cache", default=os.environ.get("NORMGRAPH_VECTOR_CACHE", ".vector_cache"))
+    parser.add_argument("--output", default=None, help="output path without file extension (csv and json)")
+    args = parser.parse_args()
+
+    float_index = LocalVectorIndex.load(tools.driver, args.cache, kind="flat")
+    questions = load_questions(args.questions)[:args.limit]
+    query_vectors = [tools.get_embedding(tools.vo, question, tools.EMBEDDING_MODEL) for question in questions]
+    print(f"Evaluating {len(questions)} questions on {len(float_index.chunk_ids)} embeddings...")
+
+    results = []
+    for kind, dim, oversample in itertools.product(args.kind, args.dim, args.oversample):
+        result = evaluate(float_index, query_vectors, kind, dim, oversample, args.k)
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output + ".csv", 'w', newline='', encoding='utf-8') as output_file:
+            dict_writer = csv.DictWriter(output_file, results[0].keys())
+            dict_writer.writeheader()
+            dict_writer.writerows(results)
+        with open(args.output + ".json", 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
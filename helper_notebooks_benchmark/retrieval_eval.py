@@ -0,0 +1,170 @@
+"""
+Retrieval quality-vs-latency evaluation of the hybrid retriever (`RRFGraphQuery`).
+
+The script runs a labelled set of questions (`retrieval_labels.json`, question -> expected section ids or section numbers) through the retriever and sweeps its parameters:
+- k: number of vector search results (DocumentRetriever uses 5, SearchDataBase 3)
+- score threshold: minimum cosine similarity of the vector search (0.8)
+- RRF constant: k of the reciprocal rank fusion (60)
+
+For every parameter combination recall@k, MRR and nDCG@k are reported next to the retrieval latency and the token size of the rendered context, that is passed to the models. The cheapest setting within a configurable recall tolerance of the best setting is recommended.
+
+With `--filters`, every combination is additionally evaluated with the data type / category pre-filters of `base_agent/utils/filters.py`, using the optional 'data_type' and 'category' of each labelled question (the values the model would choose in the tool call).
+
+Usage (run from the repository root):
+```shell
+python -m helper_notebooks_benchmark.retrieval_eval --k 3 5 8 --threshold 0.7 0.8 --rrf-k 20 60 --output results/retrieval_eval
+python -m helper_notebooks_benchmark.retrieval_eval --filters --output results/retrieval_eval_filters
+```
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import time
+from typing import Dict, List
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+from base_agent.utils import tools
+from base_agent.utils.filters import filter_for
+from helper_notebooks_benchmark.benchmark_normgraph import percentile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_labels(filename: str) -> List[Dict]:
+    """
+    Load the labelled questions and resolve section numbers to section ids.
+
+    Returns:
+    List[Dict]: Entries with 'question', the set 'expected' of relevant section ids and the optional 'data_type' and 'category'. Unlabelled questions are skipped.
+    """
+    with open(filename, encoding='utf-8') as labels_file:
+        entries = json.load(labels_file)["questions"]
+
+    nums = sorted({num for entry in entries for num in entry.get("expected_nums", [])})
+    ids_by_num = {}
+    if nums:
+        records, _, _ = tools.driver.execute_query("MATCH (s) WHERE s.num IN $nums RETURN s.num AS num, s.id AS id", nums=nums)
+        for record in records:
+            ids_by_num.setdefault(record["num"], set()).add(record["id"])
+
+    labelled = []
+    for entry in entries:
+        expected = set(entry.get("expected_ids", []))
+        for num in entry.get("expected_nums", []):
+            expected |= ids_by_num.get(num, set())
+        if expected:
+            labelled.append({"question": entry["question"], "expected": expected, "data_type": entry.get("data_type"), "category": entry.get("category")})
+    return labelled
+
+
+def recall_at_k(ranking: List[str], expected: set, k: int) -> float:
+    return len(set(ranking[:k]) & expected) / len(expected)
+
+
+def reciprocal_rank(ranking: List[str], expected: set) -> float:
+    for position, doc in enumerate(ranking, start=1):
+        if doc in expected:
+            return 1.0 / position
+    return 0.0
+
+
+def ndcg_at_k(ranking: List[str], expected: set, k: int) -> float:
+    dcg = sum(1.0 / math.log2(position + 1) for position, doc in enumerate(ranking[:k], start=1) if doc in expected)
+    ideal = sum(1.0 / math.log2(position + 1) for position in range(1, min(len(expected), k) + 1))
+    return dcg / ideal if ideal else 0.0
+
+
+def render_context(section_ids: List[str]) -> str:
+    """Render the context exactly as the retrieval tools pass it to the model."""
+    if not section_ids:
+        return ""
+    root_section = tools.parse_query_response(tools.RetrieveSections(section_ids, tools.driver))
+    return tools.reduce_linebreaks(root_section.__str__())
+
+
+def evaluate(labels: List[Dict], k: int, threshold: float, rrf_k: int, filtered: bool = False) -> Dict:
+    """
+    Evaluate one parameter combination on all labelled questions, optionally with the data type / category filter of each question.
+    """
+    recalls, reciprocal_ranks, ndcgs, latencies, context_tokens, retrieved = [], [], [], [], [], []
+    for entry in labels:
+        search_filter = filter_for(entry["data_type"], entry["category"]) if filtered else None
+        start = time.perf_counter()
+        ranked = tools.RRFGraphQuery(entry["question"], k, tools.driver, tools.vo, score_threshold=threshold, rrf_k=rrf_k, search_filter=search_filter)
+        latencies.append(time.perf_counter() - start)
+
+        ranking = list(ranked.keys())
+        recalls.append(recall_at_k(ranking, entry["expected"], k))
+        reciprocal_ranks.append(reciprocal_rank(ranking, entry["expected"]))
+        ndcgs.append(ndcg_at_k(ranking, entry["expected"], k))
+        retrieved.append(len(ranking))
+        context_tokens.append(tools.count_tokens(render_context(ranking)))
+
+    n = len(labels)
+    return {
+        "k": k,
+        "score_threshold": threshold,
+        "rrf_k": rrf_k,
+        "filtered": filtered,
+        "recall_at_k": round(sum(recalls) / n, 4),
+        "mrr": round(sum(reciprocal_ranks) / n, 4),
+        "ndcg_at_k": round(sum(ndcgs) / n, 4),
+        "mean_retrieved_sections": round(sum(retrieved) / n, 2),
+        "mean_context_tokens": round(sum(context_tokens) / n, 1),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(percentile(latencies, 95) * 1000, 1),
+    }
+
+
+def recommend(results: List[Dict], tolerance: float) -> Dict:
+    """Cheapest setting (context tokens, then latency) whose recall is within `tolerance` of the best recall."""
+    best_recall = max(result["recall_at_k"] for result in results)
+    candidates = [result for result in results if result["recall_at_k"] >= best_recall - tolerance]
+    return min(candidates, key=lambda result: (result["mean_context_tokens"], result["latency_p50_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate retrieval quality vs. latency of RRFGraphQuery.")
+    parser.add_argument("--labels", default=os.path.join(BENCHMARK_DIR, "retrieval_labels.json"))
+    parser.add_argument("--k", type=int, nargs="+", default=[tools.SEARCH_DATABASE_K, tools.DOCUMENT_RETRIEVER_K])
+    parser.add_argument("--threshold", type=float, nargs="+", default=[tools.VECTOR_SCORE_THRESHOLD])
+    parser.add_argument("--rrf-k", type=int, nargs="+", default=[tools.RRF_K])
+    parser.add_argument("--filters", action="store_true", help="additionally evaluate every setting with the data type / category filters")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="accepted recall loss of the recommended setting")
+    parser.add_argument("--output", default=None, help="output path without file extension (csv and json)")
+    args = parser.parse_args()
+
+    labels = load_labels(args.labels)
+    if not labels:
+        raise SystemExit(f"No labelled questions in {args.labels}, add 'expected_ids' or 'expected_nums' first.")
+    print(f"Evaluating {len(labels)} labelled questions...")
+
+    results = []
+    for k, threshold, rrf_k, filtered in itertools.product(args.k, args.threshold, args.rrf_k, [False, True] if args.filters else [False]):
+        result = evaluate(labels, k, threshold, rrf_k, filtered)
+        results.append(result)
+        print(json.dumps(result))
+
+    recommendation = recommend(results, args.tolerance)
+    print("Recommended setting: " + json.dumps(recommendation))
+
+    if args.output:
+        with open(args.output + ".csv", 'w', newline='', encoding='utf-8') as output_file:
+            dict_writer = csv.DictWriter(output_file, results[0].keys())
+            dict_writer.writeheader()
+            dict_writer.writerows(results)
+        with open(args.output + ".json", 'w', encoding='utf-8') as output_file:
+            json.dump({"results": results, "recommendation": recommendation}, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()